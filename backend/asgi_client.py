@@ -0,0 +1,146 @@
+'''
+ASGI test client
+
+Runs the async app of flaskr.asgi from synchronous code, for the tests and
+benchmarks: AsyncAppRunner keeps an event loop in a background thread and
+hands out clients with the open, get, post and delete methods of the Flask
+test client.
+'''
+
+import asyncio
+import json
+import threading
+from urllib.parse import unquote
+
+from werkzeug.datastructures import Headers
+
+from flaskr import json_body
+
+
+class AsyncAppRunner:
+    '''
+    Event loop running the requests of an AsyncApp in a background thread
+    Requests of every client of the runner run concurrently on the loop, so
+    clients in many threads share the app and its pool
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def run(self, coroutine):
+        '''Return result of coroutine run on the event loop'''
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever,
+                                 name='asgi-test-client',
+                                 daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def test_client(self):
+        '''Return client making requests from synchronous code'''
+        return AsyncTestClient(self)
+
+    def close(self):
+        '''Shut the app down and stop the event loop'''
+        with self.loop_lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.app.shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+class TestResponse:
+    '''Response received by AsyncTestClient'''
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    @property
+    def mimetype(self):
+        '''Return media type of the Content-Type header'''
+        return self.headers.get('Content-Type', '').split(';')[0].strip()
+
+    def get_data(self, as_text=False):
+        '''Return body bytes, or text if as_text'''
+        return self.data.decode('utf-8') if as_text else self.data
+
+    def get_json(self):
+        '''Return body decoded as JSON'''
+        return json.loads(self.data)
+
+    def close(self):
+        pass
+
+
+class AsyncTestClient:
+    '''Client making requests to the app of an AsyncAppRunner'''
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def open(self, path, method='GET', json=None, data=None, headers=None,
+             content_type=None):
+        '''Return TestResponse of request'''
+        path, _, query_string = path.partition('?')
+        body = data or b''
+        if isinstance(body, str):
+            body = body.encode()
+        header_list = list((headers or {}).items())
+        if json is not None:
+            body = json_body(json)
+            content_type = 'application/json'
+        if content_type is not None:
+            header_list.append(('Content-Type', content_type))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method.upper(),
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode(),
+            'query_string': query_string.encode(),
+            'root_path': '',
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in header_list],
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80)
+        }
+        return self.runner.run(self.request(scope, body))
+
+    async def request(self, scope, body):
+        '''Return TestResponse of ASGI request scope with body'''
+        messages = [{'type': 'http.request', 'body': body,
+                     'more_body': False}]
+        sent = []
+
+        async def receive():
+            if len(messages) > 0:
+                return messages.pop(0)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.runner.app(scope, receive, send)
+        return TestResponse(
+            sent[0]['status'],
+            Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                     for name, value in sent[0]['headers']]),
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def get(self, path, **kwargs):
+        return self.open(path, method='GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, method='POST', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, method='DELETE', **kwargs)
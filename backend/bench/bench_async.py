@@ -0,0 +1,80 @@
+'''
+Benchmark the sync and async apps side by side at rising concurrency
+
+Seeds the given database with synthetic questions, then runs scenarios of
+bench_endpoints against create_app and create_async_app with each number
+of --clients, through their test clients or with --server over HTTP to a
+threaded WSGI server and to uvicorn. Both apps get the same pool settings.
+Prints the requests per second and p99 latency of each app.
+
+    createdb trivia_bench
+    python bench/bench_async.py --clients 1 16 64 256 \
+        --database postgresql://localhost:5432/trivia_bench
+'''
+
+import argparse
+
+from bench_endpoints import (
+    SCENARIOS, Workload, delete_bench_questions, run_scenario, serve
+)
+from common import DATABASE_PATH, seed
+from asgi_client import AsyncAppRunner
+from flaskr import create_app
+from flaskr.asgi import create_async_app
+
+DEFAULT_SCENARIOS = ['first_page', 'category_page', 'search', 'quiz_turn',
+                     'insert', 'delete']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1, 16, 64, 256])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per scenario and client count')
+    parser.add_argument('--pool-size', type=int,
+                        help='DB_POOL_SIZE of both apps')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS),
+                        default=DEFAULT_SCENARIOS)
+    parser.add_argument('--server', action='store_true',
+                        help='serve over HTTP instead of the test clients')
+    args = parser.parse_args()
+
+    config = {'DATABASE_URL': args.database, 'DB_POOL_SIZE': args.pool_size}
+    app = create_app({**config, 'CREATE_SCHEMA': True})
+    with app.app_context():
+        seed(args.questions)
+        # Seeding bypasses the data versions, so drop the stale index
+        app.extensions['trivia_indexes'].clear()
+    workload = Workload(args.questions, 6, 20, 100)
+    apps = [('sync', app),
+            ('async', AsyncAppRunner(create_async_app(config)))]
+    try:
+        for name in args.scenarios:
+            for clients in args.clients:
+                line = f'{name:<14} clients={clients:<4}'
+                for label, served_app in apps:
+                    make_driver, server = serve(served_app, label == 'async',
+                                                args.server)
+                    try:
+                        run_scenario(SCENARIOS[name], make_driver, workload,
+                                     1, 20)
+                        result = run_scenario(SCENARIOS[name], make_driver,
+                                              workload, clients,
+                                              args.requests)
+                    finally:
+                        if server is not None:
+                            server.shutdown()
+                    line += (f' {label}={result["requests_per_second"]:.0f}/s'
+                             f' p99={result["p99_ms"]}ms'
+                             f' errors={result["errors"]}')
+                print(line, flush=True)
+    finally:
+        apps[1][1].close()
+        delete_bench_questions(app)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Benchmark bulk and filtered deletes against a loop of single deletes
+
+Seeds the given database with synthetic questions, then imports questions
+into an extra category and deletes them three ways: one DELETE
+/questions/<id> per question, DELETE /questions with their ID list, and
+DELETE /questions with their category. Prints the questions deleted per
+second of each. The question ID index is built before every delete, as
+it is in a serving app.
+
+    createdb trivia_bench
+    python bench/bench_delete.py --questions 100000 --deletes 100 1000 10000
+'''
+
+import argparse
+import time
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app
+from flaskr.bulk import import_questions, MAX_DELETE_IDS
+from flaskr.question_ids import question_ids
+from models import db, Category, Question
+
+
+def delete_one_by_one(client, ids, category_id):
+    '''DELETE /questions/<id> for each question'''
+    for question_id in ids:
+        client.delete(f'/questions/{question_id}')
+
+
+def delete_by_ids(client, ids, category_id):
+    '''DELETE /questions with lists of up to MAX_DELETE_IDS IDs'''
+    for offset in range(0, len(ids), MAX_DELETE_IDS):
+        client.delete('/questions',
+                      json={'ids': ids[offset:offset + MAX_DELETE_IDS]})
+
+
+def delete_by_category(client, ids, category_id):
+    '''DELETE /questions with the category'''
+    client.delete('/questions', json={'category': category_id})
+
+
+METHODS = [('one_by_one', delete_one_by_one), ('ids', delete_by_ids),
+           ('category', delete_by_category)]
+
+
+def import_retired(app, category_id, count):
+    '''Return IDs of count questions imported into category'''
+    with app.app_context():
+        import_questions([{
+            'question': f'Retired question {i}?',
+            'answer': 'Retired',
+            'category': category_id,
+            'difficulty': i % 5 + 1
+        } for i in range(count)], {category_id})
+        question_ids()
+        return [question_id for question_id, in Question.query.with_entities(
+            Question.id).filter(Question.category == category_id)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--deletes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    app = create_app({'DATABASE_URL': args.database, 'CREATE_SCHEMA': True})
+    with app.app_context():
+        seed(args.questions)
+        # Seeding bypasses the data versions, so drop the stale index
+        app.extensions['trivia_indexes'].clear()
+        category = Category('Retired')
+        db.session.add(category)
+        db.session.commit()
+        category_id = category.id
+    client = app.test_client()
+    for count in args.deletes:
+        for name, method in METHODS:
+            ids = import_retired(app, category_id, count)
+            start = time.perf_counter()
+            method(client, ids, category_id)
+            elapsed = time.perf_counter() - start
+            print(f'deletes={count} method={name} seconds={elapsed:.3f} '
+                  f'questions_per_second={count / elapsed:.0f}')
+
+
+if __name__ == '__main__':
+    main()
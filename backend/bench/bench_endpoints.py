@@ -0,0 +1,452 @@
+'''
+Benchmark every endpoint with concurrent clients
+
+Seeds a database with synthetic questions and categories, a SQLite file
+by default or the database of --database, then runs each scenario with
+concurrent clients, through the test client or with --server over HTTP to
+a local server. Prints the throughput and the p50, p95 and p99 latency of
+every scenario as JSON, so runs can be compared between commits.
+
+    python bench/bench_endpoints.py --questions 100000 --output before.json
+    python bench/bench_endpoints.py --server --clients 8 \
+        --database postgresql://localhost:5432/trivia_bench
+
+With --async-app the requests go to the ASGI app of create_async_app,
+served over HTTP by uvicorn with --server (see requirements-optional.txt).
+
+Scenarios run in the order below, reads first. Inserted and bulk
+imported questions are deleted when the run ends. With --write-behind,
+inserts are queued and answered 202, and the delete scenario has none of
+them to delete.
+'''
+
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from common import CATEGORIES, seed, vocabulary
+from asgi_client import AsyncAppRunner
+from flaskr import create_app, encode_cursor, QUESTIONS_PER_PAGE
+from flaskr.asgi import create_async_app
+from flaskr.counts import reconcile_question_counts
+from models import db, Question
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+SQLITE_PATH = 'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                          'trivia_bench.db')
+BENCH_QUESTION = 'Benchmark question?'
+# Search terms and suggestion prefixes come from the most common words
+COMMON_WORDS = 200
+
+
+class TestClientDriver:
+    '''Makes requests through the test client of a sync or async app'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        '''Return status code of response to request, and the response'''
+        response = self.client.open(path, method=method, json=body)
+        response.get_data()
+        response.close()
+        return response.status_code, response
+
+
+class ServerDriver:
+    '''Makes requests over HTTP to a local server on port'''
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None):
+        '''Return status code of response to request, and its body'''
+        connection = http.client.HTTPConnection('localhost', self.port)
+        try:
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+class Workload:
+    '''Seeded data the scenarios pick their requests from'''
+
+    def __init__(self, question_count, category_count, quiz_length,
+                 bulk_size):
+        self.question_count = question_count
+        self.category_count = category_count
+        self.quiz_length = quiz_length
+        self.bulk_size = bulk_size
+        self.words = vocabulary()[:COMMON_WORDS]
+        # IDs of inserted questions for the delete scenario to take
+        self.created = collections.deque()
+
+
+def response_json(response):
+    '''Return JSON body of test client response or HTTP response body'''
+    if isinstance(response, bytes):
+        return json.loads(response)
+    return response.get_json()
+
+
+def get_categories(driver, workload, state):
+    '''GET /categories'''
+    return driver.request('GET', '/categories')[0]
+
+
+def get_first_page(driver, workload, state):
+    '''GET /questions'''
+    return driver.request('GET', '/questions')[0]
+
+
+def get_deep_page(driver, workload, state):
+    '''GET /questions with a page in the last tenth of all pages'''
+    pages = max(1, math.ceil(workload.question_count / QUESTIONS_PER_PAGE))
+    page = state['generator'].randint(pages - pages // 10, pages)
+    return driver.request('GET', f'/questions?page={page}')[0]
+
+
+def get_after_cursor(driver, workload, state):
+    '''GET /questions after a cursor in the last tenth of all questions'''
+    question_id = state['generator'].randint(
+        workload.question_count * 9 // 10, workload.question_count - 1)
+    return driver.request(
+        'GET', f'/questions?after={encode_cursor(question_id)}')[0]
+
+
+def get_category_page(driver, workload, state):
+    '''GET /categories/<id>/questions with any page of a random category'''
+    generator = state['generator']
+    pages = max(1, workload.question_count // workload.category_count //
+                QUESTIONS_PER_PAGE)
+    return driver.request(
+        'GET', f'/categories/{generator.randint(1, workload.category_count)}'
+               f'/questions?page={generator.randint(1, pages)}')[0]
+
+
+def post_search(driver, workload, state):
+    '''POST /questions with the search term of a common word'''
+    return driver.request('POST', '/questions', {
+        'searchTerm': state['generator'].choice(workload.words)
+    })[0]
+
+
+def get_suggestions(driver, workload, state):
+    '''GET /questions/suggest with a prefix of a common word'''
+    prefix = state['generator'].choice(workload.words)[:3]
+    return driver.request('GET', f'/questions/suggest?prefix={prefix}')[0]
+
+
+def post_quiz_turn(driver, workload, state):
+    '''POST /quizzes for the next turn of a quiz of quiz_length turns'''
+    if len(state['previous_questions']) == 0:
+        state['category'] = state['generator'].randint(
+            0, workload.category_count)
+    status, response = driver.request('POST', '/quizzes', {
+        'previous_questions': state['previous_questions'],
+        'quiz_category': {'id': state['category']}
+    })
+    question = response_json(response)['question'] if status == 200 else None
+    if question is None or \
+            len(state['previous_questions']) + 1 == workload.quiz_length:
+        state['previous_questions'] = []
+    else:
+        state['previous_questions'].append(question['id'])
+    return status
+
+
+def post_quiz_prefetch(driver, workload, state):
+    '''POST /quizzes with count for every question of a quiz'''
+    return driver.request('POST', '/quizzes', {
+        'previous_questions': [],
+        'quiz_category': {
+            'id': state['generator'].randint(0, workload.category_count)},
+        'count': workload.quiz_length
+    })[0]
+
+
+def get_export(driver, workload, state):
+    '''GET /questions/export of a random category and difficulty'''
+    generator = state['generator']
+    return driver.request(
+        'GET', f'/questions/export?'
+               f'category={generator.randint(1, workload.category_count)}'
+               f'&difficulty={generator.randint(1, 5)}')[0]
+
+
+def get_metrics(driver, workload, state):
+    '''GET /metrics'''
+    return driver.request('GET', '/metrics')[0]
+
+
+def post_question(driver, workload, state):
+    '''POST /questions with a new question'''
+    generator = state['generator']
+    status, response = driver.request('POST', '/questions', {
+        'question': BENCH_QUESTION,
+        'answer': 'Benchmark',
+        'category': generator.randint(1, workload.category_count),
+        'difficulty': generator.randint(1, 5)
+    })
+    if status == 200:
+        workload.created.append(response_json(response)['created'])
+    return status
+
+
+def delete_question(driver, workload, state):
+    '''DELETE /questions/<id> of an inserted question, None if none left'''
+    try:
+        question_id = workload.created.popleft()
+    except IndexError:
+        return None
+    return driver.request('DELETE', f'/questions/{question_id}')[0]
+
+
+def post_questions_bulk(driver, workload, state):
+    '''POST /questions/bulk with bulk_size new questions'''
+    return driver.request('POST', '/questions/bulk', [{
+        'question': BENCH_QUESTION,
+        'answer': 'Benchmark',
+        'category': i % workload.category_count + 1,
+        'difficulty': i % 5 + 1
+    } for i in range(workload.bulk_size)])[0]
+
+
+SCENARIOS = collections.OrderedDict([
+    ('categories', get_categories),
+    ('first_page', get_first_page),
+    ('deep_page', get_deep_page),
+    ('after_cursor', get_after_cursor),
+    ('category_page', get_category_page),
+    ('search', post_search),
+    ('suggest', get_suggestions),
+    ('quiz_turn', post_quiz_turn),
+    ('quiz_prefetch', post_quiz_prefetch),
+    ('export', get_export),
+    ('metrics', get_metrics),
+    ('insert', post_question),
+    ('delete', delete_question),
+    ('bulk', post_questions_bulk)
+])
+
+
+def percentile(latencies, share):
+    '''Return nearest rank percentile of sorted latencies'''
+    if len(latencies) == 0:
+        return None
+    return latencies[max(0, math.ceil(share * len(latencies)) - 1)]
+
+
+def run_scenario(scenario, make_driver, workload, clients, requests):
+    '''Return throughput and latency of requests to scenario by clients'''
+    counter = itertools.count()
+
+    def work(client):
+        driver = make_driver()
+        state = {'generator': random.Random(client),
+                 'previous_questions': []}
+        latencies = []
+        errors = 0
+        while next(counter) < requests:
+            start = time.perf_counter()
+            status = scenario(driver, workload, state)
+            if status is None:
+                break
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors += 1
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(work, range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(itertools.chain.from_iterable(
+        latencies for latencies, errors in results))
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors for latencies, errors in results),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        **{f'p{int(share * 100)}_ms':
+           None if percentile(latencies, share) is None
+           else round(percentile(latencies, share) * 1000, 2)
+           for share in [0.5, 0.95, 0.99]}
+    }
+
+
+class WSGIServer:
+    '''Threaded local WSGI server of a sync app'''
+
+    def __init__(self, app):
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('localhost', 0, app, threaded=True)
+        self.port = self.server.port
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class ASGIServer:
+    '''Local uvicorn server of an async app'''
+
+    def __init__(self, app):
+        if uvicorn is None:
+            sys.exit('Serving the async app needs uvicorn installed')
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        self.port = listener.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, log_level='warning', access_log=False, lifespan='on'))
+        self.thread = threading.Thread(
+            target=self.server.run, kwargs={'sockets': [listener]},
+            daemon=True)
+        self.thread.start()
+        while not self.server.started and self.thread.is_alive():
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def serve(app, async_app, server):
+    '''
+    Return function making drivers of requests to app, through its test
+    client or a local server, and the server or None
+    An async app is given as the AsyncAppRunner serving its test clients
+    '''
+    if not server:
+        return lambda: TestClientDriver(app), None
+    server = ASGIServer(app.app) if async_app else WSGIServer(app)
+    return lambda: ServerDriver(server.port), server
+
+
+def delete_bench_questions(app):
+    '''Delete the questions inserted by the scenarios'''
+    with app.app_context():
+        Question.query.filter(Question.question == BENCH_QUESTION) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        reconcile_question_counts()
+
+
+def current_commit():
+    '''Return abbreviated hash of the checked out commit, None if unknown'''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            check=True, text=True,
+            cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=SQLITE_PATH)
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=len(CATEGORIES))
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed requests per scenario first')
+    parser.add_argument('--quiz-length', type=int, default=20)
+    parser.add_argument('--bulk-size', type=int, default=100)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument('--server', action='store_true',
+                        help='serve over HTTP instead of the test client')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='keep the questions already in the database')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='queue inserts for batched background writes')
+    parser.add_argument('--async-app', action='store_true',
+                        help='request the async app over ASGI')
+    parser.add_argument('--output', help='write JSON here, not to stdout')
+    args = parser.parse_args()
+    if args.async_app and args.write_behind:
+        parser.error('the async app has no write-behind queue')
+
+    app = create_app({'DATABASE_URL': args.database, 'CREATE_SCHEMA': True,
+                      'WRITE_BEHIND': args.write_behind})
+    with app.app_context():
+        if not args.no_seed:
+            seed(args.questions, args.categories)
+        # Seeding bypasses the data versions, so drop the stale index
+        app.extensions['trivia_indexes'].clear()
+    workload = Workload(args.questions, args.categories, args.quiz_length,
+                        args.bulk_size)
+    served_app = app
+    if args.async_app:
+        served_app = AsyncAppRunner(
+            create_async_app({'DATABASE_URL': args.database}))
+    make_driver, server = serve(served_app, args.async_app, args.server)
+
+    results = collections.OrderedDict()
+    try:
+        for name in args.scenarios:
+            scenario = SCENARIOS[name]
+            if args.warmup > 0:
+                run_scenario(scenario, make_driver, workload, 1, args.warmup)
+            results[name] = run_scenario(scenario, make_driver, workload,
+                                         args.clients, args.requests)
+            print(f'{name:<14} {results[name]}', file=sys.stderr)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if args.async_app:
+            served_app.close()
+        if args.write_behind:
+            app.extensions['trivia_write_behind'].close()
+        delete_bench_questions(app)
+
+    report = json.dumps({
+        'commit': current_commit(),
+        'database': db.get_engine(app).dialect.name,
+        'driver': 'server' if args.server else 'test_client',
+        'app': 'asgi' if args.async_app else 'wsgi',
+        'write_behind': args.write_behind,
+        'questions': args.questions,
+        'categories': args.categories,
+        'clients': args.clients,
+        'requests': args.requests,
+        'scenarios': results
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
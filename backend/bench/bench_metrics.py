@@ -0,0 +1,59 @@
+'''
+Benchmark overhead of request metrics
+
+Makes the same requests through the test client of an app with METRICS
+off, with METRICS on, and with SERVER_TIMING on too, and reports
+microseconds per request for each route. Seeds the given database with
+synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_metrics.py --questions 10000
+'''
+
+import argparse
+import time
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app
+from models import setup_db
+
+ROUTES = ['/categories', '/questions', '/categories/1/questions?page=5']
+CONFIGS = [
+    ('off', {'METRICS': False}),
+    ('metrics', {}),
+    ('server_timing', {'SERVER_TIMING': True})
+]
+
+
+def time_per_request(client, route, repeat):
+    '''Return mean microseconds per GET request of route'''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.get(route).close()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    apps = []
+    for name, config in CONFIGS:
+        app = create_app(config)
+        setup_db(app, args.database)
+        apps.append((name, app))
+    with apps[0][1].app_context():
+        seed(args.questions)
+    for route in ROUTES:
+        for name, app in apps:
+            client = app.test_client()
+            time_per_request(client, route, args.repeat // 10)
+            micros = time_per_request(client, route, args.repeat)
+            print(f'{route:<32} {name:<14} {micros:.1f}us/request')
+
+
+if __name__ == '__main__':
+    main()
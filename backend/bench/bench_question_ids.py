@@ -0,0 +1,80 @@
+'''
+Benchmark memory and speed of the question ID index
+
+Builds the index POST /quizzes picks questions from and reports the bytes
+held by its arrays, the peak traced while building it, and what a Python
+set or list of the same IDs would hold instead. Then times quiz turns.
+Seeds the given database with synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_question_ids.py --questions 1000000
+'''
+
+import argparse
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app, random_questions
+from flaskr.question_ids import QuestionIds, question_ids
+from models import setup_db, db
+
+
+def megabytes(size):
+    '''Return size in bytes formatted as megabytes'''
+    return f'{size / 1024 ** 2:.1f}MB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, nargs='+',
+                        default=[10000, 1000000])
+    parser.add_argument('--history', type=int, default=100)
+    parser.add_argument('--turns', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+    with app.app_context():
+        for question_count in args.questions:
+            seed(question_count)
+            url = str(db.engine.url)
+            start = time.perf_counter()
+            QuestionIds.build(url, 0)
+            build = time.perf_counter() - start
+            tracemalloc.start()
+            index = QuestionIds.build(url, 0)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # Every question is in one of the buckets of category 0
+            ids = sorted(itertools.chain.from_iterable(
+                ids for (category_id, difficulty), ids
+                in index.buckets.items() if category_id == 0))
+            id_set = set(ids)
+            set_size = sys.getsizeof(id_set) + sum(map(sys.getsizeof, id_set))
+            list_size = sys.getsizeof(ids) + sum(map(sys.getsizeof, ids))
+            print(f'questions={question_count} '
+                  f'index={megabytes(index.nbytes)} '
+                  f'build_peak={megabytes(peak)} build={build:.2f}s '
+                  f'set_of_all_ids={megabytes(set_size)} '
+                  f'list_of_all_ids={megabytes(list_size)}')
+
+            app.extensions['trivia_indexes'].clear()
+            question_ids()
+            for category_id in [0, 1]:
+                previous_questions = random.sample(ids, args.history)
+                start = time.perf_counter()
+                for _ in range(args.turns):
+                    random_questions(category_id, previous_questions)
+                    db.session.expunge_all()
+                turn = (time.perf_counter() - start) / args.turns
+                print(f'questions={question_count} category={category_id} '
+                      f'history={args.history} turn={turn * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Benchmark 10 question quizzes with and without prefetch
+
+Serves the app over HTTP in a background thread and plays quizzes from
+concurrent clients, either one POST /quizzes per question or one POST
+/quizzes with count for the whole quiz, and reports quizzes and requests
+per second. Seeds the given database with synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_quiz_prefetch.py --questions 100000 --clients 8
+'''
+
+import argparse
+import http.client
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app
+from models import setup_db
+
+
+def post_quiz(port, body):
+    '''Return response body of POST /quizzes'''
+    connection = http.client.HTTPConnection('localhost', port)
+    try:
+        connection.request('POST', '/quizzes', json.dumps(body),
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def play_one_by_one(port, category_id, quiz_length):
+    '''Play a quiz one request per question, return request count'''
+    previous_questions = []
+    for _ in range(quiz_length):
+        question = post_quiz(port, {
+            'previous_questions': previous_questions,
+            'quiz_category': {'id': category_id}
+        })['question']
+        if question is None:
+            break
+        previous_questions.append(question['id'])
+    return quiz_length
+
+
+def play_prefetched(port, category_id, quiz_length):
+    '''Play a quiz with one request for every question, return 1'''
+    post_quiz(port, {
+        'previous_questions': [],
+        'quiz_category': {'id': category_id},
+        'count': quiz_length
+    })
+    return 1
+
+
+def time_quizzes(play, port, clients, quizzes, quiz_length):
+    '''Return quizzes and requests per second'''
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        requests = sum(executor.map(
+            lambda quiz: play(port, quiz % 7, quiz_length), range(quizzes)))
+    elapsed = time.perf_counter() - start
+    return quizzes / elapsed, requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--quizzes', type=int, default=200)
+    parser.add_argument('--quiz-length', type=int, default=10)
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+    with app.app_context():
+        seed(args.questions)
+        # Seeding bypasses the data versions, so drop the stale index
+        app.extensions['trivia_indexes'].clear()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('localhost', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for clients in args.clients:
+            for name, play in [('one_by_one', play_one_by_one),
+                               ('prefetch', play_prefetched)]:
+                quizzes_per_second, requests_per_second = time_quizzes(
+                    play, server.port, clients, args.quizzes,
+                    args.quiz_length)
+                print(f'clients={clients} {name:<10} '
+                      f'quizzes/s={quizzes_per_second:.1f} '
+                      f'requests/s={requests_per_second:.1f}')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
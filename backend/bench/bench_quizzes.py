@@ -0,0 +1,90 @@
+'''
+Benchmark random question selection for POST /quizzes
+
+Compares the previous approach of loading every question and filtering
+previous questions in Python against random_questions, which picks IDs
+from the in-process question ID index. Seeds the given database with
+synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_quizzes.py --questions 10000 1000000
+'''
+
+import argparse
+import random
+import time
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app, random_questions
+from models import setup_db, db, Question
+
+
+def legacy_question(category_id, previous_questions):
+    '''Return random question the way POST /quizzes used to'''
+    if category_id == 0:
+        questions = Question.query.all()
+    else:
+        questions = Question.query.filter(
+            Question.category == category_id).all()
+    remaining_questions = [question for question in questions
+                           if question.id not in previous_questions]
+    if len(remaining_questions) > 0:
+        return random.choice(remaining_questions)
+    return None
+
+
+def current_question(category_id, previous_questions):
+    '''Return random question the way POST /quizzes does now'''
+    questions = random_questions(category_id, previous_questions)
+    return questions[0] if questions else None
+
+
+def time_turns(select, category_id, history, turns):
+    '''Return mean seconds per quiz turn'''
+    high_id = db.session.query(db.func.max(Question.id)).scalar()
+    previous_questions = random.sample(range(1, high_id + 1), history)
+    start = time.perf_counter()
+    for _ in range(turns):
+        select(category_id, previous_questions)
+        db.session.expunge_all()
+    return (time.perf_counter() - start) / turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, nargs='+',
+                        default=[10000, 1000000])
+    parser.add_argument('--history', type=int, nargs='+',
+                        default=[0, 10, 100])
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--legacy-limit', type=int, default=1000000,
+                        help='skip legacy timing above this many questions')
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+    with app.app_context():
+        for question_count in args.questions:
+            seed(question_count)
+            # Seeding bypasses the data versions, so drop the stale index
+            app.extensions['trivia_indexes'].clear()
+            for category_id in [0, 1]:
+                for history in args.history:
+                    current = time_turns(current_question, category_id,
+                                         history, args.turns)
+                    legacy = None
+                    if question_count <= args.legacy_limit:
+                        legacy = time_turns(legacy_question, category_id,
+                                            history, max(1, args.turns // 10))
+                    print(
+                        f'questions={question_count} category={category_id} '
+                        f'history={history} '
+                        f'current={current * 1000:.2f}ms ' +
+                        (f'legacy={legacy * 1000:.2f}ms' if legacy else
+                         'legacy=skipped')
+                    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Benchmark query plans before and after upgrade_schema
+
+Seeds the given database with synthetic questions, takes the questions
+table back to a deployment restored from trivia.psql (integer category, no
+indexes) or made by an older create_all (text category), then prints the
+plan and execution time of the category listing and quiz lookup queries
+before and after running the upgrade.
+
+    createdb trivia_bench
+    python bench/bench_schema.py --questions 1000000 --legacy-column text
+'''
+
+import argparse
+import time
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app
+from models import setup_db, upgrade_schema, db
+
+QUERIES = {
+    'category page 100': '''
+        SELECT id, question, answer, category, difficulty FROM questions
+        WHERE category = '1' ORDER BY id LIMIT 10 OFFSET 990''',
+    'category page 5000': '''
+        SELECT id, question, answer, category, difficulty FROM questions
+        WHERE category = '1' ORDER BY id LIMIT 10 OFFSET 49990''',
+    'category count': '''
+        SELECT count(id) FROM questions WHERE category = '1' ''',
+    'quiz id range': '''
+        SELECT min(id), max(id) FROM questions
+        WHERE category = '1' AND id NOT IN (1, 7, 13)''',
+    'quiz id probe': '''
+        SELECT id, question, answer, category, difficulty FROM questions
+        WHERE category = '1' AND id NOT IN (1, 7, 13)
+        AND id IN (5, 11, 17, 23, 29, 35, 41, 47)''',
+    'difficulty export': '''
+        SELECT id, question, answer, category, difficulty FROM questions
+        WHERE difficulty = 3 ORDER BY id LIMIT 1000'''
+}
+
+
+def make_legacy(column_type):
+    '''Drop the indexes and foreign key, optionally make category text'''
+    with db.engine.begin() as connection:
+        connection.execute('''
+            ALTER TABLE questions DROP CONSTRAINT category;
+            DROP INDEX ix_questions_category_id;
+            DROP INDEX ix_questions_difficulty;
+        ''')
+        if column_type == 'text':
+            connection.execute('ALTER TABLE questions ALTER COLUMN category '
+                               'TYPE varchar USING category::varchar')
+        connection.execute('ANALYZE questions')
+
+
+def explain(sql):
+    '''Return plan node names and execution milliseconds of query'''
+    lines = [line for line, in db.session.execute(
+        'EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF) ' + sql)]
+    db.session.commit()
+    nodes = [line.strip().lstrip('-> ') for line in lines
+             if not line.startswith(' ') or '->' in line]
+    nodes = [node for node in nodes if not node.startswith(
+        ('Planning', 'Execution'))]
+    milliseconds = next(float(line.split()[2]) for line in lines
+                        if line.startswith('Execution'))
+    return nodes, milliseconds
+
+
+def report(label):
+    '''Print plan and time of every query'''
+    for name, sql in QUERIES.items():
+        explain(sql)
+        nodes, milliseconds = explain(sql)
+        print(f'{label:<6} {name:<19} {milliseconds:9.2f}ms  '
+              + ' / '.join(nodes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=1000000)
+    parser.add_argument('--legacy-column', default='integer',
+                        choices=['integer', 'text'])
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+    with app.app_context():
+        seed(args.questions)
+        make_legacy(args.legacy_column)
+        report('before')
+        start = time.perf_counter()
+        upgrade_schema(log=lambda message: None)
+        print(f'upgrade_schema took {time.perf_counter() - start:.1f}s')
+        report('after')
+
+
+if __name__ == '__main__':
+    main()
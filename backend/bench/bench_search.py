@@ -0,0 +1,66 @@
+'''
+Benchmark POST /questions search terms
+
+Compares the previous substring ILIKE query against Question.search,
+which uses the full-text index, for one page of results and the total.
+Seeds the given database with synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_search.py --questions 100000 1000000
+'''
+
+import argparse
+import time
+
+from common import DATABASE_PATH, seed, vocabulary
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from models import setup_db, db, Question
+
+
+def legacy_search(search_term):
+    '''Return query for search term the way POST /questions used to'''
+    return Question.query.filter(Question.question.ilike(f'%{search_term}%'))
+
+
+def time_search(search, search_term, repeats):
+    '''Return mean seconds to fetch first page and total for search term'''
+    start = time.perf_counter()
+    for _ in range(repeats):
+        query = search(search_term)
+        query.order_by(Question.id).limit(QUESTIONS_PER_PAGE).all()
+        query.order_by(None).count()
+        db.session.expunge_all()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, nargs='+',
+                        default=[100000, 1000000])
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    words = vocabulary()
+    # Common, mid-frequency and rare words of the seeded text
+    search_terms = [words[0], words[100], words[4000],
+                    f'{words[0]} {words[1]}']
+    app = create_app()
+    setup_db(app, args.database)
+    with app.app_context():
+        for question_count in args.questions:
+            seed(question_count)
+            for search_term in search_terms:
+                current = time_search(Question.search, search_term,
+                                      args.repeats)
+                legacy = time_search(legacy_search, search_term, args.repeats)
+                print(
+                    f'questions={question_count} term={search_term!r} '
+                    f'matches={Question.search(search_term).count()} '
+                    f'current={current * 1000:.2f}ms '
+                    f'legacy={legacy * 1000:.2f}ms'
+                )
+
+
+if __name__ == '__main__':
+    main()
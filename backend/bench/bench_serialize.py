@@ -0,0 +1,105 @@
+'''
+Benchmark loading and serializing question listings per 1k rows
+
+Compares the previous listing path, ORM instances through
+Question.format() and jsonify, against the lean path of column tuples
+through json_response, with the stdlib encoder and with orjson, and with
+the answer left out by a sparse fieldset. Reports milliseconds per 1k
+rows for serializing alone and for loading plus serializing. Seeds the
+given database with synthetic questions first.
+
+    createdb trivia_bench
+    python bench/bench_serialize.py --questions 10000
+'''
+
+import argparse
+import time
+from unittest import mock
+
+from flask import jsonify
+
+from common import DATABASE_PATH, seed
+from flaskr import create_app, json_response, QUESTION_FIELDS
+from models import setup_db, db, Question
+
+ROWS = 1000
+
+
+def orm_load():
+    '''Return page of ORM instances'''
+    return Question.query.order_by(Question.id).limit(ROWS).all()
+
+
+def orm_serialize(questions):
+    '''Return response body the way listings used to'''
+    return jsonify({'questions': [question.format()
+                                  for question in questions]}).get_data()
+
+
+def lean_load(fields):
+    '''Return function loading page of column tuples of fields'''
+    def load():
+        return Question.query.with_entities(
+            *[getattr(Question, field) for field in fields]
+        ).order_by(Question.id).limit(ROWS).all()
+    return load
+
+
+def lean_serialize(fields):
+    '''Return function serializing column tuples like listings do now'''
+    def serialize(rows):
+        return json_response({'questions': [dict(zip(fields, row))
+                                            for row in rows]}).get_data()
+    return serialize
+
+
+def time_per_call(function, repeat):
+    '''Return mean milliseconds per call'''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+    without_answer = [field for field in QUESTION_FIELDS if field != 'answer']
+    cases = [
+        ('orm+jsonify', orm_load, orm_serialize, None),
+        ('tuples+stdlib', lean_load(QUESTION_FIELDS),
+         lean_serialize(QUESTION_FIELDS), mock.patch('flaskr.orjson', None)),
+        ('tuples+orjson', lean_load(QUESTION_FIELDS),
+         lean_serialize(QUESTION_FIELDS), None),
+        ('no_answer+orjson', lean_load(without_answer),
+         lean_serialize(without_answer), None)
+    ]
+    with app.app_context():
+        seed(args.questions)
+    with app.test_request_context():
+        for name, load, serialize, patch in cases:
+            if patch is not None:
+                patch.start()
+            rows = load()
+            serialize_ms = time_per_call(lambda: serialize(rows), args.repeat)
+
+            def load_and_serialize():
+                serialize(load())
+                db.session.expunge_all()
+            total_ms = time_per_call(load_and_serialize, args.repeat)
+            if patch is not None:
+                patch.stop()
+            size = len(serialize(rows))
+            print(f'{name:<17} serialize={serialize_ms:.2f}ms '
+                  f'load+serialize={total_ms:.2f}ms bytes={size} '
+                  f'per {ROWS} rows')
+
+
+if __name__ == '__main__':
+    main()
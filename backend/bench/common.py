@@ -0,0 +1,90 @@
+'''
+Shared benchmark helpers for seeding synthetic questions
+'''
+
+import io
+import itertools
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from models import (  # noqa: E402
+    db, create_search_index, fill_question_counts, Category
+)
+
+DATABASE_PATH = 'postgresql://{}/{}'.format('localhost:5432', 'trivia_bench')
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'sa', 'tor', 'vi', 'quo', 'da', 'nel',
+             'pha', 'ri', 'gu', 'bes', 'th', 'on', 'ma', 'zel', 'cu', 'ur']
+
+
+def vocabulary(size=5000, seed=0):
+    '''Return list of distinct made-up words'''
+    generator = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(generator.choice(SYLLABLES)
+                          for _ in range(generator.randint(2, 4))))
+    return sorted(words)
+
+
+def category_names(category_count=len(CATEGORIES)):
+    '''Return names of category_count categories'''
+    return CATEGORIES[:category_count] + [
+        f'Category {i}' for i in range(len(CATEGORIES) + 1,
+                                       category_count + 1)]
+
+
+def question_rows(question_count, seed=0, category_count=len(CATEGORIES)):
+    '''Yield (question, answer, category, difficulty) rows of made-up text'''
+    generator = random.Random(seed)
+    words = vocabulary(seed=seed)
+    # Lower ranked words are much more common, like natural text
+    weights = list(itertools.accumulate(
+        1 / rank for rank in range(1, len(words) + 1)))
+    for i in range(question_count):
+        text = generator.choices(words, cum_weights=weights,
+                                 k=generator.randint(6, 12))
+        answer = generator.choices(words, cum_weights=weights,
+                                   k=generator.randint(1, 3))
+        yield (' '.join(text).capitalize() + '?',
+               ' '.join(answer).capitalize(),
+               i % category_count + 1, i % 5 + 1)
+
+
+def seed(question_count, category_count=len(CATEGORIES)):
+    '''Replace questions and categories with synthetic rows'''
+    db.session.remove()
+    db.drop_all()
+    if db.engine.dialect.name == 'sqlite':
+        # The search table is not in the metadata, and would keep the rows
+        # of the dropped questions
+        with db.engine.begin() as connection:
+            connection.execute('DROP TABLE IF EXISTS questions_search')
+    db.create_all()
+    db.session.execute(Category.__table__.insert(), [
+        {'type': category} for category in category_names(category_count)])
+    db.session.commit()
+    create_search_index()
+    rows = question_rows(question_count, category_count=category_count)
+    connection = db.engine.raw_connection()
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            buffer = io.StringIO(''.join(
+                '\t'.join(map(str, row)) + '\n' for row in rows))
+            connection.cursor().copy_from(
+                buffer, 'questions',
+                columns=('question', 'answer', 'category', 'difficulty'))
+        else:
+            connection.cursor().executemany(
+                'INSERT INTO questions (question, answer, category, '
+                'difficulty) VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+    finally:
+        connection.close()
+    fill_question_counts()
+    db.session.execute('ANALYZE')
+    db.session.commit()
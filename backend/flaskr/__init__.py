@@ -3,89 +3,343 @@ App module
 '''
 
 import os
-import random
-from flask import Flask, request, abort, jsonify
+import base64
+import binascii
+import json
+import click
+from flask import Flask, Response, request, abort, jsonify
+from flask import stream_with_context, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func
 
-from models import setup_db, Question, Category
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from models import setup_db, create_schema, upgrade_schema, Question
+from .bulk import (
+    import_questions, parse_ndjson, parse_questions, question_values,
+    delete_filters, delete_questions, export_query, export_questions,
+    NDJSON_MIMETYPES, EXPORT_MIMETYPES
+)
+from .cache import (
+    init_cache, cached_categories, cached_question_counts, conditional,
+    data_etag, QUESTIONS, CATEGORIES
+)
+from .counts import reconcile_question_counts
+from .indexes import init_indexes
+from .metrics import init_metrics, metrics_text, METRICS_MIMETYPE
+from .question_ids import init_question_ids, question_ids, QuestionDraw
+from .quiz_sessions import open_session, starts_session
+from .replicas import (
+    init_replicas, read_from_replica, read_only, on_replica
+)
+from .search_cache import init_search_cache, search_cache, search_key
+from .selection import target_difficulty, STRATEGIES, UNIFORM, ADAPTIVE
+from .suggest import suggest_questions, SUGGEST_LIMIT, MAX_SUGGEST_LIMIT
+from .write_behind import init_write_behind, write_behind
 
 QUESTIONS_PER_PAGE = 10
+QUESTION_FIELDS = ['id', 'question', 'answer', 'category', 'difficulty']
+MAX_QUIZ_COUNT = 50
+
+
+def encode_cursor(question_id):
+    '''Return opaque cursor token for question ID'''
+    return base64.urlsafe_b64encode(str(question_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Return question ID for cursor token, 0 for blank token'''
+    if cursor == '':
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        abort(422)
+
+
+def json_body(payload):
+    '''Return payload encoded as JSON bytes, by orjson when installed'''
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def json_response(payload):
+    '''Return JSON response of payload'''
+    return Response(json_body(payload), mimetype='application/json')
+
+
+def allow_header(error):
+    '''Return list of the Allow header of MethodNotAllowed error'''
+    return [header for header in error.get_headers()
+            if header[0] == 'Allow']
+
+
+def question_fields(fields):
+    '''
+    Return question fields named in comma separated fields, all if None
+    The ID is always included, raise ValueError for unknown names
+    '''
+    if fields is None:
+        return QUESTION_FIELDS
+    names = {name.strip() for name in fields.split(',')} - {''}
+    if not names <= set(QUESTION_FIELDS):
+        raise ValueError('unknown question fields')
+    return [field for field in QUESTION_FIELDS
+            if field == 'id' or field in names]
 
 
-def paginate_questions(questions):
-    '''Return list of question objects as paginated list of dicts'''
+def requested_fields():
+    '''Return question fields named by the fields parameter, all by default'''
+    try:
+        return question_fields(request.args.get('fields'))
+    except ValueError:
+        abort(422)
+
+
+def question_rows(query, fields):
+    '''
+    Return query of tuples of question fields, starting with the ID
+    Loads only those columns and no ORM instances
+    '''
+    return query.with_entities(*[getattr(Question, field) for field in fields])
+
+
+def paginate_questions(query, total_questions=None):
+    '''
+    Return page of question query as dict of response fields
+    Uses keyset pagination on question ID when after cursor is given,
+    otherwise LIMIT/OFFSET page with total count, counted unless given
+    Questions hold the fields requested by the fields parameter
+    '''
+    fields = requested_fields()
+    after = request.args.get('after')
+    if after is not None:
+        return paginate_questions_after(query, decode_cursor(after), fields)
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    page_questions = [question.format() for question in questions[start:end]]
-    return page_questions
+    page_questions = []
+    if page > 0:
+        rows = question_rows(query, fields).order_by(Question.id).limit(
+            QUESTIONS_PER_PAGE).offset((page - 1) * QUESTIONS_PER_PAGE)
+        page_questions = [dict(zip(fields, row)) for row in rows]
+    if total_questions is None:
+        total_questions = page_total(page, page_questions)
+    if total_questions is None:
+        total_questions = query.order_by(None).count()
+    return {
+        'questions': page_questions,
+        'total_questions': total_questions
+    }
+
+
+def page_total(page, page_questions):
+    '''
+    Return total number of questions known from a page of them, None if
+    they must be counted
+    '''
+    if page == 1 and len(page_questions) < QUESTIONS_PER_PAGE:
+        # First page is not full so it holds every question
+        return len(page_questions)
+    return None
+
+
+def paginate_questions_after(query, question_id, fields):
+    '''
+    Return page of question query after question ID as dict of response fields
+    One extra row is fetched to tell if a next page exists
+    '''
+    query = query.order_by(None).filter(Question.id > question_id)
+    return page_after(question_rows(query, fields).order_by(
+        Question.id).limit(QUESTIONS_PER_PAGE + 1).all(), fields)
+
+
+def page_after(rows, fields):
+    '''
+    Return dict of response fields of a page after a cursor from up to one
+    more rows of fields than a page holds
+    '''
+    next_cursor = None
+    if len(rows) > QUESTIONS_PER_PAGE:
+        rows = rows[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(rows[-1][0])
+    return {
+        'questions': [dict(zip(fields, row)) for row in rows],
+        'next_cursor': next_cursor
+    }
+
+
+def random_questions(category_id, previous_questions, count=1,
+                     strategy=UNIFORM, target=None):
+    '''
+    Return up to count random questions of category not in previous questions
+    Picks unseen IDs from the question ID index by selection strategy and
+    loads them in one query
+    '''
+    draw = QuestionDraw(question_ids(), category_id, previous_questions,
+                        count, strategy, target)
+    for picked in draw.picks():
+        # A replica might only lag behind the index, so IDs it misses are
+        # kept
+        draw.add({question.id: (question.category, question)
+                  for question in Question.query.filter(
+                      Question.id.in_(picked))}, prune=not on_replica())
+    return draw.questions
 
 
-def categories_as_dict(categories):
-    '''Return categories object as dict'''
-    as_dict = {}
-    for category in categories:
-        as_dict[category.id] = category.type
-    return as_dict
+def is_count(value):
+    '''Return True if value is a non-negative integer and not a boolean'''
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        value >= 0
+
+
+def quiz_request(body):
+    '''
+    Return quiz session, integer previous questions, count, category ID,
+    strategy and target difficulty of quizzes request body
+    Aborts when the body is not valid
+    '''
+    if not isinstance(body, dict):
+        abort(400)
+    quiz_session = body.get('quiz_session')
+    previous_questions = body.get('previous_questions')
+    if quiz_session is None and not isinstance(previous_questions, list):
+        abort(422)
+    count = body.get('count')
+    if count is not None and (
+            quiz_session is not None or not is_count(count) or
+            count not in range(1, MAX_QUIZ_COUNT + 1)):
+        abort(422)
+    try:
+        category_id = int(body.get('quiz_category').get('id'))
+    except (AttributeError, TypeError, ValueError):
+        abort(422)
+    strategy = body.get('strategy', UNIFORM)
+    answers = [body.get(name, 0) for name in ['correct', 'incorrect']]
+    if strategy not in STRATEGIES or \
+            (strategy != UNIFORM and quiz_session is not None) or \
+            any(not is_count(answer) for answer in answers):
+        abort(422)
+    target = target_difficulty(*answers) if strategy == ADAPTIVE else None
+    if isinstance(previous_questions, list):
+        previous_questions = [question_id for question_id in previous_questions
+                              if isinstance(question_id, int)]
+    return (quiz_session, previous_questions, count, category_id, strategy,
+            target)
+
+
+def load_quiz_session(quiz_session):
+    '''
+    Return quiz session started by integer seed or blank for random seed,
+    or continued by session token
+    '''
+    max_question_id = None
+    if starts_session(quiz_session):
+        max_question_id = Question.query.with_entities(
+            func.max(Question.id)).scalar()
+    try:
+        return open_session(quiz_session, max_question_id)
+    except ValueError:
+        abort(422)
 
 
 def create_app(test_config=None):
     '''Create and configure the app'''
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    init_replicas(app)
+    if app.config.get('METRICS', True):
+        init_metrics(app)
+    init_cache(app)
+    init_search_cache(app)
+    init_indexes(app)
+    init_question_ids(app)
+    init_write_behind(app)
     CORS(app, resources={'/': {'origins': '*'}})
 
     @app.after_request
     def after_request(response):
         '''Set Access-Control-Allow'''
         response.headers.add(
-            'Access-Control-Allow-Headers', 'Content-Type,Authorization,true'
+            'Access-Control-Allow-Headers',
+            'Content-Type,Authorization,If-None-Match,If-Modified-Since,true'
         )
         response.headers.add(
             'Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'
         )
+        response.headers.add(
+            'Access-Control-Expose-Headers', 'ETag,Last-Modified'
+        )
         return response
 
+    if app.config.get('METRICS', True):
+        @app.route('/metrics')
+        def get_metrics():
+            '''Handle GET requests for metrics'''
+            return Response(metrics_text(app),
+                            content_type=METRICS_MIMETYPE)
+
     @app.route('/categories')
+    @read_only
+    @conditional(CATEGORIES)
     def get_categories():
         '''Handle GET requests for categories'''
-        categories = Category.query.all()
+        categories = cached_categories()
         if len(categories) == 0:
             abort(404)
         return jsonify({
             'success': True,
-            'categories': categories_as_dict(categories)
+            'categories': categories
         })
 
     @app.route('/categories/<int:category_id>/questions')
+    @read_only
+    @conditional(QUESTIONS)
     def get_questions_by_category(category_id):
         '''Handle GET requests for questions by category ID'''
-        questions = Question.query.filter(
-            Question.category == category_id).all()
-        page_questions = paginate_questions(questions)
-        if len(page_questions) == 0:
+        page = paginate_questions(
+            Question.query.filter(Question.category == category_id),
+            cached_question_counts().get(category_id, 0))
+        if len(page['questions']) == 0:
             abort(404)
-        return jsonify({
+        return json_response({
             'success': True,
             'current_category': category_id,
-            'questions': page_questions,
-            'total_questions': len(questions)
+            **page
         })
 
     @app.route('/questions')
+    @read_only
+    @conditional(QUESTIONS, CATEGORIES)
     def get_questions():
         '''Handle GET requests for questions'''
-        questions = Question.query.all()
-        page_questions = paginate_questions(questions)
-        if len(page_questions) == 0:
+        page = paginate_questions(
+            Question.query, cached_question_counts()[0])
+        if len(page['questions']) == 0:
             abort(404)
-        categories = Category.query.all()
+        return json_response({
+            'success': True,
+            'categories': cached_categories(),
+            **page
+        })
+
+    @app.route('/questions/suggest')
+    @read_only
+    @conditional(QUESTIONS)
+    def get_question_suggestions():
+        '''Handle GET requests for question text suggestions by prefix'''
+        prefix = request.args.get('prefix')
+        limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+        if prefix is None or limit not in range(1, MAX_SUGGEST_LIMIT + 1):
+            abort(422)
         return jsonify({
             'success': True,
-            'categories': categories_as_dict(categories),
-            'questions': page_questions,
-            'total_questions': len(questions)
+            'suggestions': suggest_questions(prefix, limit)
         })
 
     @app.route('/questions', methods=['POST'])
@@ -102,36 +356,184 @@ def create_app(test_config=None):
             search_term = body.get('searchTerm')
             if not isinstance(search_term, str):
                 abort(422)
-            questions = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
-            page_questions = paginate_questions(questions)
+            cache = search_cache()
+            if cache is None:
+                read_from_replica()
+                return json_response({
+                    'success': True,
+                    **paginate_questions(Question.search(search_term))
+                })
+            # Results are cached from the primary, like other versioned data
+            key = search_key(search_term, request.args.get('page'),
+                             request.args.get('after'), requested_fields())
+            version = data_etag([QUESTIONS])
+            results = cache.get(key, version)
+            if results is None:
+                results = json_body({
+                    'success': True,
+                    **paginate_questions(Question.search(search_term))
+                })
+                cache.put(key, version, results)
+            return Response(results, mimetype='application/json')
+        try:
+            values = question_values(body, cached_categories())
+        except ValueError:
+            abort(422)
+        queue = write_behind()
+        if queue is not None:
+            # Inserted later in a batch, so return where to find it
+            try:
+                token = queue.put(values)
+            except RuntimeError:
+                abort(503)
+            status_url = url_for('get_pending_question', token=token)
             return jsonify({
                 'success': True,
-                'questions': page_questions,
-                'total_questions': len(questions)
-            })
+                'pending': token,
+                'status_url': status_url
+            }), 202, {'Location': status_url}
+        question = Question(**values)
+        question.insert()
+        return jsonify({
+            'success': True,
+            'created': question.id,
+        })
+
+    @app.route('/questions/pending/<token>')
+    def get_pending_question(token):
+        '''Handle GET requests for status of question queued by token'''
+        queue = write_behind()
+        status = None if queue is None else queue.status(token)
+        if status is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'pending': token,
+            **status
+        })
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def post_questions_bulk():
+        '''
+        Handle POST requests for many questions as JSON array or NDJSON
+        Either every question is created or none are
+        '''
+        if request.mimetype in NDJSON_MIMETYPES:
+            rows = parse_ndjson(request.get_data(as_text=True))
+        else:
+            rows = request.get_json()
+            if not isinstance(rows, list):
+                abort(400)
+        result = import_questions(rows, set(cached_categories()))
+        if len(result['errors']) > 0:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Unprocessable Entity',
+                'errors': result['errors']
+            }), 422
+        return jsonify({
+            'success': True,
+            'created': result['created'],
+            'rows_per_second': result['rows_per_second']
+        })
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.File())
+    def import_questions_command(path):
+        '''Import questions from JSON array or NDJSON file'''
         try:
-            question = Question(
-                question=body.get('question'),
-                answer=body.get('answer'),
-                difficulty=int(body.get('difficulty')),
-                category=int(body.get('category'))
-            )
-        except (TypeError, ValueError):
+            rows = parse_questions(path.read())
+        except ValueError as error:
+            raise click.ClickException(f'Questions not valid JSON: {error}')
+        result = import_questions(rows, set(cached_categories()))
+        for error in result['errors']:
+            click.echo(f"Row {error['row']}: {error['message']}", err=True)
+        if len(result['errors']) > 0:
+            raise click.ClickException(
+                f"{len(result['errors'])} rows not valid, nothing imported")
+        click.echo(f"Imported {result['created']} questions "
+                   f"({result['rows_per_second']} rows/s)")
+
+    @app.route('/questions/export')
+    @read_only
+    def get_questions_export():
+        '''
+        Handle GET requests for all questions streamed as NDJSON or CSV
+        Optionally filtered by category and difficulty
+        '''
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_MIMETYPES:
             abort(422)
-        if (
-            not isinstance(question.question, str) or
-            question.question in ['', None] or
-            not isinstance(question.answer, str) or
-            question.answer in ['', None] or
-            question.difficulty not in range(1, 6) or
-            Category.query.get(question.category) is None
-        ):
+        try:
+            filters = {name: int(request.args[name])
+                       for name in ['category', 'difficulty']
+                       if name in request.args}
+        except ValueError:
             abort(422)
-        question.insert()
+        rows = export_questions(export_query(
+            filters.get('category'), filters.get('difficulty')),
+            export_format)
+        return Response(stream_with_context(rows),
+                        mimetype=EXPORT_MIMETYPES[export_format])
+
+    @app.cli.command('export-questions')
+    @click.option('--format', 'export_format', default='ndjson',
+                  type=click.Choice(list(EXPORT_MIMETYPES)))
+    @click.option('--category', 'category_id', type=int)
+    @click.option('--difficulty', type=int)
+    @click.argument('path', type=click.File('w'), default='-')
+    def export_questions_command(export_format, category_id, difficulty,
+                                 path):
+        '''Export questions as NDJSON or CSV to file or standard output'''
+        for chunk in export_questions(
+                export_query(category_id, difficulty), export_format):
+            path.write(chunk)
+
+    @app.cli.command('create-schema')
+    def create_schema_command():
+        '''Create missing tables and the search indexes'''
+        create_schema()
+        click.echo('Schema created')
+
+    @app.cli.command('reconcile-counts')
+    def reconcile_counts_command():
+        '''Count questions again and fix drifted question counts'''
+        drift = reconcile_question_counts()
+        for category_id, (stored, counted) in drift.items():
+            click.echo(f'Category {category_id}: {stored} -> {counted}')
+        click.echo(f'Fixed {len(drift)} question counts')
+
+    @app.cli.command('upgrade-schema')
+    @click.option('--batch-size', default=10000, type=click.IntRange(1))
+    @click.option('--null-invalid', is_flag=True,
+                  help='Set categories that are not valid to NULL')
+    def upgrade_schema_command(batch_size, null_invalid):
+        '''Upgrade questions table to the current schema while it is in use'''
+        try:
+            upgrade_schema(batch_size, log=click.echo,
+                           null_invalid=null_invalid)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_at_once():
+        '''
+        Handle DELETE requests for questions by ID list, category and
+        difficulty, deleted in one statement
+        '''
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+        try:
+            filters = delete_filters(body)
+        except ValueError:
+            abort(422)
+        deleted = delete_questions(**filters)
         return jsonify({
             'success': True,
-            'created': question.id,
+            'deleted': deleted,
+            'total_deleted': len(deleted)
         })
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
@@ -147,33 +549,38 @@ def create_app(test_config=None):
         })
 
     @app.route('/quizzes', methods=['POST'])
+    @read_only
     def get_quizzes():
         '''Handle POST requests for quizzes'''
-        body = request.get_json()
-        if not isinstance(body, dict):
-            abort(400)
-        previous_questions = body.get('previous_questions')
-        if not isinstance(previous_questions, list):
-            abort(422)
-        try:
-            category_id = int(body.get('quiz_category').get('id'))
-        except (TypeError, ValueError):
-            abort(422)
+        quiz_session, previous_questions, count, category_id, strategy, \
+            target = quiz_request(request.get_json())
         if category_id == 0:
-            questions = Question.query.all()
-        elif Category.query.get(category_id) is not None:
+            questions = Question.query
+        elif category_id in cached_categories():
             questions = Question.query.filter(
-                Question.category == category_id).all()
+                Question.category == category_id)
         else:
             abort(422)
-        remaining_questions = [question for question in questions
-                               if question.id not in previous_questions]
-        random_question = None
-        if len(remaining_questions) > 0:
-            random_question = random.choice(remaining_questions).format()
+        if quiz_session is not None:
+            session = load_quiz_session(quiz_session)
+            question = session.next_question(
+                questions, cached_question_counts().get(category_id, 0))
+            return jsonify({
+                'success': True,
+                'question': question.format() if question else None,
+                'quiz_session': session.encode()
+            })
+        unseen = random_questions(category_id, previous_questions,
+                                  1 if count is None else count, strategy,
+                                  target)
+        if count is not None:
+            return jsonify({
+                'success': True,
+                'questions': [question.format() for question in unseen]
+            })
         return jsonify({
             'success': True,
-            'question': random_question
+            'question': unseen[0].format() if unseen else None
         })
 
     @app.errorhandler(400)
@@ -192,6 +599,14 @@ def create_app(test_config=None):
             'message': 'Not Found'
         }), 404
 
+    @app.errorhandler(405)
+    def method_not_allowed(error):
+        return jsonify({
+            'success': False,
+            'error': 405,
+            'message': 'Method Not Allowed'
+        }), 405, allow_header(error)
+
     @app.errorhandler(422)
     def unprocessable_entity(error):
         return jsonify({
@@ -200,6 +615,14 @@ def create_app(test_config=None):
             'message': 'Unprocessable Entity'
         }), 422
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'Service Unavailable'
+        }), 503
+
     @app.errorhandler(500)
     def internal_server(error):
         return jsonify({
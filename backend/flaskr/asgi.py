@@ -0,0 +1,1449 @@
+'''
+ASGI module
+
+Alternative app serving the routes and JSON contracts of create_app over
+ASGI, for many more concurrent requests per process. Requests run as
+coroutines on one event loop and wait on the database without holding a
+thread: asyncpg on PostgreSQL and aiosqlite on SQLite, each with a pool
+of its own sized by the DB_POOL_SIZE, DB_MAX_OVERFLOW and DB_POOL_TIMEOUT
+settings of the sync app.
+
+    pip install -r requirements-optional.txt
+    uvicorn --factory flaskr.asgi:create_async_app
+
+Only the I/O is written here: statements with ? placeholders, numbered
+for asyncpg, and the drivers of the pagination, quiz session, question
+draw and index logic shared with the sync app. Question counts, the
+question ID index of quizzes and the n-gram index of suggestions follow
+the writes of this app as they follow those of the sync app, and with
+DATA_VERSION_TABLE set its writes bump the shared data versions, so both
+apps can serve one database side by side.
+
+Read endpoints answer conditional requests with the ETags of the sync app,
+which match across both apps with DATA_VERSION_TABLE set. The search cache,
+replica reads, the CLI commands and schema creation are left to the sync
+app, and without them the same requests get the same responses. So is the
+write-behind queue, which would answer inserts 202 rather than 201, so the
+async app refuses to start with WRITE_BEHIND set.
+'''
+
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import re
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, abort
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+from models import setting, default_database_path, PoolWaits
+from . import (
+    allow_header, decode_cursor, json_body, page_after, page_total,
+    question_fields, quiz_request, QUESTIONS_PER_PAGE
+)
+from .bulk import (
+    parse_ndjson, question_values, validate_rows, delete_filters,
+    export_questions, NDJSON_MIMETYPES, EXPORT_MIMETYPES, EXPORT_COLUMNS,
+    EXPORT_BATCH_SIZE, IMPORT_CHUNK_SIZE, DELETE_CHUNK_SIZE,
+    QUESTION_COLUMNS
+)
+from .cache import (
+    cache_period, not_modified, settled, version_etag, QUESTIONS,
+    CATEGORIES, CACHE_TTL
+)
+from .counts import count_changes
+from .metrics import (
+    Metrics, RequestCounts, status_text, POOL_METRICS, METRICS_MIMETYPE
+)
+from .indexes import apply_writes, INDEX_REBUILD_INTERVAL
+from .question_ids import (
+    QuestionIds, QuestionDraw, BUILD_BATCH_SIZE, QUESTION_IDS
+)
+from .quiz_sessions import open_session, starts_session
+from .suggest import (
+    NGramIndex, suggestable, word_start_pattern, SUGGEST_LIMIT,
+    MAX_SUGGEST_LIMIT, NGRAMS
+)
+
+# Pool defaults of SQLAlchemy, which the sync app keeps unless configured
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30.0
+CORS_HEADERS = [
+    ('Access-Control-Allow-Headers',
+     'Content-Type,Authorization,If-None-Match,If-Modified-Since,true'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'),
+    ('Access-Control-Expose-Headers', 'ETag,Last-Modified')
+]
+QUESTION_SELECT = ', '.join(f'questions.{column}'
+                            for column in EXPORT_COLUMNS)
+ADD_COUNT = '''
+    INSERT INTO question_counts (category_id, count) VALUES (?, ?)
+    ON CONFLICT (category_id)
+    DO UPDATE SET count = question_counts.count + excluded.count
+'''
+
+# Counters of the request being served, for the statements it runs
+request_counts = contextvars.ContextVar('request_counts', default=None)
+# Data versions and update times read by the request being served
+request_versions = contextvars.ContextVar('request_versions', default=None)
+
+
+@functools.lru_cache(maxsize=256)
+def numbered(statement):
+    '''Return statement with ? placeholders numbered $1, $2... for asyncpg'''
+    numbers = itertools.count(1)
+    return re.sub(r'\?', lambda match: f'${next(numbers)}', statement)
+
+
+def record_statement(start, rows):
+    '''Count a statement started at start and its rows for the request'''
+    counts = request_counts.get()
+    if counts is not None:
+        counts.statements += 1
+        counts.rows += rows
+        counts.sql_seconds += time.perf_counter() - start
+
+
+class Connection(ABC):
+    '''
+    Pooled connection running statements with ? placeholders
+    Subclasses run them on their driver
+    '''
+
+    dialect = None
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    async def fetch(self, statement, *args):
+        '''Return list of row tuples of statement'''
+        start = time.perf_counter()
+        rows = await self.fetch_rows(statement, args)
+        record_statement(start, len(rows))
+        return rows
+
+    async def fetchval(self, statement, *args):
+        '''Return first column of first row of statement, None if none'''
+        rows = await self.fetch(statement, *args)
+        return rows[0][0] if len(rows) > 0 else None
+
+    async def execute(self, statement, *args):
+        '''Run statement'''
+        start = time.perf_counter()
+        await self.execute_statement(statement, args)
+        record_statement(start, 0)
+
+    async def executemany(self, statement, rows):
+        '''Run statement for each tuple of args in rows'''
+        start = time.perf_counter()
+        await self.execute_many(statement, rows)
+        record_statement(start, 0)
+
+    async def iterate(self, statement, *args, batch_size=EXPORT_BATCH_SIZE):
+        '''Yield lists of up to batch_size row tuples of statement'''
+        start = time.perf_counter()
+        async for rows in self.iterate_rows(statement, args, batch_size):
+            record_statement(start, len(rows))
+            yield rows
+            start = time.perf_counter()
+
+    @abstractmethod
+    async def fetch_rows(self, statement, args):
+        '''Return list of row tuples of statement with args'''
+
+    @abstractmethod
+    async def execute_statement(self, statement, args):
+        '''Run statement with args'''
+
+    @abstractmethod
+    async def execute_many(self, statement, rows):
+        '''Run statement for each tuple of args in rows'''
+
+    @abstractmethod
+    def iterate_rows(self, statement, args, batch_size):
+        '''Yield lists of up to batch_size row tuples of statement'''
+
+    @abstractmethod
+    def transaction(self):
+        '''Return context manager running its block in one transaction'''
+
+    @abstractmethod
+    async def insert_questions(self, values):
+        '''Insert list of question column values'''
+
+    @abstractmethod
+    async def delete_questions(self, conditions, args, ids=None):
+        '''
+        Delete questions matching every condition with args, and of IDs
+        if given, return list of their ID, category ID and difficulty
+        '''
+
+    @abstractmethod
+    def any_of(self, column, values):
+        '''Return condition and args matching column to any of values'''
+
+
+class PostgresConnection(Connection):
+    '''Connection of an asyncpg pool'''
+
+    dialect = 'postgresql'
+
+    async def fetch_rows(self, statement, args):
+        return [tuple(row) for row in
+                await self.raw.fetch(numbered(statement), *args)]
+
+    async def execute_statement(self, statement, args):
+        await self.raw.execute(numbered(statement), *args)
+
+    async def execute_many(self, statement, rows):
+        await self.raw.executemany(numbered(statement), rows)
+
+    async def iterate_rows(self, statement, args, batch_size):
+        # Cursors live in a transaction, which reads one snapshot
+        async with self.raw.transaction(readonly=True):
+            cursor = await self.raw.cursor(numbered(statement), *args)
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if len(rows) == 0:
+                    return
+                yield [tuple(row) for row in rows]
+
+    @asynccontextmanager
+    async def transaction(self):
+        '''Run the statements of the block in one transaction'''
+        async with self.raw.transaction():
+            yield self
+
+    async def insert_questions(self, values):
+        '''Insert list of question column values with COPY'''
+        start = time.perf_counter()
+        await self.raw.copy_records_to_table(
+            'questions', columns=QUESTION_COLUMNS, records=[
+                tuple(question[column] for column in QUESTION_COLUMNS)
+                for question in values])
+        record_statement(start, 0)
+
+    async def delete_questions(self, conditions, args, ids=None):
+        if ids is not None:
+            condition, id_args = self.any_of('id', ids)
+            conditions, args = [condition] + conditions, id_args + args
+        return await self.fetch(
+            f'DELETE FROM questions WHERE {" AND ".join(conditions)} '
+            f'RETURNING id, category, difficulty', *args)
+
+    def any_of(self, column, values):
+        return f'{column} = ANY(?)', [list(values)]
+
+
+class SQLiteConnection(Connection):
+    '''Connection of an aiosqlite pool'''
+
+    dialect = 'sqlite'
+
+    async def fetch_rows(self, statement, args):
+        async with self.raw.execute(statement, args) as cursor:
+            return await cursor.fetchall()
+
+    async def execute_statement(self, statement, args):
+        await self.raw.execute(statement, args)
+
+    async def execute_many(self, statement, rows):
+        await self.raw.executemany(statement, rows)
+
+    async def iterate_rows(self, statement, args, batch_size):
+        async with self.raw.execute(statement, args) as cursor:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    return
+                yield rows
+
+    @asynccontextmanager
+    async def transaction(self):
+        '''
+        Run the statements of the block in one transaction, holding the
+        write lock from the start so rows it reads stay as read
+        '''
+        await self.raw.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            await self.raw.execute('ROLLBACK')
+            raise
+        await self.raw.execute('COMMIT')
+
+    async def insert_questions(self, values):
+        '''Insert list of question column values in chunks'''
+        for offset in range(0, len(values), IMPORT_CHUNK_SIZE):
+            await self.executemany(
+                'INSERT INTO questions (question, answer, category, '
+                'difficulty) VALUES (?, ?, ?, ?)',
+                [tuple(question[column] for column in QUESTION_COLUMNS)
+                 for question in values[offset:offset + IMPORT_CHUNK_SIZE]])
+
+    async def delete_questions(self, conditions, args, ids=None):
+        '''
+        Select the questions first, then delete them by ID in chunks within
+        the bound parameter limit, as delete_questions of the bulk module
+        does on SQLite
+        '''
+        id_lists = [None] if ids is None else [
+            ids[offset:offset + DELETE_CHUNK_SIZE]
+            for offset in range(0, len(ids), DELETE_CHUNK_SIZE)]
+        deleted = []
+        for id_list in id_lists:
+            id_conditions, id_args = [], []
+            if id_list is not None:
+                condition, id_args = self.any_of('id', id_list)
+                id_conditions = [condition]
+            deleted.extend(await self.fetch(
+                f'SELECT id, category, difficulty FROM questions WHERE '
+                f'{" AND ".join(id_conditions + conditions)}',
+                *id_args, *args))
+        for offset in range(0, len(deleted), DELETE_CHUNK_SIZE):
+            condition, id_args = self.any_of('id', [
+                question_id for question_id, category, difficulty
+                in deleted[offset:offset + DELETE_CHUNK_SIZE]])
+            await self.execute(f'DELETE FROM questions WHERE {condition}',
+                               *id_args)
+        return deleted
+
+    def any_of(self, column, values):
+        values = list(values)
+        return f'{column} IN ({", ".join("?" * len(values))})', values
+
+
+class PostgresPool:
+    '''asyncpg pool of size connections, and up to max_overflow more'''
+
+    def __init__(self, url, size, max_overflow, timeout,
+                 statement_timeout=None):
+        if asyncpg is None:
+            raise RuntimeError('The async app needs asyncpg on PostgreSQL')
+        # asyncpg takes libpq URLs, without the driver of SQLAlchemy URLs
+        self.url = re.sub(r'^postgres(ql)?\+\w+://', 'postgresql://', url)
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+        self.pool = None
+        self.waits = PoolWaits()
+
+    async def open(self):
+        '''Open the pool connections'''
+        server_settings = {}
+        if self.statement_timeout is not None:
+            server_settings['statement_timeout'] = str(
+                self.statement_timeout)
+        self.pool = await asyncpg.create_pool(
+            self.url, min_size=self.size,
+            max_size=self.size + self.max_overflow,
+            server_settings=server_settings)
+
+    @asynccontextmanager
+    async def connection(self):
+        '''Yield connection checked out of the pool'''
+        start = time.perf_counter()
+        try:
+            raw = await self.pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.waits.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.waits.record(time.perf_counter() - start)
+        try:
+            yield PostgresConnection(raw)
+        finally:
+            await self.pool.release(raw)
+
+    def status(self):
+        '''Return dict of pool size, connections in use and waits'''
+        status = {'pool': type(self).__name__, 'size': self.size}
+        if self.pool is not None:
+            status.update({
+                'checked_out':
+                    self.pool.get_size() - self.pool.get_idle_size(),
+                'overflow': max(0, self.pool.get_size() - self.size),
+                'max_overflow': self.max_overflow
+            })
+        status.update(self.waits.status())
+        return status
+
+    async def close(self):
+        '''Close the pool connections'''
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+class SQLitePool:
+    '''Up to size aiosqlite connections, opened as they are needed'''
+
+    def __init__(self, path, size, timeout):
+        if aiosqlite is None:
+            raise RuntimeError('The async app needs aiosqlite on SQLite')
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.opened = 0
+        self.idle = None
+        self.waits = PoolWaits()
+
+    async def open(self):
+        '''Start the pool, connections open on checkout'''
+        self.idle = asyncio.LifoQueue()
+
+    async def checkout(self):
+        '''Return idle connection, a new one while under size, or wait'''
+        if self.idle.empty() and self.opened < self.size:
+            self.opened += 1
+            try:
+                # Autocommit, as transactions are begun explicitly
+                return await aiosqlite.connect(self.path,
+                                               isolation_level=None)
+            except BaseException:
+                self.opened -= 1
+                raise
+        return await asyncio.wait_for(self.idle.get(), self.timeout)
+
+    @asynccontextmanager
+    async def connection(self):
+        '''Yield connection checked out of the pool'''
+        start = time.perf_counter()
+        try:
+            raw = await self.checkout()
+        except asyncio.TimeoutError:
+            self.waits.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.waits.record(time.perf_counter() - start)
+        try:
+            yield SQLiteConnection(raw)
+        finally:
+            self.idle.put_nowait(raw)
+
+    def status(self):
+        '''Return dict of pool size, connections in use and waits'''
+        status = {'pool': type(self).__name__, 'size': self.size,
+                  'overflow': 0, 'max_overflow': 0}
+        if self.idle is not None:
+            status['checked_out'] = self.opened - self.idle.qsize()
+        status.update(self.waits.status())
+        return status
+
+    async def close(self):
+        '''Close the idle connections'''
+        while self.idle is not None and not self.idle.empty():
+            await self.idle.get_nowait().close()
+            self.opened -= 1
+
+
+def create_pool(app, url):
+    '''Return unopened pool of database URL with the pool settings of app'''
+    size = setting(app, 'DB_POOL_SIZE', DB_POOL_SIZE)
+    timeout = setting(app, 'DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)
+    if url.startswith('sqlite:///'):
+        return SQLitePool(url[len('sqlite:///'):], size, timeout)
+    if url.startswith('postgres'):
+        return PostgresPool(
+            url, size, setting(app, 'DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+            timeout, setting(app, 'DB_STATEMENT_TIMEOUT'))
+    raise ValueError(f'The async app does not support database {url}')
+
+
+class AsyncDataVersions:
+    '''
+    Generation counters of question and category data, counted in process
+    or read from the data_versions table like DataVersions
+    '''
+
+    def __init__(self, use_table=False, ttl=None):
+        self.use_table = use_table
+        self.ttl = ttl
+        self.local = {QUESTIONS: 0, CATEGORIES: 0}
+        # In-process versions only identify data within this process
+        self.instance = 'db' if use_table else uuid.uuid4().hex[:8]
+
+    async def create_rows(self, connection):
+        '''Insert missing rows of the data_versions table'''
+        if self.use_table:
+            await connection.executemany(
+                'INSERT INTO data_versions (name, version, updated_at) '
+                'VALUES (?, 0, ?) ON CONFLICT (name) DO NOTHING',
+                [(name, datetime.utcnow()) for name in sorted(self.local)])
+
+    async def load(self, connection):
+        '''
+        Return dicts of version and of update time by name, the times None
+        unless kept in the table, read once per request
+        '''
+        loaded = request_versions.get()
+        if loaded is None:
+            if self.use_table:
+                rows = await connection.fetch(
+                    'SELECT name, version, updated_at FROM data_versions')
+                # aiosqlite returns the times as text
+                loaded = ({name: version for name, version, updated in rows},
+                          {name: datetime.fromisoformat(updated)
+                           if isinstance(updated, str) else updated
+                           for name, version, updated in rows})
+            else:
+                loaded = (dict(self.local), None)
+            request_versions.set(loaded)
+        return loaded
+
+    async def current(self, connection):
+        '''Return dict of version by name'''
+        versions, updated = await self.load(connection)
+        return versions
+
+    def etag(self, versions, names):
+        '''Return strong ETag value for versions of names'''
+        return version_etag(self.instance, versions, names,
+                            None if self.use_table else self.ttl)
+
+    def last_modified(self, updated, names):
+        '''
+        Return last update time of names, None unless kept in the table or
+        while writes in the same second could still follow
+        '''
+        if updated is None:
+            return None
+        return settled(max(updated[name] for name in names))
+
+    async def bump_in_transaction(self, connection, names):
+        '''Bump versions in the writing transaction when kept in the table'''
+        if self.use_table:
+            condition, args = connection.any_of('name', sorted(names))
+            await connection.execute(
+                f'UPDATE data_versions SET version = version + 1, '
+                f'updated_at = ? WHERE {condition}',
+                datetime.utcnow(), *args)
+
+    def bump_committed(self, names):
+        '''Bump versions after the writing transaction commits'''
+        for name in names:
+            self.local[name] += 1
+        request_versions.set(None)
+
+
+class QuestionQuery:
+    '''
+    Questions matching a condition, ranked by an ORDER BY expression and
+    then by ID, with the args of condition and rank
+    '''
+
+    def __init__(self, condition='1 = 1', args=(), join='', rank=None,
+                 rank_args=()):
+        self.condition = condition
+        self.args = list(args)
+        self.join = join
+        self.rank = rank
+        self.rank_args = list(rank_args)
+
+    def select(self, columns, extra=None):
+        '''Return SELECT of columns in rank and ID order, without args'''
+        condition = self.condition
+        if extra is not None:
+            condition = f'{condition} AND {extra}'
+        order = 'questions.id' if self.rank is None or extra is not None \
+            else f'{self.rank}, questions.id'
+        return (f'SELECT {", ".join(columns)} FROM questions{self.join} '
+                f'WHERE {condition} ORDER BY {order}')
+
+    def count(self):
+        '''Return SELECT of the number of matching questions'''
+        return (f'SELECT COUNT(*) FROM questions{self.join} '
+                f'WHERE {self.condition}')
+
+    def max_id(self):
+        '''Return SELECT of the highest ID of matching questions'''
+        return (f'SELECT MAX(questions.id) FROM questions{self.join} '
+                f'WHERE {self.condition}')
+
+
+def category_query(category_id):
+    '''Return query of questions of category, every question for 0'''
+    if category_id == 0:
+        return QuestionQuery()
+    return QuestionQuery('questions.category = ?', [category_id])
+
+
+def search_query(connection, search_term):
+    '''
+    Return query of questions matching every word of search term as a
+    word prefix in question or answer, most relevant first, as
+    Question.search does
+    '''
+    words = re.findall(r'\w+', search_term.lower())
+    if len(words) == 0:
+        return QuestionQuery('lower(questions.question) LIKE lower(?)',
+                             [f'%{search_term}%'])
+    if connection.dialect == 'postgresql':
+        ts_query = ' & '.join(f'{word}:*' for word in words)
+        return QuestionQuery(
+            "questions.search_vector @@ to_tsquery('simple', ?)",
+            [ts_query],
+            rank="ts_rank(questions.search_vector, "
+                 "to_tsquery('simple', ?)) DESC",
+            rank_args=[ts_query])
+    return QuestionQuery(
+        'questions_search MATCH ?',
+        [' AND '.join(f'"{word}"*' for word in words)],
+        join=' JOIN questions_search '
+             'ON questions_search.rowid = questions.id',
+        rank='questions_search.rank')
+
+
+def question_dict(row):
+    '''Return dict of question fields of a row of QUESTION_SELECT'''
+    return dict(zip(EXPORT_COLUMNS, row))
+
+
+async def paginate_questions(connection, request, query,
+                             total_questions=None):
+    '''
+    Return page of question query as dict of response fields, by keyset
+    after the after cursor or by page, like the sync paginate_questions
+    '''
+    try:
+        fields = question_fields(request.args.get('fields'))
+    except ValueError:
+        abort(422)
+    columns = [f'questions.{field}' for field in fields]
+    after = request.args.get('after')
+    if after is not None:
+        return page_after(await connection.fetch(
+            query.select(columns, 'questions.id > ?') + ' LIMIT ?',
+            *query.args, decode_cursor(after), QUESTIONS_PER_PAGE + 1),
+            fields)
+    page = request.arg('page', 1, int)
+    page_questions = []
+    if page > 0:
+        rows = await connection.fetch(
+            query.select(columns) + ' LIMIT ? OFFSET ?',
+            *query.args, *query.rank_args, QUESTIONS_PER_PAGE,
+            (page - 1) * QUESTIONS_PER_PAGE)
+        page_questions = [dict(zip(fields, row)) for row in rows]
+    if total_questions is None:
+        total_questions = page_total(page, page_questions)
+    if total_questions is None:
+        total_questions = await connection.fetchval(query.count(),
+                                                    *query.args)
+    return {
+        'questions': page_questions,
+        'total_questions': total_questions
+    }
+
+
+async def add_question_counts(connection, changes):
+    '''Add Counter of count changes by category ID on connection'''
+    # In category order, so concurrent writers cannot deadlock
+    rows = [(category_id, delta)
+            for category_id, delta in sorted(changes.items()) if delta != 0]
+    if len(rows) > 0:
+        await connection.executemany(ADD_COUNT, rows)
+
+
+async def question_count(connection, category_id):
+    '''Return stored question count of category, 0 for all questions'''
+    count = await connection.fetchval(
+        'SELECT count FROM question_counts WHERE category_id = ?',
+        category_id)
+    return count or 0
+
+
+async def next_question(connection, session, query, count):
+    '''
+    Return next question dict of query in quiz session order and advance,
+    or None, as QuizSession.next_question does
+    '''
+    dense = session.dense(count)
+    question = None
+    if dense is False:
+        question_id = session.next_ranked(
+            question_id for question_id, in await connection.fetch(
+                query.select(['questions.id']), *query.args))
+        if question_id is not None:
+            rows = await connection.fetch(
+                query.select([QUESTION_SELECT], 'questions.id = ?'),
+                *query.args, question_id)
+            question = question_dict(rows[0]) if len(rows) > 0 else None
+    elif dense:
+        for probe in session.probes():
+            condition, args = connection.any_of('questions.id', probe)
+            questions = {row[0]: question_dict(row) for row in
+                         await connection.fetch(
+                             query.select([QUESTION_SELECT], condition),
+                             *query.args, *args)}
+            question_id = session.next_probed(probe, questions)
+            if question_id is not None:
+                question = questions[question_id]
+                break
+    if question is None and session.extend(await connection.fetchval(
+            query.max_id(), *query.args)):
+        return await next_question(connection, session, query, count)
+    return question
+
+
+class Request:
+    '''Method, path, query args, headers and body of an HTTP request'''
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {
+            name: values[0] for name, values in parse_qs(
+                scope['query_string'].decode('utf-8', 'replace'),
+                keep_blank_values=True).items()}
+        self.headers = Headers([
+            (name.decode('latin-1'), value.decode('latin-1'))
+            for name, value in scope['headers']])
+        self.body = body
+        self.rule = None
+
+    @property
+    def mimetype(self):
+        '''Return lowercase media type of the Content-Type header'''
+        return self.headers.get('Content-Type', '').split(';')[0] \
+            .strip().lower()
+
+    @property
+    def if_none_match(self):
+        '''Return ETags of the If-None-Match header'''
+        return parse_etags(self.headers.get('If-None-Match'))
+
+    @property
+    def if_modified_since(self):
+        '''Return date of the If-Modified-Since header, None if not valid'''
+        return parse_date(self.headers.get('If-Modified-Since'))
+
+    def arg(self, name, default=None, type=None):
+        '''Return query arg converted by type, default if missing or not'''
+        value = self.args.get(name)
+        if value is None or type is None:
+            return default if value is None else value
+        try:
+            return type(value)
+        except ValueError:
+            return default
+
+    def get_json(self):
+        '''
+        Return JSON body, None unless the request says it is JSON, and
+        abort 400 if it is not valid
+        '''
+        if self.mimetype != 'application/json' and not (
+                self.mimetype.startswith('application/') and
+                self.mimetype.endswith('+json')):
+            return None
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            abort(400)
+
+    def get_text(self):
+        '''Return body decoded as UTF-8'''
+        return self.body.decode('utf-8', 'replace')
+
+
+class Response:
+    '''Status, headers and body bytes or async iterator of body chunks'''
+
+    def __init__(self, body=b'', status=200,
+                 content_type='application/json', headers=None,
+                 stream=None):
+        self.body = body
+        self.status = status
+        self.headers = [] if content_type is None else [
+            ('Content-Type', content_type)]
+        self.headers.extend(headers or [])
+        self.stream = stream
+
+
+def json_response(payload, status=200, headers=None):
+    '''Return JSON response of payload'''
+    return Response(json_body(payload), status, headers=headers)
+
+
+def error_response(code, message, headers=None):
+    '''Return JSON error response like the error handlers of create_app'''
+    return json_response({
+        'success': False,
+        'error': code,
+        'message': message
+    }, code, headers)
+
+
+class AsyncApp:
+    '''ASGI app dispatching requests to the coroutines of its routes'''
+
+    def __init__(self, config):
+        if config.get('WRITE_BEHIND', False):
+            raise ValueError('The async app has no write-behind queue')
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.database_url = setting(self, 'DATABASE_URL',
+                                    default_database_path)
+        self.pool = create_pool(self, self.database_url)
+        use_table = config.get('DATA_VERSION_TABLE', False)
+        self.versions = AsyncDataVersions(
+            use_table,
+            None if use_table else config.get('CACHE_TTL', CACHE_TTL))
+        self.metrics = Metrics() if config.get('METRICS', True) else None
+        self.routes = []
+        self.started = False
+        self.start_lock = asyncio.Lock()
+        self.build_lock = asyncio.Lock()
+        self.has_trigram_index = False
+        # Version, cache period and dict of the categories, and the
+        # in-process indexes by name with their background rebuilds
+        self.categories = None
+        self.indexes = {}
+        self.rebuilds = {}
+
+    def route(self, rule, methods=('GET',)):
+        '''Decorate coroutine to handle requests to rule by methods'''
+        pattern = re.compile('^' + re.sub(
+            r'<(?:(int):)?(\w+)>',
+            lambda match: fr'(?P<{match[2]}>\d+)' if match[1]
+            else fr'(?P<{match[2]}>[^/]+)', rule) + '$')
+        converters = {name: int for name in
+                      re.findall(r'<int:(\w+)>', rule)}
+
+        def decorator(view):
+            self.routes.append((rule, pattern, converters, set(methods),
+                                view))
+            return view
+        return decorator
+
+    async def startup(self):
+        '''Open the pool and read database features once'''
+        async with self.start_lock:
+            if self.started:
+                return
+            await self.pool.open()
+            async with self.pool.connection() as connection:
+                await self.versions.create_rows(connection)
+                if connection.dialect == 'postgresql':
+                    self.has_trigram_index = await connection.fetchval(
+                        "SELECT 1 FROM pg_extension "
+                        "WHERE extname = 'pg_trgm'") is not None
+            self.started = True
+
+    async def shutdown(self):
+        '''Close the pool, so the app can start again on another loop'''
+        async with self.start_lock:
+            for rebuild in self.rebuilds.values():
+                rebuild.cancel()
+            self.rebuilds = {}
+            await self.pool.close()
+            self.started = False
+            # Locks stay bound to the loop they first waited on
+            self.start_lock = asyncio.Lock()
+            self.build_lock = asyncio.Lock()
+
+    async def cached_categories(self, connection, versions):
+        '''
+        Return dict of category type by category ID, read again once their
+        version moves on or, with in-process versions, the cache period
+        ends, as VersionedCache does
+        '''
+        key = (versions[CATEGORIES], None if self.versions.ttl is None
+               else cache_period(self.versions.ttl))
+        if self.categories is None or self.categories[0] != key:
+            self.categories = (key, dict(await connection.fetch(
+                'SELECT id, type FROM categories ORDER BY id')))
+        return self.categories[1]
+
+    def conditional(self, *names):
+        '''
+        Decorate GET view to support conditional requests on data of names
+        like conditional of the sync app, responding 304 from versions
+        alone when the client copy is current
+        '''
+        def decorator(view):
+            @functools.wraps(view)
+            async def wrapper(request, **kwargs):
+                if self.versions.use_table:
+                    async with self.pool.connection() as connection:
+                        versions, updated = await self.versions.load(
+                            connection)
+                else:
+                    versions, updated = await self.versions.load(None)
+                etag = self.versions.etag(versions, names)
+                last_modified = self.versions.last_modified(updated, names)
+                if not_modified(request.if_none_match,
+                                request.if_modified_since, etag,
+                                last_modified):
+                    # Without the entity headers, as Werkzeug sends 304
+                    return Response(b'', 304, content_type=None, headers=[
+                        ('ETag', quote_etag(etag)),
+                        ('Cache-Control', 'no-cache')])
+                response = await view(request, **kwargs)
+                if response.status == 200:
+                    response.headers.append(('ETag', quote_etag(etag)))
+                    if last_modified is not None:
+                        response.headers.append(
+                            ('Last-Modified', http_date(last_modified)))
+                    response.headers.append(('Cache-Control', 'no-cache'))
+                return response
+            return wrapper
+        return decorator
+
+    async def current_index(self, connection, versions, name, build,
+                            rows_after):
+        '''
+        Return in-process index by name, built by build(connection,
+        version) on first use, caught up with rows_after(connection,
+        max_id) when behind, and rebuilt in the background once it missed
+        writes, as current_index of the sync app does
+        '''
+        version = versions[QUESTIONS]
+        index = self.indexes.get(name)
+        if index is None:
+            async with self.build_lock:
+                index = self.indexes.get(name)
+                if index is None:
+                    index = self.indexes[name] = await build(connection,
+                                                             version)
+            return index
+        if index.behind(version, self.versions.ttl) and \
+                index.catch_up_lock.acquire(blocking=False):
+            try:
+                index.catch_up(await rows_after(connection, index.max_id),
+                               version, await question_count(connection, 0))
+            finally:
+                index.catch_up_lock.release()
+        rebuild = self.rebuilds.get(name)
+        if index.rebuild_due(self.config.get(
+                'INDEX_REBUILD_INTERVAL', INDEX_REBUILD_INTERVAL)) and \
+                (rebuild is None or rebuild.done()):
+            self.rebuilds[name] = asyncio.ensure_future(
+                self.rebuild_index(name, build))
+        return index
+
+    async def rebuild_index(self, name, build):
+        '''Build index by name again on a connection of its own'''
+        # Read versions afresh rather than those of the request it left
+        request_versions.set(None)
+        async with self.pool.connection() as connection:
+            versions = await self.versions.current(connection)
+            self.indexes[name] = await build(connection, versions[QUESTIONS])
+
+    async def build_question_ids(self, connection, version):
+        '''Return question ID index of every question in the database'''
+        index = QuestionIds(self.database_url, version)
+        if connection.dialect == 'postgresql':
+            index.fill_grouped(await connection.fetch(
+                'SELECT category, difficulty, array_agg(id ORDER BY id) '
+                'FROM questions GROUP BY category, difficulty'))
+        else:
+            async for rows in connection.iterate(
+                    'SELECT id, category, difficulty FROM questions '
+                    'ORDER BY id', batch_size=BUILD_BATCH_SIZE):
+                index.fill_sorted(rows)
+        return index
+
+    async def build_ngram_index(self, connection, version):
+        '''Return n-gram index of every question in the database'''
+        index = NGramIndex(self.database_url, version)
+        async for rows in connection.iterate(
+                'SELECT id, question FROM questions'):
+            index.add_rows(rows)
+        return index
+
+    async def question_id_index(self, connection, versions):
+        '''Return question ID index, caught up with writes it missed'''
+        return await self.current_index(
+            connection, versions, QUESTION_IDS, self.build_question_ids,
+            lambda connection, max_id: connection.fetch(
+                'SELECT id, category, difficulty FROM questions '
+                'WHERE id > ? ORDER BY id', max_id))
+
+    async def suggestion_index(self, connection, versions):
+        '''Return n-gram index, caught up with writes it missed'''
+        return await self.current_index(
+            connection, versions, NGRAMS, self.build_ngram_index,
+            lambda connection, max_id: connection.fetch(
+                'SELECT id, question FROM questions WHERE id > ? '
+                'ORDER BY id', max_id))
+
+    def questions_committed(self, added=(), deleted=()):
+        '''
+        Apply committed writes of questions of ID, category ID, difficulty
+        and text, and of deleted questions of ID, category ID and
+        difficulty, to the versions and in-process indexes
+        '''
+        self.versions.bump_committed([QUESTIONS])
+        apply_writes(self.indexes, self.database_url, added, deleted)
+
+    async def random_questions(self, connection, versions, category_id,
+                               previous_questions, count, strategy,
+                               target):
+        '''
+        Return up to count random question dicts of category not in
+        previous questions, picked from the question ID index
+        '''
+        draw = QuestionDraw(
+            await self.question_id_index(connection, versions), category_id,
+            previous_questions, count, strategy, target)
+        for picked in draw.picks():
+            condition, args = connection.any_of('questions.id', picked)
+            questions = [question_dict(row) for row in await connection.fetch(
+                f'SELECT {QUESTION_SELECT} FROM questions WHERE {condition}',
+                *args)]
+            draw.add({question['id']: (question['category'], question)
+                      for question in questions})
+        return draw.questions
+
+    def dispatch(self, request):
+        '''Return route rule, view and path args of request, abort if none'''
+        method = 'GET' if request.method == 'HEAD' else request.method
+        allowed = set()
+        for rule, pattern, converters, methods, view in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            if method in methods:
+                return rule, view, {
+                    name: converters.get(name, str)(value)
+                    for name, value in match.groupdict().items()}
+            allowed |= methods
+        if len(allowed) == 0:
+            abort(404)
+        raise MethodNotAllowed(sorted(allowed | {'HEAD', 'OPTIONS'}))
+
+    async def respond(self, request):
+        '''Return response of request, JSON errors for failures'''
+        try:
+            if request.method == 'OPTIONS':
+                # Answered with the allowed methods of the path, as Flask
+                # does, since no route takes OPTIONS
+                try:
+                    self.dispatch(request)
+                except MethodNotAllowed as error:
+                    return Response(b'', content_type='text/html',
+                                    headers=allow_header(error))
+            request.rule, view, kwargs = self.dispatch(request)
+            if not self.started:
+                await self.startup()
+            return await view(request, **kwargs)
+        except MethodNotAllowed as error:
+            return error_response(error.code, error.name,
+                                  allow_header(error))
+        except HTTPException as error:
+            return error_response(error.code, error.name)
+        except Exception:
+            self.logger.exception('Exception on %s %s', request.method,
+                                  request.path)
+            return error_response(500, 'Internal Server Error')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        request = Request(scope, b''.join(chunks))
+        counts = RequestCounts()
+        token = request_counts.set(counts)
+        versions_token = request_versions.set(None)
+        response = None
+        try:
+            response = await self.respond(request)
+            counts.response_bytes = await self.send_response(
+                send, response, request.method == 'HEAD')
+        finally:
+            request_counts.reset(token)
+            request_versions.reset(versions_token)
+            if self.metrics is not None and response is not None:
+                self.metrics.record(
+                    (request.method, request.rule or 'unmatched',
+                     str(response.status)),
+                    time.perf_counter() - counts.start, counts)
+
+    async def send_response(self, send, response, head=False):
+        '''Send response, return number of body bytes sent'''
+        headers = response.headers + CORS_HEADERS
+        if response.stream is None:
+            headers = headers + [('Content-Length', str(len(response.body)))]
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers]
+        })
+        if response.stream is None:
+            await send({'type': 'http.response.body',
+                        'body': b'' if head else response.body})
+            return len(response.body)
+        sent = 0
+        async with aclosing(response.stream) as chunks:
+            async for chunk in chunks:
+                if head:
+                    break
+                sent += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        return sent
+
+    async def lifespan(self, receive, send):
+        '''Open the pool at server startup and close it at shutdown'''
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_async_app(test_config=None):
+    '''Create and configure the async app'''
+    app = AsyncApp(dict(test_config or {}))
+
+    if app.metrics is not None:
+        @app.route('/metrics')
+        async def get_metrics(request):
+            '''Handle GET requests for metrics'''
+            return Response(
+                (app.metrics.text() +
+                 status_text(POOL_METRICS, app.pool.status())).encode(),
+                content_type=METRICS_MIMETYPE)
+
+    @app.route('/categories')
+    @app.conditional(CATEGORIES)
+    async def get_categories(request):
+        '''Handle GET requests for categories'''
+        async with app.pool.connection() as connection:
+            categories = await app.cached_categories(
+                connection, await app.versions.current(connection))
+        if len(categories) == 0:
+            abort(404)
+        return json_response({
+            'success': True,
+            'categories': categories
+        })
+
+    @app.route('/categories/<int:category_id>/questions')
+    @app.conditional(QUESTIONS)
+    async def get_questions_by_category(request, category_id):
+        '''Handle GET requests for questions by category ID'''
+        async with app.pool.connection() as connection:
+            page = await paginate_questions(
+                connection, request, category_query(category_id),
+                await question_count(connection, category_id))
+        if len(page['questions']) == 0:
+            abort(404)
+        return json_response({
+            'success': True,
+            'current_category': category_id,
+            **page
+        })
+
+    @app.route('/questions')
+    @app.conditional(QUESTIONS, CATEGORIES)
+    async def get_questions(request):
+        '''Handle GET requests for questions'''
+        async with app.pool.connection() as connection:
+            page = await paginate_questions(
+                connection, request, QuestionQuery(),
+                await question_count(connection, 0))
+            if len(page['questions']) == 0:
+                abort(404)
+            categories = await app.cached_categories(
+                connection, await app.versions.current(connection))
+        return json_response({
+            'success': True,
+            'categories': categories,
+            **page
+        })
+
+    @app.route('/questions/suggest')
+    @app.conditional(QUESTIONS)
+    async def get_question_suggestions(request):
+        '''Handle GET requests for question text suggestions by prefix'''
+        prefix = request.args.get('prefix')
+        limit = request.arg('limit', SUGGEST_LIMIT, int)
+        if prefix is None or limit not in range(1, MAX_SUGGEST_LIMIT + 1):
+            abort(422)
+        suggestions = []
+        if suggestable(prefix):
+            async with app.pool.connection() as connection:
+                if app.has_trigram_index:
+                    escaped = re.sub(r'([\\%_])', r'\\\1', prefix)
+                    suggestions = [question for question, in
+                                   await connection.fetch(
+                                       'SELECT question FROM questions '
+                                       'WHERE question ILIKE ? ORDER BY '
+                                       'CASE WHEN lower(question) ~ ? '
+                                       'THEN 0 ELSE 1 END, '
+                                       'length(question), id LIMIT ?',
+                                       f'%{escaped}%',
+                                       word_start_pattern(prefix), limit)]
+                else:
+                    index = await app.suggestion_index(
+                        connection, await app.versions.current(connection))
+                    suggestions = index.suggest(prefix, limit)
+        return json_response({
+            'success': True,
+            'suggestions': suggestions
+        })
+
+    @app.route('/questions', methods=['POST'])
+    async def post_question(request):
+        '''
+        Handle POST requests for questions
+        Optionally return questions by search term
+        '''
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+        async with app.pool.connection() as connection:
+            if 'searchTerm' in body:
+                # Return questions by search term
+                search_term = body.get('searchTerm')
+                if not isinstance(search_term, str):
+                    abort(422)
+                return json_response({
+                    'success': True,
+                    **await paginate_questions(
+                        connection, request,
+                        search_query(connection, search_term))
+                })
+            categories = await app.cached_categories(
+                connection, await app.versions.current(connection))
+            try:
+                values = question_values(body, categories)
+            except ValueError:
+                abort(422)
+            async with connection.transaction():
+                question_id = await connection.fetchval(
+                    'INSERT INTO questions (question, answer, category, '
+                    'difficulty) VALUES (?, ?, ?, ?) RETURNING id',
+                    *[values[column] for column in QUESTION_COLUMNS])
+                await add_question_counts(
+                    connection, count_changes([values['category']], 1))
+                await app.versions.bump_in_transaction(connection,
+                                                       [QUESTIONS])
+        app.questions_committed(added=[(
+            question_id, values['category'], values['difficulty'],
+            values['question'])])
+        return json_response({
+            'success': True,
+            'created': question_id
+        })
+
+    @app.route('/questions/bulk', methods=['POST'])
+    async def post_questions_bulk(request):
+        '''
+        Handle POST requests for many questions as JSON array or NDJSON
+        Either every question is created or none are
+        '''
+        start = time.perf_counter()
+        if request.mimetype in NDJSON_MIMETYPES:
+            rows = parse_ndjson(request.get_text())
+        else:
+            rows = request.get_json()
+            if not isinstance(rows, list):
+                abort(400)
+        async with app.pool.connection() as connection:
+            values, errors = validate_rows(rows, set(
+                await app.cached_categories(
+                    connection, await app.versions.current(connection))))
+            if len(errors) > 0:
+                return json_response({
+                    'success': False,
+                    'error': 422,
+                    'message': 'Unprocessable Entity',
+                    'errors': errors
+                }, 422)
+            async with connection.transaction():
+                await connection.insert_questions(values)
+                await add_question_counts(connection, count_changes(
+                    [question['category'] for question in values], 1))
+                await app.versions.bump_in_transaction(connection,
+                                                       [QUESTIONS])
+        # The new IDs are not known, so the indexes catch up with them
+        app.versions.bump_committed([QUESTIONS])
+        elapsed = time.perf_counter() - start
+        return json_response({
+            'success': True,
+            'created': len(values),
+            'rows_per_second': round(len(values) / elapsed) if elapsed else 0
+        })
+
+    @app.route('/questions/export')
+    async def get_questions_export(request):
+        '''
+        Handle GET requests for all questions streamed as NDJSON or CSV
+        Optionally filtered by category and difficulty
+        '''
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_MIMETYPES:
+            abort(422)
+        try:
+            filters = {name: int(request.args[name])
+                       for name in ['category', 'difficulty']
+                       if name in request.args}
+        except ValueError:
+            abort(422)
+        conditions = [f'{name} = ?' for name in filters] or ['1 = 1']
+        statement = (f'SELECT {QUESTION_SELECT} FROM questions '
+                     f'WHERE {" AND ".join(conditions)} ORDER BY id')
+
+        async def chunks():
+            for chunk in export_questions([], export_format):
+                yield chunk.encode()
+            async with app.pool.connection() as connection:
+                async for rows in connection.iterate(statement,
+                                                     *filters.values()):
+                    for chunk in export_questions(rows, export_format,
+                                                  header=False):
+                        yield chunk.encode()
+
+        return Response(content_type=EXPORT_MIMETYPES[export_format],
+                        stream=chunks())
+
+    @app.route('/questions', methods=['DELETE'])
+    async def delete_questions_at_once(request):
+        '''
+        Handle DELETE requests for questions by ID list, category and
+        difficulty, deleted in one transaction
+        '''
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+        try:
+            filters = delete_filters(body)
+        except ValueError:
+            abort(422)
+        conditions = []
+        args = []
+        for name, column in [('category_id', 'category'),
+                             ('difficulty', 'difficulty')]:
+            if name in filters:
+                conditions.append(f'{column} = ?')
+                args.append(filters[name])
+        async with app.pool.connection() as connection:
+            async with connection.transaction():
+                deleted = await connection.delete_questions(
+                    conditions, args, filters.get('question_ids'))
+                await add_question_counts(connection, count_changes(
+                    [category for question_id, category, difficulty
+                     in deleted], -1))
+                await app.versions.bump_in_transaction(connection,
+                                                       [QUESTIONS])
+        app.questions_committed(deleted=deleted)
+        deleted_ids = sorted(question_id for question_id, category,
+                             difficulty in deleted)
+        return json_response({
+            'success': True,
+            'deleted': deleted_ids,
+            'total_deleted': len(deleted_ids)
+        })
+
+    @app.route('/questions/<int:question_id>', methods=['DELETE'])
+    async def delete_question(request, question_id):
+        '''Handle DELETE requests for questions by question ID'''
+        async with app.pool.connection() as connection:
+            async with connection.transaction():
+                deleted = await connection.delete_questions(
+                    ['id = ?'], [question_id])
+                if len(deleted) == 0:
+                    abort(404)
+                await add_question_counts(
+                    connection, count_changes([deleted[0][1]], -1))
+                await app.versions.bump_in_transaction(connection,
+                                                       [QUESTIONS])
+        app.questions_committed(deleted=deleted)
+        return json_response({
+            'success': True,
+            'deleted': question_id
+        })
+
+    @app.route('/quizzes', methods=['POST'])
+    async def get_quizzes(request):
+        '''Handle POST requests for quizzes'''
+        quiz_session, previous_questions, count, category_id, strategy, \
+            target = quiz_request(request.get_json())
+        async with app.pool.connection() as connection:
+            versions = await app.versions.current(connection)
+            if category_id != 0 and category_id not in \
+                    await app.cached_categories(connection, versions):
+                abort(422)
+            if quiz_session is not None:
+                session = await load_quiz_session(connection, quiz_session)
+                question = await next_question(
+                    connection, session, category_query(category_id),
+                    await question_count(connection, category_id))
+                return json_response({
+                    'success': True,
+                    'question': question,
+                    'quiz_session': session.encode()
+                })
+            unseen = await app.random_questions(
+                connection, versions, category_id, previous_questions,
+                1 if count is None else count, strategy, target)
+        if count is not None:
+            return json_response({
+                'success': True,
+                'questions': unseen
+            })
+        return json_response({
+            'success': True,
+            'question': unseen[0] if unseen else None
+        })
+
+    return app
+
+
+async def load_quiz_session(connection, quiz_session):
+    '''
+    Return quiz session started by integer seed or blank for random seed,
+    or continued by session token
+    '''
+    max_question_id = None
+    if starts_session(quiz_session):
+        max_question_id = await connection.fetchval(
+            'SELECT MAX(id) FROM questions')
+    try:
+        return open_session(quiz_session, max_question_id)
+    except ValueError:
+        abort(422)
@@ -0,0 +1,243 @@
+'''
+Bulk module
+
+Imports many questions at once. Every row is validated against one set of
+category IDs loaded up front, then valid rows are inserted in chunks inside
+a single transaction: COPY on PostgreSQL, executemany elsewhere, with the
+question counts of their categories. If any row is not valid nothing is
+inserted and every row error is reported.
+
+Deletes remove every question of an ID list, category or difficulty with
+one set-based DELETE, and update the question counts and in-process
+indexes once for all of them.
+
+Exports stream questions as NDJSON or CSV from a server-side cursor, one
+batch of rows at a time, so memory use does not grow with the table.
+'''
+
+import csv
+import io
+import json
+import time
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from models import db, Question
+from .cache import versioned_transaction, QUESTIONS
+from .counts import add_question_counts, begin_write, count_changes
+from .indexes import apply_writes
+
+IMPORT_CHUNK_SIZE = 1000
+# IDs per DELETE statement, within the bound parameter limit of SQLite
+DELETE_CHUNK_SIZE = 1000
+MAX_DELETE_IDS = 10000
+EXPORT_BATCH_SIZE = 1000
+NDJSON_MIMETYPES = ['application/x-ndjson', 'application/ndjson']
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+QUESTION_COLUMNS = ['question', 'answer', 'category', 'difficulty']
+EXPORT_COLUMNS = ['id'] + QUESTION_COLUMNS
+
+
+def parse_ndjson(text):
+    '''Return list of rows of NDJSON text, with None for lines not valid'''
+    rows = []
+    for line in text.splitlines():
+        if line.strip() == '':
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            rows.append(None)
+    return rows
+
+
+def parse_questions(text):
+    '''
+    Return list of rows of JSON array or NDJSON text
+    Raise ValueError if a JSON array is not valid
+    '''
+    if text.lstrip().startswith('['):
+        rows = json.loads(text)
+        if not isinstance(rows, list):
+            raise ValueError('questions not a JSON array')
+        return rows
+    return parse_ndjson(text)
+
+
+def question_values(row, category_ids):
+    '''
+    Return dict of column values of a question row
+    Raise ValueError with message if the row is not valid
+    '''
+    if not isinstance(row, dict):
+        raise ValueError('question not a JSON object')
+    try:
+        difficulty = int(row.get('difficulty'))
+        category = int(row.get('category'))
+    except (TypeError, ValueError):
+        raise ValueError('difficulty and category must be integers')
+    question = row.get('question')
+    answer = row.get('answer')
+    if not isinstance(question, str) or question == '':
+        raise ValueError('question must be a non-blank string')
+    if not isinstance(answer, str) or answer == '':
+        raise ValueError('answer must be a non-blank string')
+    if difficulty not in range(1, 6):
+        raise ValueError('difficulty must be from 1 to 5')
+    if category not in category_ids:
+        raise ValueError('category not found')
+    return {
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def insert_chunk(connection, chunk):
+    '''Insert chunk of question values on connection'''
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for values in chunk:
+            writer.writerow([values[column] for column in QUESTION_COLUMNS])
+        buffer.seek(0)
+        connection.connection.cursor().copy_expert(
+            'COPY questions (question, answer, category, difficulty) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+    else:
+        connection.execute(Question.__table__.insert(), chunk)
+
+
+def validate_rows(rows, category_ids):
+    '''Return list of column values of question rows, and row errors'''
+    values = []
+    errors = []
+    for index, row in enumerate(rows):
+        try:
+            values.append(question_values(row, category_ids))
+        except ValueError as error:
+            errors.append({'row': index, 'message': str(error)})
+    return values, errors
+
+
+def import_questions(rows, category_ids):
+    '''
+    Validate and insert question rows in one transaction
+    Return dict with created count and rows per second, or row errors
+    '''
+    start = time.perf_counter()
+    values, errors = validate_rows(rows, category_ids)
+    if len(errors) > 0:
+        return {'created': 0, 'errors': errors}
+    with versioned_transaction([QUESTIONS]) as connection:
+        for offset in range(0, len(values), IMPORT_CHUNK_SIZE):
+            insert_chunk(connection,
+                         values[offset:offset + IMPORT_CHUNK_SIZE])
+        add_question_counts(connection, count_changes(
+            [question['category'] for question in values], 1))
+    elapsed = time.perf_counter() - start
+    return {
+        'created': len(values),
+        'errors': [],
+        'rows_per_second': round(len(values) / elapsed) if elapsed else 0
+    }
+
+
+def delete_filters(body):
+    '''
+    Return dict of delete_questions arguments of request body
+    Raise ValueError with message if the body is not valid
+    '''
+    if not isinstance(body, dict) or \
+            len(set(body) & {'ids', 'category', 'difficulty'}) == 0:
+        raise ValueError('ids, category or difficulty required')
+    filters = {}
+    if 'ids' in body:
+        ids = body['ids']
+        if not isinstance(ids, list) or not all(
+                isinstance(question_id, int) and
+                not isinstance(question_id, bool) for question_id in ids):
+            raise ValueError('ids must be a list of integers')
+        if len(ids) > MAX_DELETE_IDS:
+            raise ValueError(f'at most {MAX_DELETE_IDS} ids')
+        filters['question_ids'] = ids
+    for name, argument in [('category', 'category_id'),
+                           ('difficulty', 'difficulty')]:
+        if name in body:
+            if not isinstance(body[name], int) or \
+                    isinstance(body[name], bool):
+                raise ValueError(f'{name} must be an integer')
+            filters[argument] = body[name]
+    return filters
+
+
+def delete_questions(question_ids=None, category_id=None, difficulty=None):
+    '''
+    Delete questions matching every filter given in one transaction
+    Return sorted list of IDs of deleted questions
+    '''
+    table = Question.__table__
+    criteria = []
+    if question_ids is not None:
+        criteria.append(table.c.id.in_(question_ids))
+    if category_id is not None:
+        criteria.append(table.c.category == category_id)
+    if difficulty is not None:
+        criteria.append(table.c.difficulty == difficulty)
+    columns = [table.c.id, table.c.category, table.c.difficulty]
+    engine = db.get_engine()
+    with versioned_transaction([QUESTIONS]) as connection:
+        if connection.dialect.name == 'postgresql':
+            deleted = connection.execute(table.delete().where(
+                and_(*criteria)).returning(*columns)).fetchall()
+        else:
+            begin_write(connection)
+            deleted = connection.execute(
+                select(columns).where(and_(*criteria))).fetchall()
+            for offset in range(0, len(deleted), DELETE_CHUNK_SIZE):
+                connection.execute(table.delete().where(table.c.id.in_([
+                    question_id for question_id, category, difficulty
+                    in deleted[offset:offset + DELETE_CHUNK_SIZE]])))
+        add_question_counts(connection, count_changes(
+            [category for question_id, category, difficulty in deleted],
+            -1))
+    apply_writes(current_app.extensions['trivia_indexes'], str(engine.url),
+                 deleted=deleted)
+    return sorted(question_id for question_id, category, difficulty
+                  in deleted)
+
+
+def export_query(category_id=None, difficulty=None):
+    '''Return streaming query of question rows in ID order'''
+    query = Question.query.with_entities(
+        *[getattr(Question, column) for column in EXPORT_COLUMNS])
+    if category_id is not None:
+        query = query.filter(Question.category == category_id)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    return query.order_by(Question.id).execution_options(
+        stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_questions(query, export_format, header=True):
+    '''
+    Yield text chunks of question rows as NDJSON or CSV, the CSV with a
+    header row unless header is false
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv' and header:
+        writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(query, 1):
+        if export_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n')
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell() > 0:
+        yield buffer.getvalue()
@@ -0,0 +1,311 @@
+'''
+Cache module
+
+In-process caches of data that rarely changes, such as the category map
+and question counts per category. Cached values are tagged with a data
+version, a generation counter per table that committed question and
+category writes bump, and are recomputed once the version moves on.
+
+By default versions are counted in process, so a worker does not see the
+writes of other workers. Its cached values then also expire at the end of
+each CACHE_TTL second period, which bounds how stale they get. With
+DATA_VERSION_TABLE set versions live in the data_versions table and are
+bumped inside the writing transaction, so every worker process sees writes
+made by the others for the cost of one small query per request. Deploy
+more than one worker with DATA_VERSION_TABLE set.
+
+Read endpoints use the versions as strong ETags, so a conditional GET for
+unchanged data is answered 304 before any query or serialization. ETags of
+in-process versions also name the period, so they change with the cached
+values. Only the table records when versions were bumped, so only table
+versions give a Last-Modified date.
+'''
+
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app, g, has_app_context, request, make_response
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import db, Question, Category, DataVersion, QuestionCount
+from .replicas import primary
+
+QUESTIONS = 'questions'
+CATEGORIES = 'categories'
+VERSION_NAMES = {Question: QUESTIONS, Category: CATEGORIES}
+# Seconds cached values live without DATA_VERSION_TABLE
+CACHE_TTL = 5
+
+
+class DataVersions:
+    '''Generation counters of question and category data'''
+
+    def __init__(self, use_table=False, ttl=None):
+        self.use_table = use_table
+        self.ttl = ttl
+        self.local = {QUESTIONS: 0, CATEGORIES: 0}
+        # In-process versions only identify data within this process
+        self.instance = 'db' if use_table else uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+
+    def read_table(self):
+        '''Return dicts of version and update time by name'''
+        with primary():
+            rows = DataVersion.query.all()
+        missing = set(self.local) - {row.name for row in rows}
+        if len(missing) == 0:
+            return ({row.name: row.version for row in rows},
+                    {row.name: row.updated_at for row in rows})
+        for name in missing:
+            db.session.add(DataVersion(name, 0))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker inserted them first
+            db.session.rollback()
+        return self.read_table()
+
+    def load(self):
+        '''Read versions, and update times of the table, once per request'''
+        if 'data_versions' not in g:
+            if self.use_table:
+                g.data_versions, g.data_updated = self.read_table()
+            else:
+                with self.lock:
+                    g.data_versions = dict(self.local)
+                g.data_updated = None
+
+    def current(self):
+        '''Return dict of version by name'''
+        self.load()
+        return g.data_versions
+
+    def updated(self):
+        '''Return dict of last update time by name, None unless in table'''
+        self.load()
+        return g.data_updated
+
+    def etag(self, names):
+        '''Return strong ETag value for data of names'''
+        return version_etag(self.instance, self.current(), names,
+                            None if self.use_table else self.ttl)
+
+    def last_modified(self, names):
+        '''
+        Return last update time of data of names, None unless kept in the
+        table or while writes in the same second could still follow
+        '''
+        updated = self.updated()
+        if updated is None:
+            return None
+        return settled(max(updated[name] for name in names))
+
+    def bump_in_transaction(self, connection, names):
+        '''Bump versions in the writing transaction when kept in the table'''
+        if self.use_table:
+            connection.execute(DataVersion.__table__.update().where(
+                DataVersion.name.in_(names)
+            ).values(version=DataVersion.version + 1,
+                     updated_at=datetime.utcnow()))
+
+    def bump_committed(self, names):
+        '''Bump versions after the writing transaction commits'''
+        with self.lock:
+            for name in names:
+                self.local[name] += 1
+        g.pop('data_versions', None)
+        g.pop('data_updated', None)
+        # Lets replica routing send this client's next reads to the primary
+        g.data_written = True
+
+
+def cache_period(ttl):
+    '''Return number of the current ttl second period, unique if ttl is 0'''
+    if ttl == 0:
+        return time.monotonic_ns()
+    return int(time.monotonic() // ttl)
+
+
+def version_etag(instance, versions, names, ttl=None):
+    '''
+    Return strong ETag value of versions of names, naming the cache period
+    too when cached values expire every ttl seconds
+    '''
+    parts = [instance]
+    if ttl is not None:
+        parts.append(f'p{cache_period(ttl)}')
+    return '-'.join(parts + [f'{name[0]}{versions[name]}'
+                             for name in sorted(names)])
+
+
+def settled(updated):
+    '''
+    Return update time if its second is over, else None
+    HTTP dates have no fractions, so a second write within the second of
+    the date would leave it unchanged
+    '''
+    if updated.replace(microsecond=0) < datetime.utcnow().replace(
+            microsecond=0):
+        return updated
+    return None
+
+
+class VersionedCache:
+    '''
+    Values computed at most once per data version, and at most once per ttl
+    second period if ttl is set
+    '''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key, version, compute):
+        '''Return cached value for key at version, computing it if stale'''
+        period = None if self.ttl is None else cache_period(self.ttl)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version and entry[2] == period:
+            return entry[1]
+        # Read from the primary, as a lagging replica would cache old data
+        # under the new version
+        with primary():
+            value = compute()
+        self.entries[key] = (version, value, period)
+        return value
+
+
+def init_cache(app):
+    '''
+    Add data versions and cache to app, the cache expiring values unless
+    versions are kept in the table
+    '''
+    use_table = app.config.get('DATA_VERSION_TABLE', False)
+    ttl = None if use_table else app.config.get('CACHE_TTL', CACHE_TTL)
+    app.extensions['trivia_cache'] = (DataVersions(use_table, ttl),
+                                      VersionedCache(ttl))
+
+
+def data_versions():
+    '''Return dict of current version by name'''
+    versions, cache = current_app.extensions['trivia_cache']
+    return versions.current()
+
+
+def data_etag(names):
+    '''Return tag of current versions of names, unique across workers'''
+    versions, cache = current_app.extensions['trivia_cache']
+    return versions.etag(names)
+
+
+def cached_categories():
+    '''Return dict of category type by category ID'''
+    versions, cache = current_app.extensions['trivia_cache']
+    return cache.get(
+        CATEGORIES, versions.current()[CATEGORIES],
+        lambda: {category.id: category.type
+                 for category in Category.query.order_by(Category.id)})
+
+
+def cached_question_counts():
+    '''Return dict of question count by category ID, 0 for all questions'''
+    versions, cache = current_app.extensions['trivia_cache']
+
+    def stored_counts():
+        counts = {0: 0}
+        counts.update(QuestionCount.query.with_entities(
+            QuestionCount.category_id, QuestionCount.count).filter(
+            QuestionCount.count != 0))
+        return counts
+
+    return cache.get(QUESTIONS, versions.current()[QUESTIONS],
+                     stored_counts)
+
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+    '''
+    Return True if conditional request headers match current data
+    If-Modified-Since only counts without If-None-Match and with a date
+    '''
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= \
+            if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def conditional(*names):
+    '''
+    Decorate GET view to support conditional requests on data of names
+    Responds 304 from versions alone when the client copy is current
+    '''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions, cache = current_app.extensions['trivia_cache']
+            etag = versions.etag(names)
+            last_modified = versions.last_modified(names)
+            if not_modified(request.if_none_match,
+                            request.if_modified_since, etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            if response.status_code in [200, 304]:
+                response.set_etag(etag)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+                response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def versioned_transaction(names):
+    '''
+    Yield connection in a transaction for writes made outside the ORM,
+    bumping versions of names with them
+    '''
+    versions, cache = current_app.extensions['trivia_cache']
+    with db.get_engine().begin() as connection:
+        yield connection
+        versions.bump_in_transaction(connection, names)
+    versions.bump_committed(names)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_data_changes(session, flush_context):
+    '''Bump table versions in the transaction of flushed writes'''
+    if not has_app_context() or \
+            'trivia_cache' not in current_app.extensions:
+        return
+    names = {VERSION_NAMES[type(instance)]
+             for instance in session.new | session.dirty | session.deleted
+             if type(instance) in VERSION_NAMES}
+    if len(names) == 0:
+        return
+    versions, cache = current_app.extensions['trivia_cache']
+    versions.bump_in_transaction(session.connection(), names)
+    session.info.setdefault('data_changes', set()).update(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_data_changes(session):
+    '''Bump in-process versions once writes are committed'''
+    names = session.info.pop('data_changes', None)
+    if names and has_app_context() and \
+            'trivia_cache' in current_app.extensions:
+        versions, cache = current_app.extensions['trivia_cache']
+        versions.bump_committed(names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_data_changes(session):
+    '''Forget writes that were rolled back'''
+    session.info.pop('data_changes', None)
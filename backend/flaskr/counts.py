@@ -0,0 +1,120 @@
+'''
+Counts module
+
+Question counts per category, kept in the question_counts table so the
+total_questions of a listing is read from one row instead of counted.
+Category 0 counts every question. Question inserts, deletes and category
+changes flushed through the ORM, and bulk imports, add their changes to
+the counts in the transaction that writes the questions, so the counts
+commit or roll back with them.
+
+Writes made outside the app, such as statements in psql or seeding
+scripts, are not counted. reconcile_question_counts, run by flask
+reconcile-counts, counts the questions again and fixes any drift.
+'''
+
+from collections import Counter
+
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.orm import Session
+
+from models import Question, QuestionCount
+from .cache import versioned_transaction, QUESTIONS
+
+ADD_COUNT = text('''
+    INSERT INTO question_counts (category_id, count)
+    VALUES (:category_id, :delta)
+    ON CONFLICT (category_id)
+    DO UPDATE SET count = question_counts.count + excluded.count
+''')
+
+
+def count_changes(category_ids, delta):
+    '''Return Counter of count changes for questions of category IDs'''
+    changes = Counter()
+    for category_id in category_ids:
+        changes[0] += delta
+        if category_id is not None:
+            changes[int(category_id)] += delta
+    return changes
+
+
+def add_question_counts(connection, changes):
+    '''Add Counter of count changes by category ID on connection'''
+    # Rows are updated in category order, so concurrent writers lock them
+    # in the same order and cannot deadlock
+    params = [{'category_id': category_id, 'delta': delta}
+              for category_id, delta in sorted(changes.items())
+              if delta != 0]
+    if len(params) > 0:
+        connection.execute(ADD_COUNT, params)
+
+
+def begin_write(connection):
+    '''
+    Start the write transaction of a SQLite connection now rather than at
+    its first write, so rows it reads stay as read until it commits
+    '''
+    # The driver starts a transaction at the first write, and not before
+    # reads, so one is open only if the connection wrote already
+    if not connection.connection.in_transaction:
+        connection.execute('BEGIN IMMEDIATE')
+
+
+def count_questions(connection):
+    '''Return dict of question count by category ID, counted in full'''
+    counts = {0: 0}
+    for category_id, count in connection.execute(
+            select([Question.category, func.count(Question.id)])
+            .group_by(Question.category)):
+        if category_id is not None:
+            counts[int(category_id)] = count
+        counts[0] += count
+    return counts
+
+
+def reconcile_question_counts():
+    '''
+    Count questions again and fix the counts that drifted
+    Return dict of stored and counted count by category ID of those fixed
+    '''
+    with versioned_transaction([QUESTIONS]) as connection:
+        # Make writers wait until the fixed counts commit, so none is
+        # counted both ways or neither
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                'LOCK TABLE question_counts IN EXCLUSIVE MODE')
+        else:
+            begin_write(connection)
+        counted = count_questions(connection)
+        stored = dict(connection.execute(select(
+            [QuestionCount.category_id, QuestionCount.count])).fetchall())
+        drift = {category_id: (stored.get(category_id, 0),
+                               counted.get(category_id, 0))
+                 for category_id in sorted(set(stored) | set(counted))
+                 if stored.get(category_id, 0) !=
+                 counted.get(category_id, 0)}
+        add_question_counts(connection, Counter({
+            category_id: counted_count - stored_count
+            for category_id, (stored_count, counted_count)
+            in drift.items()}))
+    return drift
+
+
+@event.listens_for(Session, 'after_flush')
+def record_question_count_changes(session, flush_context):
+    '''Add flushed question writes to the counts in their transaction'''
+    changes = Counter()
+    for instance in session.new:
+        if isinstance(instance, Question):
+            changes.update(count_changes([instance.category], 1))
+    for instance in session.deleted:
+        if isinstance(instance, Question):
+            changes.update(count_changes([instance.category], -1))
+    for instance in session.dirty:
+        if isinstance(instance, Question):
+            history = inspect(instance).attrs.category.history
+            if history.has_changes():
+                changes.update(count_changes(history.deleted, -1))
+                changes.update(count_changes(history.added, 1))
+    add_question_counts(session.connection(), changes)
@@ -0,0 +1,208 @@
+'''
+Indexes module
+
+In-process indexes of the questions table, such as the question ID index
+of quizzes. An index is built once, then follows question writes: writes
+committed through the app update it in place, and it is tagged with the
+questions data version it reflects.
+
+Writes it did not see, such as bulk imports or the writes of other
+workers with DATA_VERSION_TABLE set, leave it behind the data version.
+The next request that uses it then catches up by loading only questions
+above the highest ID it holds, while concurrent requests use it as it is
+rather than wait. Without DATA_VERSION_TABLE other workers do not bump the
+version, so an index also catches up every CACHE_TTL seconds.
+
+Writes committed through the ORM, the bulk deletes and the async app all
+go through apply_writes, which hands them to each index and tags it one
+version on, as their transaction bumped the questions version once.
+
+Deletes and category changes made elsewhere cannot be caught up that way.
+An index that then holds another number of questions than the question
+count has missed some, and is rebuilt in a background thread at most every
+INDEX_REBUILD_INTERVAL seconds, while the old one keeps serving.
+'''
+
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Question
+from .cache import cached_question_counts, data_versions, QUESTIONS
+from .replicas import primary
+
+INDEX_REBUILD_INTERVAL = 60
+
+build_lock = threading.Lock()
+
+
+class QuestionIndex(ABC):
+    '''
+    In-process index of questions tagged with the questions data version
+    it reflects and the highest question ID it loaded
+    Subclasses add rows of questions and count the questions they hold
+    '''
+
+    def __init__(self, url, version):
+        self.url = url
+        self.version = version
+        self.max_id = 0
+        self.built_at = self.checked_at = time.monotonic()
+        self.missed_writes = False
+        # Held by the one request catching up, the others do not wait
+        self.catch_up_lock = threading.Lock()
+
+    @abstractmethod
+    def add_rows(self, rows):
+        '''Add rows of questions loaded from the database'''
+
+    @abstractmethod
+    def question_count(self):
+        '''Return number of questions held'''
+
+    @abstractmethod
+    def apply(self, added, deleted):
+        '''
+        Apply committed writes: added or changed questions of ID, category
+        ID, difficulty and text, then deleted questions of ID, category ID
+        and difficulty, the last two None when not known
+        '''
+
+    def behind(self, version, interval=None):
+        '''
+        Return True if the index has not caught up with version, or not
+        within the last interval seconds if interval is set
+        '''
+        return version != self.version or (
+            interval is not None and
+            time.monotonic() - self.checked_at >= interval)
+
+    def catch_up(self, rows, version, total):
+        '''
+        Add rows of questions above the highest ID held and tag the index
+        with version, noting missed writes unless it holds total questions
+        '''
+        self.add_rows(rows)
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.missed_writes = self.question_count() != total
+
+    def rebuild_due(self, interval):
+        '''Return True if the index missed writes and is interval old'''
+        return self.missed_writes and \
+            time.monotonic() - self.built_at >= interval
+
+
+def init_indexes(app):
+    '''Add in-process indexes and their background rebuilds to app'''
+    app.extensions['trivia_indexes'] = {}
+    app.extensions['trivia_index_rebuilds'] = {}
+
+
+def current_index(name, build, rows_after):
+    '''
+    Return in-process index of current app by name, built by
+    build(url, version) on first use, caught up with rows_after(max_id)
+    when behind, and rebuilt in the background once it missed writes
+    '''
+    indexes = current_app.extensions['trivia_indexes']
+    url = str(db.get_engine().url)
+    versions, cache = current_app.extensions['trivia_cache']
+    version = data_versions()[QUESTIONS]
+    index = indexes.get(name)
+    if index is None or index.url != url:
+        with build_lock:
+            index = indexes.get(name)
+            if index is None or index.url != url:
+                with primary():
+                    index = indexes[name] = build(url, version)
+        return index
+    if index.behind(version, versions.ttl) and \
+            index.catch_up_lock.acquire(blocking=False):
+        try:
+            with primary():
+                index.catch_up(rows_after(index.max_id), version,
+                               cached_question_counts()[0])
+        finally:
+            index.catch_up_lock.release()
+    if index.rebuild_due(current_app.config.get(
+            'INDEX_REBUILD_INTERVAL', INDEX_REBUILD_INTERVAL)):
+        rebuild_in_background(name, build)
+    return index
+
+
+def rebuild_in_background(name, build):
+    '''Build index of current app by name again in a thread, unless one is'''
+    app = current_app._get_current_object()
+    rebuilds = app.extensions['trivia_index_rebuilds']
+
+    def rebuild():
+        with app.app_context():
+            url = str(db.get_engine().url)
+            version = data_versions()[QUESTIONS]
+            with primary():
+                index = build(url, version)
+            # Writes committed meanwhile went to the old index, but bumped
+            # the version, so the new one catches up with them
+            app.extensions['trivia_indexes'][name] = index
+
+    with build_lock:
+        thread = rebuilds.get(name)
+        if thread is not None and thread.is_alive():
+            return
+        thread = rebuilds[name] = threading.Thread(
+            target=rebuild, name=f'rebuild-{name}', daemon=True)
+        thread.start()
+
+
+def apply_writes(indexes, url, added=(), deleted=()):
+    '''
+    Apply committed writes of added and deleted questions to every index
+    of dict indexes on database url
+    '''
+    for index in list(indexes.values()):
+        if index.url == url:
+            index.apply(added, deleted)
+            # The writing transaction bumped the questions version once
+            index.version += 1
+
+
+def integer_or_none(value):
+    '''Return value as integer, None if None'''
+    return None if value is None else int(value)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_index_changes(session, flush_context):
+    '''Remember flushed question writes until the transaction commits'''
+    added, deleted = session.info.setdefault('index_changes', ([], []))
+    for instance in session.new | session.dirty:
+        if isinstance(instance, Question):
+            added.append((instance.id, integer_or_none(instance.category),
+                          integer_or_none(instance.difficulty),
+                          instance.question))
+    for instance in session.deleted:
+        if isinstance(instance, Question):
+            # Attributes of a deleted row may no longer load
+            deleted.append((instance.id, None, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_index_changes(session):
+    '''Apply committed question writes to the indexes of current app'''
+    added, deleted = session.info.pop('index_changes', ([], []))
+    if len(added) + len(deleted) == 0 or not has_app_context() or \
+            'trivia_indexes' not in current_app.extensions:
+        return
+    apply_writes(current_app.extensions['trivia_indexes'],
+                 str(session.get_bind().url), added, deleted)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_index_changes(session):
+    '''Forget question writes that were rolled back'''
+    session.info.pop('index_changes', None)
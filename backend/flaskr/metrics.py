@@ -0,0 +1,259 @@
+'''
+Metrics module
+
+Request instrumentation exposed in the Prometheus text format. Every
+request records its wall time in a histogram, and counts the SQL
+statements it executed, the rows they returned, the time spent in them
+and the response bytes, by method, route and status.
+
+Statements are counted by events of the app's engines, listened to only
+when metrics are on, into the request's own counters, so the cost is a
+few clock reads and additions per request and per statement. Rows are
+the row counts the database driver reports, which psycopg2 does for
+every result and SQLite does not. Streamed responses are recorded when
+the stream closes. The connection pool in use and its checkout waits are
+reported too, and so are the hits, misses and size of the search cache.
+Metrics are kept per process.
+'''
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db, pool_status
+
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0]
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+COUNTERS = [
+    ('trivia_sql_statements_total', 'statements',
+     'SQL statements executed by requests'),
+    ('trivia_sql_rows_total', 'rows',
+     'Rows returned by SQL statements of requests'),
+    ('trivia_sql_duration_seconds_total', 'sql_seconds',
+     'Seconds spent in SQL statements of requests'),
+    ('trivia_response_bytes_total', 'response_bytes',
+     'Response body bytes')
+]
+POOL_METRICS = [
+    ('trivia_db_pool_size', 'size', 'gauge',
+     'Connections the pool keeps open'),
+    ('trivia_db_pool_checked_out', 'checked_out', 'gauge',
+     'Connections in use'),
+    ('trivia_db_pool_overflow', 'overflow', 'gauge',
+     'Connections open beyond the pool size'),
+    ('trivia_db_pool_checkouts_total', 'checkouts', 'counter',
+     'Connection checkouts'),
+    ('trivia_db_pool_wait_seconds_total', 'wait_seconds', 'counter',
+     'Seconds checkouts waited for a connection'),
+    ('trivia_db_pool_max_wait_seconds', 'max_wait_seconds', 'gauge',
+     'Longest wait of a checkout for a connection'),
+    ('trivia_db_pool_timeouts_total', 'timeouts', 'counter',
+     'Checkouts that timed out waiting for a connection')
+]
+SEARCH_CACHE_METRICS = [
+    ('trivia_search_cache_hits_total', 'hits', 'counter',
+     'Searches answered from the search cache'),
+    ('trivia_search_cache_misses_total', 'misses', 'counter',
+     'Searches not found in the search cache'),
+    ('trivia_search_cache_evictions_total', 'evictions', 'counter',
+     'Search cache entries evicted to stay within its limits'),
+    ('trivia_search_cache_entries', 'entries', 'gauge',
+     'Entries held by the search cache'),
+    ('trivia_search_cache_bytes', 'bytes', 'gauge',
+     'Bytes held by the search cache')
+]
+
+
+class RequestCounts:
+    '''Counters of one request'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.sql_seconds = 0.0
+        self.statement_start = None
+        self.response_bytes = 0
+
+
+class EndpointMetrics:
+    '''Totals and duration histogram of requests to one endpoint'''
+
+    def __init__(self):
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.requests = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+
+
+class Metrics:
+    '''Metrics of every endpoint of an app'''
+
+    def __init__(self):
+        self.endpoints = defaultdict(EndpointMetrics)
+        self.lock = threading.Lock()
+
+    def record(self, labels, seconds, counts):
+        '''Add request to totals of endpoint labels'''
+        with self.lock:
+            endpoint = self.endpoints[labels]
+            endpoint.buckets[bisect.bisect_left(DURATION_BUCKETS,
+                                                seconds)] += 1
+            endpoint.requests += 1
+            endpoint.seconds += seconds
+            endpoint.statements += counts.statements
+            endpoint.rows += counts.rows
+            endpoint.sql_seconds += counts.sql_seconds
+            endpoint.response_bytes += counts.response_bytes
+
+    def text(self):
+        '''Return metrics in the Prometheus text format'''
+        with self.lock:
+            endpoints = sorted(
+                (labels, vars(endpoint).copy())
+                for labels, endpoint in self.endpoints.items())
+        lines = [
+            '# HELP trivia_request_duration_seconds Request wall time',
+            '# TYPE trivia_request_duration_seconds histogram'
+        ]
+        for labels, endpoint in endpoints:
+            label_text = format_labels(labels)
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ['+Inf'],
+                                    endpoint['buckets']):
+                cumulative += count
+                lines.append(
+                    f'trivia_request_duration_seconds_bucket'
+                    f'{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'trivia_request_duration_seconds_sum'
+                         f'{{{label_text}}} {endpoint["seconds"]}')
+            lines.append(f'trivia_request_duration_seconds_count'
+                         f'{{{label_text}}} {endpoint["requests"]}')
+        for name, field, description in COUNTERS:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, endpoint in endpoints:
+                lines.append(
+                    f'{name}{{{format_labels(labels)}}} {endpoint[field]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    '''Return Prometheus label text of method, route and status'''
+    method, route, status = labels
+    escaped = route.replace('\\', '\\\\').replace('"', '\\"')
+    return f'method="{method}",route="{escaped}",status="{status}"'
+
+
+def init_metrics(app):
+    '''Add request instrumentation to app'''
+    metrics = app.extensions['trivia_metrics'] = Metrics()
+    server_timing = app.config.get('SERVER_TIMING', False)
+    instrument_engines(app)
+
+    @app.before_request
+    def start_request_metrics():
+        # setup_db replaces the engines when the database URL changes
+        instrument_engines(app)
+        g.request_counts = RequestCounts()
+
+    @app.after_request
+    def record_request_metrics(response):
+        counts = g.pop('request_counts', None)
+        if counts is None:
+            return response
+        labels = (request.method,
+                  request.url_rule.rule if request.url_rule else 'unmatched',
+                  str(response.status_code))
+        if server_timing:
+            response.headers['Server-Timing'] = (
+                f'app;dur={(time.perf_counter() - counts.start) * 1000:.2f}, '
+                f'db;dur={counts.sql_seconds * 1000:.2f};'
+                f'desc="{counts.statements} statements"')
+        if not response.is_streamed:
+            counts.response_bytes = response.calculate_content_length() or 0
+            metrics.record(labels, time.perf_counter() - counts.start,
+                           counts)
+            return response
+        # Statements run while streaming still count, by the copy kept in g
+        g.request_counts = counts
+        response.response = counted_chunks(response.response, counts)
+        response.call_on_close(lambda: metrics.record(
+            labels, time.perf_counter() - counts.start, counts))
+        return response
+
+
+def instrument_engines(app):
+    '''Count statements of the engines of app unless they are already'''
+    for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+        engine = db.get_engine(app, bind)
+        if not event.contains(engine, 'after_cursor_execute',
+                              count_statement):
+            event.listen(engine, 'before_cursor_execute', start_statement)
+            event.listen(engine, 'after_cursor_execute', count_statement)
+
+
+def counted_chunks(chunks, counts):
+    '''Yield response chunks, adding their bytes to counts'''
+    for chunk in chunks:
+        counts.response_bytes += len(chunk)
+        yield chunk
+
+
+def metrics_text(app):
+    '''
+    Return metrics of app, its pool and its search cache in the Prometheus
+    text format
+    '''
+    search_cache = app.extensions.get('trivia_search_cache')
+    return app.extensions['trivia_metrics'].text() + \
+        status_text(POOL_METRICS, pool_status()) + \
+        status_text(SEARCH_CACHE_METRICS,
+                    {} if search_cache is None else search_cache.stats())
+
+
+def status_text(metrics, values):
+    '''Return Prometheus text of the metrics found in dict of values'''
+    lines = []
+    for name, field, kind, description in metrics:
+        if field in values:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {values[field]}')
+    return ''.join(line + '\n' for line in lines)
+
+
+def request_counts():
+    '''Return counters of current request, None when not instrumented'''
+    if has_request_context():
+        return g.get('request_counts')
+    return None
+
+
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    '''Start timing a statement of an instrumented request'''
+    counts = request_counts()
+    if counts is not None:
+        counts.statement_start = time.perf_counter()
+
+
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    '''Count a statement of an instrumented request and its rows'''
+    counts = request_counts()
+    if counts is None or counts.statement_start is None:
+        return
+    counts.statements += 1
+    counts.sql_seconds += time.perf_counter() - counts.statement_start
+    counts.statement_start = None
+    if cursor.description is not None and cursor.rowcount > 0:
+        counts.rows += cursor.rowcount
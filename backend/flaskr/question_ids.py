@@ -0,0 +1,293 @@
+'''
+Question IDs module
+
+In-process index of question IDs for quiz serving. Each category and
+difficulty maps to a sorted array of 32 bit IDs, and every question is
+also under category 0 for quizzes over all categories. Random unseen
+questions are picked with a few array lookups, drawing a difficulty from
+an alias table of the selection strategy, and then fetched by primary key.
+
+The index is built when the app is created and follows question writes
+committed through the ORM. Writes it did not see, such as bulk imports or
+writes of other workers, are caught up as the indexes module describes.
+A picked question that turns out deleted or moved is dropped from it.
+Alias tables are rebuilt on first use after the index changes.
+'''
+
+import bisect
+import itertools
+import random
+import sys
+import threading
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from models import db, Question
+from .indexes import QuestionIndex, current_index
+from .selection import AliasTable, bucket_weights, UNIFORM
+
+# Random picks tried per wanted ID before listing unseen IDs, reached only
+# when most IDs of the category are among the previous questions
+SAMPLE_TRIES = 16
+BUILD_BATCH_SIZE = 10000
+QUESTION_IDS = 'question_ids'
+
+
+class QuestionIds(QuestionIndex):
+    '''Sorted question IDs by category ID and difficulty, 0 for all'''
+
+    def __init__(self, url, version):
+        super().__init__(url, version)
+        self.buckets = defaultdict(lambda: array('i'))
+        # Bumped by every change, so alias tables know they are stale
+        self.generation = 0
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, url, version):
+        '''Return index of every question in the database'''
+        index = cls(url, version)
+        if db.engine.dialect.name == 'postgresql':
+            # Sorted ID arrays are aggregated by the database, far faster
+            # than streaming one row per question
+            index.fill_grouped(Question.query.with_entities(
+                Question.category, Question.difficulty,
+                func.array_agg(aggregate_order_by(Question.id, Question.id))
+            ).group_by(Question.category, Question.difficulty))
+            return index
+        index.fill_sorted(Question.query.with_entities(
+            Question.id, Question.category, Question.difficulty
+        ).order_by(Question.id).execution_options(
+            stream_results=True).yield_per(BUILD_BATCH_SIZE))
+        return index
+
+    def fill_grouped(self, rows):
+        '''
+        Fill empty index from rows of category ID, difficulty and sorted
+        list of their question IDs
+        '''
+        merged = defaultdict(list)
+        for category_id, difficulty, ids in rows:
+            if category_id is not None:
+                self.buckets[(category_id, difficulty)] = array('i', ids)
+            merged[difficulty].append(ids)
+        for difficulty, id_lists in merged.items():
+            ids = self.buckets[(0, difficulty)] = array('i', sorted(
+                itertools.chain.from_iterable(id_lists)))
+            self.max_id = max(self.max_id, ids[-1])
+
+    def fill_sorted(self, rows):
+        '''
+        Add rows of question ID, category ID and difficulty in ID order to
+        empty index
+        '''
+        for question_id, category_id, difficulty in rows:
+            self.buckets[(0, difficulty)].append(question_id)
+            if category_id is not None:
+                self.buckets[(category_id, difficulty)].append(question_id)
+            self.max_id = question_id
+
+    def add_rows(self, rows):
+        '''Add rows of question ID, category ID and difficulty'''
+        for question_id, category_id, difficulty in rows:
+            self.add(question_id, category_id, difficulty)
+            self.max_id = max(self.max_id, question_id)
+
+    def question_count(self):
+        '''Return number of questions held'''
+        with self.lock:
+            return sum(len(ids) for (category_id, difficulty), ids
+                       in self.buckets.items() if category_id == 0)
+
+    def add(self, question_id, category_id, difficulty):
+        '''Add question, or move it to its current category and difficulty'''
+        with self.lock:
+            self.discard(question_id)
+            insort(self.buckets[(0, difficulty)], question_id)
+            if category_id is not None:
+                insort(self.buckets[(category_id, difficulty)], question_id)
+
+    def remove(self, question_id):
+        '''Remove question if indexed'''
+        with self.lock:
+            self.discard(question_id)
+
+    def apply(self, added, deleted):
+        for question_id, category_id, difficulty, text in added:
+            self.add(question_id, category_id, difficulty)
+        self.remove_many([question for question in deleted
+                          if question[2] is not None])
+        # Deleted where not known, so looked for in every bucket
+        for question_id, category_id, difficulty in deleted:
+            if difficulty is None:
+                self.remove(question_id)
+
+    def remove_many(self, questions):
+        '''
+        Remove questions of ID, category ID and difficulty at once,
+        rewriting each of their buckets once
+        '''
+        removed = defaultdict(set)
+        for question_id, category_id, difficulty in questions:
+            removed[(0, difficulty)].add(question_id)
+            if category_id is not None:
+                removed[(category_id, difficulty)].add(question_id)
+        with self.lock:
+            self.generation += 1
+            for key, question_ids in removed.items():
+                ids = self.buckets.get(key)
+                if ids is not None:
+                    self.buckets[key] = array('i', (
+                        question_id for question_id in ids
+                        if question_id not in question_ids))
+
+    def discard(self, question_id):
+        '''Remove question from every bucket, caller holds lock'''
+        self.generation += 1
+        for ids in self.buckets.values():
+            position = bisect.bisect_left(ids, question_id)
+            if position < len(ids) and ids[position] == question_id:
+                del ids[position]
+
+    def alias_table(self, category_id, strategy, target):
+        '''
+        Return difficulties and buckets of category that strategy can draw,
+        and alias table drawing one, None if none, caller holds lock
+        '''
+        key = (category_id, strategy, target)
+        entry = self.tables.get(key)
+        if entry is None or entry[0] != self.generation:
+            difficulties = sorted(
+                (difficulty for bucket_category, difficulty in self.buckets
+                 if bucket_category == category_id),
+                key=lambda difficulty: (difficulty is None, difficulty))
+            weights = bucket_weights(strategy, difficulties, [
+                len(self.buckets[(category_id, difficulty)])
+                for difficulty in difficulties], target)
+            drawable = [(difficulty, weight) for difficulty, weight
+                        in zip(difficulties, weights) if weight > 0]
+            entry = self.tables[key] = (
+                self.generation,
+                [difficulty for difficulty, weight in drawable],
+                [self.buckets[(category_id, difficulty)]
+                 for difficulty, weight in drawable],
+                AliasTable([weight for difficulty, weight in drawable])
+                if len(drawable) > 0 else None)
+        return entry[1:]
+
+    def sample_unseen(self, category_id, seen, count, strategy=UNIFORM,
+                      target=None):
+        '''
+        Return up to count distinct random IDs of category not in seen,
+        drawn by strategy among the unseen IDs
+        '''
+        picked = []
+        with self.lock:
+            difficulties, buckets, table = self.alias_table(
+                category_id, strategy, target)
+            if table is None:
+                return picked
+            for _ in range(SAMPLE_TRIES * count):
+                ids = buckets[table.draw()]
+                question_id = ids[random.randrange(len(ids))]
+                if question_id not in seen and question_id not in picked:
+                    picked.append(question_id)
+                    if len(picked) == count:
+                        return picked
+            # Seen holds most of the IDs, or the category has few more than
+            # count, so listing them costs about as much as the request did
+            unseen = [[question_id for question_id in ids
+                       if question_id not in seen and
+                       question_id not in picked] for ids in buckets]
+        while len(picked) < count:
+            weights = bucket_weights(strategy, difficulties,
+                                     [len(ids) for ids in unseen], target)
+            if sum(weights) == 0:
+                break
+            ids = unseen[AliasTable(weights).draw()]
+            picked.append(ids.pop(random.randrange(len(ids))))
+        return picked
+
+    @property
+    def nbytes(self):
+        '''Return bytes allocated for the ID arrays'''
+        with self.lock:
+            return sum(sys.getsizeof(ids) for ids in self.buckets.values())
+
+
+class QuestionDraw:
+    '''
+    Random unseen questions of a category drawn from a question ID index,
+    picked here and loaded by the caller until count are found
+    '''
+
+    def __init__(self, index, category_id, previous_questions, count,
+                 strategy=UNIFORM, target=None):
+        self.index = index
+        self.category_id = category_id
+        self.seen = set(previous_questions)
+        self.count = count
+        self.strategy = strategy
+        self.target = target
+        self.questions = []
+        self.picked = []
+
+    def picks(self):
+        '''Yield lists of IDs to load until count questions are added'''
+        while len(self.questions) < self.count:
+            self.picked = self.index.sample_unseen(
+                self.category_id, self.seen,
+                self.count - len(self.questions), self.strategy,
+                self.target)
+            if len(self.picked) == 0:
+                return
+            yield self.picked
+            self.seen.update(self.picked)
+
+    def add(self, loaded, prune=True):
+        '''
+        Add questions of the last picked IDs from dict of category ID and
+        question by ID loaded, removing IDs not found in the category from
+        the index if prune
+        '''
+        for question_id in self.picked:
+            category_id, question = loaded.get(question_id, (None, None))
+            if question is not None and \
+                    self.category_id in [0, category_id]:
+                self.questions.append(question)
+            elif prune:
+                # Deleted or moved by a write the index did not see
+                self.index.remove(question_id)
+
+
+def insort(ids, question_id):
+    '''Insert ID into sorted array unless present'''
+    position = bisect.bisect_left(ids, question_id)
+    if position == len(ids) or ids[position] != question_id:
+        ids.insert(position, question_id)
+
+
+def init_question_ids(app):
+    '''
+    Build question ID index of app from its database now, unless the schema
+    is still to be created, then on first use
+    '''
+    with app.app_context():
+        if db.engine.has_table(Question.__tablename__):
+            question_ids()
+
+
+def questions_after(max_id):
+    '''Return query of question ID, category ID and difficulty above ID'''
+    return Question.query.with_entities(
+        Question.id, Question.category, Question.difficulty
+    ).filter(Question.id > max_id).order_by(Question.id)
+
+
+def question_ids():
+    '''Return question ID index of app, caught up with writes it missed'''
+    return current_index(QUESTION_IDS, QuestionIds.build, questions_after)
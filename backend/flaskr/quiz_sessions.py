@@ -0,0 +1,263 @@
+'''
+Quiz sessions module
+
+A quiz session plays questions in a pseudo-random order derived from a
+seed, so the client only sends back a small token instead of every
+previous question and the server stores nothing between turns.
+
+The order is a keyed permutation of the question ID space, not of the
+questions that exist when the session starts. Session position 0, 1, 2...
+maps through the permutation to an ID, and IDs that are missing or in
+another category are skipped. Deleted questions are therefore skipped,
+questions added later are played when their position is still ahead, and
+no question is ever played twice.
+
+The ID space is sized with room for questions added during the session.
+Once its positions run out while questions beyond it exist, the session
+extends to a larger ID space under a new permutation, and plays only the
+IDs above the space it covered before.
+'''
+
+import base64
+import binascii
+import random
+
+from sqlalchemy import func
+
+from models import Question
+
+FEISTEL_ROUNDS = 4
+PROBE_BATCH = 64
+MAX_PROBE_BATCH = 4096
+# Below this share of the ID space a category's IDs are ranked directly
+SPARSE_DENSITY = 1 / 64
+MASK_64 = (1 << 64) - 1
+
+
+def mix(value, key):
+    '''Return 64 bit hash of value keyed by key'''
+    value = (value ^ key) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+class Permutation:
+    '''Keyed bijection on the integers 0 to 2 ** bits - 1'''
+
+    def __init__(self, seed, bits):
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [mix(seed, round_number)
+                     for round_number in range(FEISTEL_ROUNDS)]
+
+    def forward(self, position):
+        '''Return question ID at session position'''
+        left = position >> self.half_bits
+        right = position & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (mix(right, key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def inverse(self, question_id):
+        '''Return session position of question ID'''
+        left = question_id >> self.half_bits
+        right = question_id & self.half_mask
+        for key in reversed(self.keys):
+            left, right = right ^ (mix(left, key) & self.half_mask), left
+        return (left << self.half_bits) | right
+
+
+class QuizSession:
+    '''
+    Seed, ID space size and next position of a quiz session, and the IDs
+    below floor covered by the spaces it extended from
+    '''
+
+    def __init__(self, seed, bits, position=0, floor=0):
+        self.seed = seed
+        self.bits = bits
+        self.position = position
+        self.floor = floor
+        self.permutation = Permutation(seed, bits)
+
+    @classmethod
+    def start(cls, seed, max_question_id):
+        '''
+        Return new session for seed
+        The ID space leaves room for questions added during the session
+        '''
+        return cls(seed, space_bits(max_question_id or 0))
+
+    @classmethod
+    def decode(cls, token):
+        '''Return session for token, raise ValueError if not valid'''
+        try:
+            fields = list(map(int, base64.urlsafe_b64decode(
+                token.encode()).decode().split('.')))
+        except (AttributeError, UnicodeError, binascii.Error):
+            raise ValueError('quiz session not valid')
+        # Sessions that never extended have no floor
+        if len(fields) == 3:
+            fields.append(0)
+        if len(fields) != 4:
+            raise ValueError('quiz session not valid')
+        seed, bits, position, floor = fields
+        if bits < 2 or bits > 64 or bits % 2 or position < 0 or \
+                floor < 0 or floor >= 1 << bits:
+            raise ValueError('quiz session not valid')
+        return cls(seed, bits, position, floor)
+
+    def encode(self):
+        '''Return opaque token for session'''
+        fields = [self.seed, self.bits, self.position]
+        if self.floor > 0:
+            fields.append(self.floor)
+        return base64.urlsafe_b64encode(
+            '.'.join(map(str, fields)).encode()).decode()
+
+    @property
+    def size(self):
+        '''Return number of positions in the ID space'''
+        return 1 << self.bits
+
+    def extend(self, max_question_id):
+        '''
+        Move on to an ID space holding max question ID under a new
+        permutation, keeping the IDs covered so far below floor
+        Return False if max question ID is within the ID space already
+        '''
+        if max_question_id is None or max_question_id < self.size:
+            return False
+        self.floor = self.size
+        self.bits = space_bits(max_question_id)
+        self.position = 0
+        self.permutation = Permutation(self.seed, self.bits)
+        return True
+
+    def dense(self, question_count):
+        '''
+        Return True if the next question of question_count questions is
+        found by probing batches of permuted IDs, False by ranking their
+        IDs by session position, None if the session is over
+        '''
+        if question_count == 0:
+            self.position = self.size
+        if self.position >= self.size:
+            return None
+        return question_count >= self.size * SPARSE_DENSITY
+
+    def probes(self):
+        '''
+        Yield dicts of session position by permuted ID of growing batches
+        of positions ahead, moving past each batch the caller asks beyond
+        '''
+        batch = PROBE_BATCH
+        while self.position < self.size:
+            positions = range(self.position,
+                              min(self.position + batch, self.size))
+            probe = {}
+            for position in positions:
+                question_id = self.permutation.forward(position)
+                if question_id >= self.floor:
+                    probe[question_id] = position
+            if len(probe) > 0:
+                yield probe
+            self.position = positions.stop
+            batch = min(batch * 2, MAX_PROBE_BATCH)
+
+    def next_probed(self, probe, found_ids):
+        '''
+        Return first ID of probe in session order among found IDs and
+        advance past it, None if none was found
+        '''
+        if len(found_ids) == 0:
+            return None
+        question_id = min(found_ids, key=probe.__getitem__)
+        self.position = probe[question_id] + 1
+        return question_id
+
+    def next_ranked(self, question_ids):
+        '''
+        Return first of question IDs ahead in session order and advance
+        past it, or None and end the session
+        '''
+        ranked = [(self.permutation.inverse(question_id), question_id)
+                  for question_id in question_ids
+                  if self.floor <= question_id < self.size]
+        ahead = [rank for rank in ranked if rank[0] >= self.position]
+        if len(ahead) == 0:
+            self.position = self.size
+            return None
+        position, question_id = min(ahead)
+        self.position = position + 1
+        return question_id
+
+    def next_question(self, query, question_count):
+        '''
+        Return next question of query in session order and advance, or None
+        Dense queries probe batches of permuted IDs, sparse queries rank
+        their IDs by session position
+        '''
+        dense = self.dense(question_count)
+        question = None
+        if dense:
+            question = self.next_dense_question(query)
+        elif dense is not None:
+            question = self.next_sparse_question(query)
+        if question is None and self.extend(
+                query.with_entities(func.max(Question.id)).scalar()):
+            return self.next_question(query, question_count)
+        return question
+
+    def next_dense_question(self, query):
+        '''Return next question by probing batches of permuted IDs'''
+        for probe in self.probes():
+            questions = {question.id: question for question in
+                         query.filter(Question.id.in_(list(probe)))}
+            question_id = self.next_probed(probe, questions)
+            if question_id is not None:
+                return questions[question_id]
+        return None
+
+    def next_sparse_question(self, query):
+        '''Return next question by ranking all IDs of query'''
+        question_id = self.next_ranked(
+            question_id for question_id, in query.with_entities(Question.id))
+        if question_id is None:
+            return None
+        return query.filter(Question.id == question_id).first()
+
+
+def space_bits(max_question_id):
+    '''
+    Return even number of bits of an ID space holding max question ID
+    with room to grow
+    '''
+    bits = max_question_id.bit_length() + 1
+    return bits + bits % 2
+
+
+def starts_session(quiz_session):
+    '''Return True if quiz session is blank or an integer seed'''
+    return quiz_session == '' or (isinstance(quiz_session, int) and
+                                  not isinstance(quiz_session, bool))
+
+
+def open_session(quiz_session, max_question_id=None):
+    '''
+    Return quiz session started by integer seed or blank for random seed
+    over IDs up to max question ID, or continued by session token
+    Raise ValueError if quiz session is neither
+    '''
+    if starts_session(quiz_session):
+        seed = new_seed() if quiz_session == '' else quiz_session
+        return QuizSession.start(seed, max_question_id)
+    if not isinstance(quiz_session, str):
+        raise ValueError('quiz session not valid')
+    return QuizSession.decode(quiz_session)
+
+
+def new_seed():
+    '''Return random seed for a new session'''
+    return random.getrandbits(63)
@@ -0,0 +1,170 @@
+'''
+Replicas module
+
+Read/write splitting over a read replica. With REPLICA_DATABASE_URL set,
+views marked read_only send the ORM reads of their request to the
+replica bind, while flushes, writes made outside the ORM and every other
+view use the primary. Once a session has flushed, its later reads go to
+the primary too.
+
+A client whose request wrote data gets a cookie that sends its reads to
+the primary for REPLICA_READ_YOUR_WRITES seconds, so it sees its own
+writes while the replica catches up. The replica is checked at most every
+REPLICA_CHECK_INTERVAL seconds, and reads fall back to the primary while
+it is unreachable, lags more than REPLICA_MAX_LAG seconds, or has just
+raised a connection error.
+
+Data tagged with the data versions, such as cached category maps, the
+question ID index and the suggestion index, is always read from the
+primary, so replica lag is never cached under a newer version.
+'''
+
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, setting
+
+READ_PRIMARY_COOKIE = 'trivia_read_primary_until'
+
+
+class ReplicaHealth:
+    '''Replica reachability and lag, checked at most once per interval'''
+
+    def __init__(self, engine, interval, max_lag):
+        self.engine = engine
+        self.interval = interval
+        self.max_lag = max_lag
+        self.healthy = True
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        '''Return True if the replica answers and is not lagging'''
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name != 'postgresql':
+                    connection.execute('SELECT 1')
+                    return True
+                in_recovery, lag = connection.execute(
+                    'SELECT pg_is_in_recovery(), extract(epoch from now() - '
+                    'pg_last_xact_replay_timestamp())').first()
+                return not in_recovery or lag is None or lag <= self.max_lag
+        except Exception:
+            return False
+
+    def is_healthy(self):
+        '''Return replica health, checking again once the interval passed'''
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.interval:
+            with self.lock:
+                if self.checked_at is None or \
+                        now - self.checked_at >= self.interval:
+                    self.healthy = self.check()
+                    self.checked_at = time.monotonic()
+        return self.healthy
+
+    def mark_unhealthy(self):
+        '''Send reads to the primary until the next check'''
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+class Replica:
+    '''Replica engine of an app and its read routing settings'''
+
+    def __init__(self, engine, read_your_writes, health):
+        self.engine = engine
+        self.read_your_writes = read_your_writes
+        self.health = health
+
+
+def init_replicas(app):
+    '''Add replica read routing to app if it has a replica bind'''
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+    if 'replica' not in binds:
+        return
+    engine = db.get_engine(app, 'replica')
+    replica = app.extensions['trivia_replica'] = Replica(
+        engine, setting(app, 'REPLICA_READ_YOUR_WRITES', 5.0),
+        ReplicaHealth(engine, setting(app, 'REPLICA_CHECK_INTERVAL', 5.0),
+                      setting(app, 'REPLICA_MAX_LAG', 30.0)))
+
+    @event.listens_for(engine, 'handle_error')
+    def replica_error(context):
+        if context.is_disconnect:
+            replica.health.mark_unhealthy()
+
+    @app.after_request
+    def read_your_writes(response):
+        '''Send reads of a client that wrote to the primary for a while'''
+        if g.get('data_written') and replica.read_your_writes > 0:
+            response.set_cookie(
+                READ_PRIMARY_COOKIE,
+                str(round(time.time() + replica.read_your_writes, 3)),
+                max_age=math.ceil(replica.read_your_writes), httponly=True,
+                samesite='Lax')
+        return response
+
+
+def read_primary_requested():
+    '''Return True if the client wrote within its read-your-writes window'''
+    try:
+        until = float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def read_from_replica():
+    '''
+    Send the ORM reads of the current request to the replica, unless there
+    is none, it is unhealthy or the client needs to read its own writes
+    '''
+    replica = current_app.extensions.get('trivia_replica')
+    if replica is None or read_primary_requested() or \
+            not replica.health.is_healthy():
+        return
+    db.session.info['replica'] = replica.engine
+
+
+def on_replica():
+    '''Return True if reads of the current session go to the replica'''
+    return has_app_context() and 'replica' in db.session.info
+
+
+def read_only(view):
+    '''Decorate view to read from the replica'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        read_from_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary():
+    '''Send the reads of the session to the primary within the block'''
+    if not has_app_context():
+        yield
+        return
+    info = db.session.info
+    replica = info.pop('replica', None)
+    try:
+        yield
+    finally:
+        if replica is not None and not info.get('flushed'):
+            info['replica'] = replica
+
+
+@event.listens_for(Session, 'after_flush')
+def stop_replica_reads(session, flush_context):
+    '''Read from the primary once the session has written'''
+    session.info.pop('replica', None)
+    session.info['flushed'] = True
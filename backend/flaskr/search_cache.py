@@ -0,0 +1,237 @@
+'''
+Search cache module
+
+Cache of search result pages, so popular search terms are not searched
+again on every request. Entries hold the encoded response body, keyed by
+the normalized search term, the page or cursor and the requested fields,
+and tagged with the questions data version, so any question write makes
+them stale.
+
+By default entries are kept in process in least recently used order,
+bounded by SEARCH_CACHE_MAX_BYTES and SEARCH_CACHE_MAX_ENTRIES, and expire
+after SEARCH_CACHE_TTL seconds if set. With SEARCH_CACHE_PATH set they are
+kept in a SQLite file instead, shared by the worker processes of a host.
+Sharing needs DATA_VERSION_TABLE, or each worker tags entries with its
+own versions and only hits its own.
+'''
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+SEARCH_CACHE_MAX_BYTES = 16 * 1024 * 1024
+SEARCH_CACHE_MAX_ENTRIES = 10000
+# Bytes counted per entry on top of its key and body, for the dict entry,
+# tuple and objects holding them
+ENTRY_OVERHEAD = 200
+# Seconds between last used updates of a shared entry, to spare writes
+TOUCH_INTERVAL = 1.0
+
+
+class SearchCache:
+    '''Hit, miss and eviction counters of a search cache'''
+
+    def __init__(self, max_bytes, max_entries, ttl):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def expires(self):
+        '''Return expiry time of an entry stored now, None if none'''
+        return None if self.ttl is None else time.monotonic() + self.ttl
+
+    def stats(self):
+        '''Return dict of counters, entries and bytes held'''
+        entries, size = self.usage()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size
+        }
+
+
+class LocalSearchCache(SearchCache):
+    '''Search cache in process memory'''
+
+    def __init__(self, max_bytes, max_entries, ttl=None):
+        super().__init__(max_bytes, max_entries, ttl)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        '''Return body cached for key at version, None if none'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version or \
+                    (entry[2] is not None and entry[2] <= time.monotonic()):
+                self.misses += 1
+                if entry is not None:
+                    self.discard(key)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        '''Cache body for key at version, evicting least recently used'''
+        size = len(key) + len(body) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (version, body, self.expires(), size)
+            self.size += size
+            while self.size > self.max_bytes or \
+                    len(self.entries) > self.max_entries:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key):
+        '''Remove entry of key if cached, caller holds lock'''
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+    def usage(self):
+        '''Return number of entries and bytes held'''
+        with self.lock:
+            return len(self.entries), self.size
+
+
+class SharedSearchCache(SearchCache):
+    '''Search cache in a SQLite file shared by the processes of a host'''
+
+    def __init__(self, path, max_bytes, max_entries, ttl=None):
+        super().__init__(max_bytes, max_entries, ttl)
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    key TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL,
+                    used REAL NOT NULL
+                )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS '
+                               'ix_search_cache_used ON search_cache (used)')
+
+    def connection(self):
+        '''Return SQLite connection of the current thread'''
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(
+                self.path, timeout=1.0)
+            # A cache can lose its last writes in a crash
+            connection.execute('PRAGMA synchronous=OFF')
+        return connection
+
+    def get(self, key, version):
+        '''Return body cached for key at version, None if none'''
+        now = time.time()
+        try:
+            with self.connection() as connection:
+                entry = connection.execute(
+                    'SELECT version, body, expires, used FROM search_cache '
+                    'WHERE key = ?', (key,)).fetchone()
+                if entry is None or entry[0] != version or \
+                        (entry[2] is not None and entry[2] <= now):
+                    self.misses += 1
+                    if entry is not None:
+                        connection.execute(
+                            'DELETE FROM search_cache WHERE key = ?', (key,))
+                    return None
+                if entry[3] < now - TOUCH_INTERVAL:
+                    connection.execute(
+                        'UPDATE search_cache SET used = ? WHERE key = ?',
+                        (now, key))
+        except sqlite3.OperationalError:
+            # Locked by another process for longer than the timeout
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, body):
+        '''Cache body for key at version, evicting least recently used'''
+        size = len(key) + len(body) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        try:
+            with self.connection() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO search_cache '
+                    '(key, version, body, size, expires, used) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, version, body, size, expires, now))
+                entries, total = connection.execute(
+                    'SELECT COUNT(*), TOTAL(size) FROM search_cache'
+                ).fetchone()
+                while entries > self.max_entries or total > self.max_bytes:
+                    oldest = connection.execute(
+                        'SELECT key, size FROM search_cache '
+                        'ORDER BY used LIMIT 1').fetchone()
+                    connection.execute(
+                        'DELETE FROM search_cache WHERE key = ?',
+                        (oldest[0],))
+                    entries -= 1
+                    total -= oldest[1]
+                    self.evictions += 1
+        except sqlite3.OperationalError:
+            pass
+
+    def usage(self):
+        '''Return number of entries and bytes held'''
+        entries, total = self.connection().execute(
+            'SELECT COUNT(*), TOTAL(size) FROM search_cache').fetchone()
+        return entries, int(total)
+
+
+def init_search_cache(app):
+    '''Add search cache to app, none if SEARCH_CACHE_MAX_BYTES is 0'''
+    max_bytes = app.config.get('SEARCH_CACHE_MAX_BYTES',
+                               SEARCH_CACHE_MAX_BYTES)
+    max_entries = app.config.get('SEARCH_CACHE_MAX_ENTRIES',
+                                 SEARCH_CACHE_MAX_ENTRIES)
+    ttl = app.config.get('SEARCH_CACHE_TTL')
+    path = app.config.get('SEARCH_CACHE_PATH')
+    if max_bytes == 0 or max_entries == 0:
+        cache = None
+    elif path is not None:
+        cache = SharedSearchCache(os.path.abspath(path), max_bytes,
+                                  max_entries, ttl)
+    else:
+        cache = LocalSearchCache(max_bytes, max_entries, ttl)
+    app.extensions['trivia_search_cache'] = cache
+
+
+def search_cache():
+    '''Return search cache of current app, None if disabled'''
+    return current_app.extensions.get('trivia_search_cache')
+
+
+def search_key(search_term, page, after, fields):
+    '''
+    Return cache key of search results page, the same for terms that
+    search for the same words
+    '''
+    words = re.findall(r'\w+', search_term.lower())
+    term = ' '.join(words) if len(words) > 0 else search_term.lower()
+    return json.dumps([term, page, after, fields], separators=(',', ':'))
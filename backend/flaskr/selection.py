@@ -0,0 +1,78 @@
+'''
+Selection module
+
+Strategies for drawing quiz questions by difficulty. Questions of a
+category are held in one bucket per difficulty, and a strategy gives
+each bucket a weight:
+
+    uniform   the bucket size, so every question is equally likely
+    weighted  the bucket size times DIFFICULTY_WEIGHTS, so a question is
+              as likely as its difficulty weight
+    adaptive  a bell curve around a target difficulty that follows the
+              share of answers the player got right, whatever the sizes
+
+A Walker alias table over the bucket weights draws a bucket in constant
+time, then a question is drawn uniformly within the bucket.
+'''
+
+import math
+import random
+
+UNIFORM = 'uniform'
+WEIGHTED = 'weighted'
+ADAPTIVE = 'adaptive'
+STRATEGIES = [UNIFORM, WEIGHTED, ADAPTIVE]
+DIFFICULTY_WEIGHTS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5}
+# Standard deviation in difficulty levels of the adaptive bell curve
+ADAPTIVE_SPREAD = 1.0
+
+
+class AliasTable:
+    '''Walker alias table drawing index i with chance weights[i] / sum'''
+
+    def __init__(self, weights):
+        size = len(weights)
+        total = sum(weights)
+        self.probability = [1.0] * size
+        self.alias = list(range(size))
+        scaled = [weight * size / total for weight in weights]
+        small = [i for i, share in enumerate(scaled) if share < 1]
+        large = [i for i, share in enumerate(scaled) if share >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+    def draw(self):
+        '''Return random index'''
+        i = random.randrange(len(self.probability))
+        return i if random.random() < self.probability[i] else self.alias[i]
+
+
+def target_difficulty(correct, incorrect):
+    '''
+    Return difficulty from 1 to 5 matching the share of correct answers,
+    to one decimal place, starting from 3 with no answers
+    '''
+    share = (correct + 1) / (correct + incorrect + 2)
+    return round(1 + 4 * share, 1)
+
+
+def bucket_weights(strategy, difficulties, sizes, target=None):
+    '''
+    Return weight of each difficulty bucket of sizes for strategy
+    Questions without a difficulty are only drawn by the uniform strategy
+    '''
+    if strategy == UNIFORM:
+        return list(sizes)
+    if strategy == WEIGHTED:
+        return [size * DIFFICULTY_WEIGHTS.get(difficulty, 0)
+                for difficulty, size in zip(difficulties, sizes)]
+    return [
+        math.exp(-((difficulty - target) / ADAPTIVE_SPREAD) ** 2 / 2)
+        if size > 0 and difficulty is not None else 0
+        for difficulty, size in zip(difficulties, sizes)
+    ]
@@ -0,0 +1,179 @@
+'''
+Suggest module
+
+Autocomplete for the question search box. Both backends follow one rule:
+a suggestion contains the prefix, ignoring case, and prefixes shorter than
+MIN_PREFIX_LENGTH get none. Texts where the prefix starts a word come
+first, then shorter texts, then lower IDs.
+
+On PostgreSQL with the pg_trgm extension suggestions come from a trigram
+index on question text, which serves any prefix of 3 characters or more.
+Anywhere else they come from an in-process n-gram index of trigrams, which
+catches up with writes it missed as the indexes module describes.
+'''
+
+import heapq
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import case, func
+
+from models import db, Question
+from .indexes import QuestionIndex, current_index
+
+SUGGEST_LIMIT = 10
+MAX_SUGGEST_LIMIT = 50
+# Shorter prefixes have no trigram, so neither index could serve them
+MIN_PREFIX_LENGTH = 3
+NGRAMS = 'ngrams'
+
+trigram_databases = {}
+
+
+def grams(text):
+    '''Return set of trigrams of lowercase text'''
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def suggestable(prefix):
+    '''Return True if prefix is long enough to get suggestions'''
+    return prefix.strip() != '' and len(prefix) >= MIN_PREFIX_LENGTH
+
+
+def starts_word(text, prefix):
+    '''Return True if lowercase prefix starts a word of lowercase text'''
+    position = text.find(prefix)
+    while position >= 0:
+        if position == 0 or not text[position - 1].isalnum():
+            return True
+        position = text.find(prefix, position + 1)
+    return False
+
+
+def word_start_pattern(prefix):
+    '''Return PostgreSQL regular expression of prefix starting a word'''
+    return '(^|[^[:alnum:]])' + re.escape(prefix.lower())
+
+
+class NGramIndex(QuestionIndex):
+    '''Index of question text by trigram for substring suggestions'''
+
+    def __init__(self, url, version):
+        super().__init__(url, version)
+        self.texts = {}
+        self.postings = defaultdict(set)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, url, version):
+        '''Return index of every question in the database'''
+        index = cls(url, version)
+        index.add_rows(Question.query.with_entities(
+            Question.id, Question.question).yield_per(1000))
+        return index
+
+    def add_rows(self, rows):
+        '''Add rows of question ID and text'''
+        for question_id, text in rows:
+            self.add(question_id, text)
+            self.max_id = max(self.max_id, question_id)
+
+    def question_count(self):
+        '''Return number of questions held'''
+        with self.lock:
+            return len(self.texts)
+
+    def add(self, question_id, text):
+        '''Add or replace question text'''
+        with self.lock:
+            self.discard(question_id)
+            # Questions without text are held too, so the count adds up
+            text = text or ''
+            self.texts[question_id] = text
+            for key in grams(text):
+                self.postings[key].add(question_id)
+
+    def apply(self, added, deleted):
+        for question_id, category_id, difficulty, text in added:
+            self.add(question_id, text)
+        for question_id, category_id, difficulty in deleted:
+            self.remove(question_id)
+
+    def remove(self, question_id):
+        '''Remove question text if indexed'''
+        with self.lock:
+            self.discard(question_id)
+
+    def discard(self, question_id):
+        '''Remove question text, caller holds lock'''
+        text = self.texts.pop(question_id, None)
+        if text is None:
+            return
+        for key in grams(text):
+            posting = self.postings[key]
+            posting.discard(question_id)
+            if len(posting) == 0:
+                del self.postings[key]
+
+    def suggest(self, prefix, limit):
+        '''
+        Return up to limit question texts containing prefix of at least
+        MIN_PREFIX_LENGTH characters, in suggestion order
+        '''
+        prefix = prefix.lower()
+        with self.lock:
+            postings = sorted((self.postings.get(key, set())
+                               for key in grams(prefix)), key=len)
+            candidates = set.intersection(*postings) if postings else set()
+            matches = []
+            for question_id in candidates:
+                text = self.texts[question_id]
+                lowered = text.lower()
+                if prefix not in lowered:
+                    continue
+                matches.append((not starts_word(lowered, prefix), len(text),
+                                question_id, text))
+        return [match[3] for match in heapq.nsmallest(limit, matches)]
+
+
+def has_trigram_index(engine):
+    '''Return True if database has the pg_trgm extension'''
+    url = str(engine.url)
+    if url not in trigram_databases:
+        trigram_databases[url] = (
+            engine.dialect.name == 'postgresql' and
+            engine.execute("SELECT 1 FROM pg_extension "
+                           "WHERE extname = 'pg_trgm'").scalar() is not None
+        )
+    return trigram_databases[url]
+
+
+def questions_after(max_id):
+    '''Return query of question ID and text above ID'''
+    return Question.query.with_entities(
+        Question.id, Question.question
+    ).filter(Question.id > max_id).order_by(Question.id)
+
+
+def ngram_index():
+    '''Return n-gram index of app, caught up with writes it missed'''
+    return current_index(NGRAMS, NGramIndex.build, questions_after)
+
+
+def suggest_questions(prefix, limit=SUGGEST_LIMIT):
+    '''Return up to limit question texts containing prefix'''
+    if not suggestable(prefix):
+        return []
+    if not has_trigram_index(db.get_engine()):
+        return ngram_index().suggest(prefix, limit)
+    escaped = re.sub(r'([\\%_])', r'\\\1', prefix)
+    questions = Question.query.with_entities(Question.question).filter(
+        Question.question.ilike(f'%{escaped}%')
+    ).order_by(
+        case([(func.lower(Question.question).op('~')(
+            word_start_pattern(prefix)), 0)], else_=1),
+        func.length(Question.question), Question.id
+    ).limit(limit)
+    return [question for question, in questions]
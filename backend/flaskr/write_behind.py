@@ -0,0 +1,339 @@
+'''
+Write-behind module
+
+Optional queue for question creation. With WRITE_BEHIND set, POST
+/questions validates a question, queues it and answers 202 Accepted with
+a token and a status URL, instead of inserting it and waiting for the
+commit. A background thread inserts queued questions in batches, one
+transaction per batch, once WRITE_BEHIND_BATCH_SIZE questions are queued
+or the oldest has waited WRITE_BEHIND_INTERVAL seconds. Batches are
+inserted through the ORM, so question counts, data versions and the
+in-process indexes follow them like any other insert. Queued questions
+are not listed, searched or played until their batch commits.
+
+With WRITE_BEHIND_JOURNAL set, every queued question is appended to that
+file and synced to disk before it is accepted, and the tokens of each
+batch are appended once it commits. Questions still pending in the
+journal when the app starts are queued again, so accepted questions
+survive a crash. A crash between a commit and its journal record inserts
+that batch again. Each worker process needs its own journal file.
+'''
+
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from flask import current_app
+from sqlalchemy import exc
+
+from models import db, Question
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_INTERVAL = 0.05
+# Seconds to wait before inserting a batch again after a database error
+RETRY_DELAY = 1.0
+# Statuses of inserted questions kept for their status URL
+STATUS_LIMIT = 10000
+# Seconds an exiting process waits for the questions still queued
+CLOSE_TIMEOUT = 10.0
+
+
+class Journal:
+    '''Append-only file of queued questions and inserted tokens'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = locked_file(path, 'a+')
+
+    def replay(self):
+        '''
+        Return list of token and values of questions queued but not
+        inserted, and replace the journal with one of only those
+        '''
+        self.file.seek(0)
+        queued = OrderedDict()
+        for line in self.file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line cut short by a crash, never accepted
+                continue
+            if 'values' in record:
+                queued[record['token']] = record['values']
+            else:
+                for token in record['inserted']:
+                    queued.pop(token, None)
+        # Written beside the journal and renamed over it once on disk, so a
+        # crash leaves either journal whole
+        compacted = locked_file(self.path + '.replay', 'w+')
+        try:
+            for token, values in queued.items():
+                compacted.write(json.dumps({'token': token, 'values': values},
+                                           separators=(',', ':')) + '\n')
+            compacted.flush()
+            os.fsync(compacted.fileno())
+            os.replace(compacted.name, self.path)
+        except BaseException:
+            compacted.close()
+            raise
+        sync_directory(self.path)
+        self.file.close()
+        self.file = compacted
+        return list(queued.items())
+
+    def write(self, record):
+        '''Append record, caller holds the queue lock'''
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+
+    def sync(self):
+        '''Sync written records to disk, for every writer at once'''
+        os.fsync(self.file.fileno())
+
+    def truncate(self):
+        '''Empty the journal, caller holds the queue lock'''
+        self.file.seek(0)
+        self.file.truncate()
+
+    def close(self):
+        '''Close the journal file, releasing its lock'''
+        self.file.close()
+
+
+def locked_file(path, mode):
+    '''
+    Return file of path opened in mode and locked against other processes
+    Raise RuntimeError if another process holds the lock
+    '''
+    file = open(path, mode, encoding='utf-8')
+    if fcntl is not None:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            raise RuntimeError(
+                f'Write-behind journal {path} is used by another process')
+    return file
+
+
+def sync_directory(path):
+    '''Sync the directory entry of path to disk where the system can'''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class WriteBehindQueue:
+    '''Questions waiting to be inserted in batches by a background thread'''
+
+    def __init__(self, app, batch_size, interval, journal=None):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.journal = journal
+        # Token, column values and queue time of questions not inserted
+        self.pending = deque()
+        # Tokens of questions pending or in the batch being inserted
+        self.waiting = set()
+        self.statuses = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+        if journal is not None:
+            for token, values in journal.replay():
+                self.pending.append((token, values, time.monotonic()))
+                self.waiting.add(token)
+        self.thread = threading.Thread(target=self.run, name='write-behind',
+                                       daemon=True)
+        self.thread.start()
+
+    def put(self, values):
+        '''Queue question column values, return token of the question'''
+        token = uuid.uuid4().hex
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Write-behind queue is closed')
+            # Nothing would insert it, so refuse it rather than lose it
+            if not self.thread.is_alive():
+                raise RuntimeError('Write-behind thread stopped')
+            if self.journal is not None:
+                self.journal.write({'token': token, 'values': values})
+            self.pending.append((token, values, time.monotonic()))
+            self.waiting.add(token)
+            # Start the interval of a first question, or insert a full batch
+            if len(self.pending) in [1, self.batch_size]:
+                self.condition.notify()
+        if self.journal is not None:
+            self.journal.sync()
+        return token
+
+    def status(self, token):
+        '''Return dict of status of question token, None if unknown'''
+        with self.condition:
+            if token in self.waiting:
+                return {'status': 'pending'}
+            return self.statuses.get(token)
+
+    def size(self):
+        '''Return number of questions not inserted yet'''
+        with self.condition:
+            return len(self.waiting)
+
+    def wait_time(self):
+        '''
+        Return seconds until the next batch is due, 0 if due now, None
+        if nothing is queued, caller holds the lock
+        '''
+        if len(self.pending) >= self.batch_size or \
+                (self.closed and len(self.pending) > 0):
+            return 0
+        if len(self.pending) == 0:
+            return None
+        return max(0, self.pending[0][2] + self.interval - time.monotonic())
+
+    def run(self):
+        '''Insert batches as they become due until closed and empty'''
+        while True:
+            with self.condition:
+                wait_time = self.wait_time()
+                while wait_time != 0:
+                    if self.closed and wait_time is None:
+                        return
+                    self.condition.wait(wait_time)
+                    wait_time = self.wait_time()
+                batch = [self.pending.popleft() for _ in
+                         range(min(self.batch_size, len(self.pending)))]
+            try:
+                with self.app.app_context():
+                    try:
+                        statuses = self.insert(batch)
+                    finally:
+                        db.session.remove()
+            except exc.SQLAlchemyError:
+                self.app.logger.exception(
+                    'Write-behind batch of %d questions failed, retrying',
+                    len(batch))
+                statuses = {}
+            except Exception:
+                # Not a database error, so retrying would fail the same way
+                self.app.logger.exception(
+                    'Write-behind batch of %d questions failed', len(batch))
+                statuses = {token: {'status': 'failed'}
+                            for token, values, queued in batch}
+            if len(statuses) > 0:
+                self.finish(statuses)
+            # Only questions that did not commit are inserted again
+            retry = [item for item in batch if item[0] not in statuses]
+            if len(retry) > 0:
+                with self.condition:
+                    self.pending.extendleft(reversed(retry))
+                    self.condition.wait(RETRY_DELAY)
+
+    def insert(self, batch):
+        '''
+        Insert batch in one transaction, else each question on its own when
+        some are not valid for the database or fail otherwise
+        Return dict of status by token, failed for the questions that fail
+        and missing for those left by a database error worth retrying
+        Raise SQLAlchemyError for such errors before any question commits
+        '''
+        try:
+            questions = [Question(**values)
+                         for token, values, queued in batch]
+            db.session.add_all(questions)
+            db.session.commit()
+        except exc.SQLAlchemyError as error:
+            db.session.rollback()
+            if not isinstance(error, (exc.IntegrityError, exc.DataError)):
+                raise
+            return self.insert_each(batch)
+        except Exception:
+            db.session.rollback()
+            return self.insert_each(batch)
+        return {token: {'status': 'created', 'created': question.id}
+                for (token, values, queued), question
+                in zip(batch, questions)}
+
+    def insert_each(self, batch):
+        '''
+        Insert each question of a batch that failed on its own, stopping at
+        a database error worth retrying
+        Return dict of status by token of the questions done
+        '''
+        if len(batch) > 1:
+            statuses = {}
+            for index, item in enumerate(batch):
+                try:
+                    statuses.update(self.insert([item]))
+                except exc.SQLAlchemyError:
+                    self.app.logger.exception(
+                        'Write-behind question failed, retrying %d',
+                        len(batch) - index)
+                    break
+            return statuses
+        self.app.logger.exception('Write-behind question not inserted')
+        return {batch[0][0]: {'status': 'failed'}}
+
+    def finish(self, statuses):
+        '''Record statuses of an inserted batch'''
+        with self.condition:
+            for token, status in statuses.items():
+                self.waiting.discard(token)
+                self.statuses[token] = status
+            while len(self.statuses) > STATUS_LIMIT:
+                self.statuses.popitem(last=False)
+            if self.journal is not None:
+                if len(self.waiting) == 0:
+                    self.journal.truncate()
+                else:
+                    self.journal.write({'inserted': list(statuses)})
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self, timeout=None):
+        '''Insert the questions still queued and stop the thread'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        if self.journal is not None and not self.thread.is_alive():
+            self.journal.close()
+
+
+def init_write_behind(app):
+    '''Add write-behind queue to app if WRITE_BEHIND is set'''
+    if not app.config.get('WRITE_BEHIND', False):
+        return
+    path = app.config.get('WRITE_BEHIND_JOURNAL')
+    journal = None if path is None else Journal(os.path.abspath(path))
+    try:
+        queue = WriteBehindQueue(
+            app,
+            app.config.get('WRITE_BEHIND_BATCH_SIZE',
+                           WRITE_BEHIND_BATCH_SIZE),
+            app.config.get('WRITE_BEHIND_INTERVAL', WRITE_BEHIND_INTERVAL),
+            journal)
+    except BaseException:
+        # Release the journal for the next start to replay
+        if journal is not None:
+            journal.close()
+        raise
+    app.extensions['trivia_write_behind'] = queue
+    atexit.register(queue.close, CLOSE_TIMEOUT)
+
+
+def write_behind():
+    '''Return write-behind queue of current app, None if not enabled'''
+    return current_app.extensions.get('trivia_write_behind')
@@ -1,23 +1,458 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index
+from sqlalchemy import create_engine, inspect
+from sqlalchemy import func, literal_column, table, column, exc, text
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import orm
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
-database_path = "postgresql://{}/{}".format('localhost:5432', database_name)
+default_database_path = "postgresql://{}/{}".format(
+  'localhost:5432', database_name)
 
-db = SQLAlchemy()
+'''
+RoutingSession
+    session sending the reads of queries to the engine in info['replica']
+    when one is set, and everything else, such as flushes and plain
+    get_bind() calls, to the primary
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replica = self.info.get('replica')
+    if replica is not None and not self._flushing and \
+        (mapper is not None or clause is not None):
+      return replica
+    return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
+db = RoutingSQLAlchemy()
+
+'''
+as_bool(value)
+    returns value as a boolean, strings such as 'true', 'yes', 'on' and '1'
+    being true
 '''
-setup_db(app)
+def as_bool(value):
+  if isinstance(value, str):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+  return bool(value)
+
+'''
+setup_db(app, database_path, create)
     binds a flask application and a SQLAlchemy service
+    The database URL, pool and statement timeout settings are taken from
+    the app config, as set by test_config, else from environment variables
+    of the same names; see DATABASE_SETTINGS. REPLICA_DATABASE_URL adds a
+    replica bind for reads. Tables and search indexes are only created,
+    on the primary, when create or the CREATE_SCHEMA setting is true
+'''
+DATABASE_SETTINGS = {
+  'DATABASE_URL': str,
+  'REPLICA_DATABASE_URL': str,
+  'REPLICA_READ_YOUR_WRITES': float,
+  'REPLICA_CHECK_INTERVAL': float,
+  'REPLICA_MAX_LAG': float,
+  'DB_POOL_SIZE': int,
+  'DB_MAX_OVERFLOW': int,
+  'DB_POOL_TIMEOUT': float,
+  'DB_POOL_RECYCLE': int,
+  'DB_POOL_PRE_PING': as_bool,
+  'DB_STATEMENT_TIMEOUT': int,
+  'CREATE_SCHEMA': as_bool
+}
+
+def setup_db(app, database_path=None, create=None):
+  if database_path is None:
+    database_path = setting(app, 'DATABASE_URL', default_database_path)
+  app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+  replica_path = setting(app, 'REPLICA_DATABASE_URL')
+  app.config["SQLALCHEMY_BINDS"] = \
+    {'replica': replica_path} if replica_path else None
+  app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+  app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, database_path)
+  db.app = app
+  db.init_app(app)
+  if create is None:
+    create = setting(app, 'CREATE_SCHEMA', False)
+  if create:
+    create_schema()
+
+'''
+setting(app, name, default)
+    returns setting name of DATABASE_SETTINGS from the app config, else
+    from the environment, converted to its type, else default
+'''
+def setting(app, name, default=None):
+  value = app.config.get(name)
+  if value is None:
+    value = os.environ.get(name)
+  if value is None or value == '':
+    return default
+  return DATABASE_SETTINGS[name](value)
+
+'''
+engine_options(app, database_path)
+    returns create_engine options of the pool settings of app
+    SQLite keeps the pool Flask-SQLAlchemy picks, as it has no server to
+    run out of connections on
+'''
+def engine_options(app, database_path):
+  options = {}
+  pre_ping = setting(app, 'DB_POOL_PRE_PING')
+  if pre_ping is not None:
+    options['pool_pre_ping'] = pre_ping
+  if database_path.startswith('sqlite'):
+    return options
+  options['poolclass'] = TimedQueuePool
+  for name, option in [('DB_POOL_SIZE', 'pool_size'),
+                       ('DB_MAX_OVERFLOW', 'max_overflow'),
+                       ('DB_POOL_TIMEOUT', 'pool_timeout'),
+                       ('DB_POOL_RECYCLE', 'pool_recycle')]:
+    value = setting(app, name)
+    if value is not None:
+      options[option] = value
+  statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT')
+  if statement_timeout is not None and database_path.startswith('postgres'):
+    options['connect_args'] = {
+      'options': '-c statement_timeout={}'.format(statement_timeout)
+    }
+  return options
+
+'''
+create_schema()
+    creates missing tables and the search indexes, and counts the
+    questions of a new question_counts table
+'''
+def create_schema():
+  counts_missing = not db.engine.has_table('question_counts')
+  db.create_all()
+  if counts_missing:
+    fill_question_counts()
+  create_search_index()
+  create_trigram_index()
+
+'''
+fill_question_counts()
+    counts the questions of every category into the empty question_counts
+    table, and every question under category 0
+'''
+def fill_question_counts():
+  with db.engine.begin() as connection:
+    connection.execute(text('''
+      INSERT INTO question_counts (category_id, count)
+      SELECT 0, COUNT(*) FROM questions
+    '''))
+    connection.execute(text('''
+      INSERT INTO question_counts (category_id, count)
+      SELECT category, COUNT(*) FROM questions
+      WHERE category IS NOT NULL GROUP BY category
+    '''))
+
+'''
+PoolWaits
+    count, total and longest time of connection checkouts of a pool, and
+    the checkouts that timed out, including the time to open connections
+'''
+class PoolWaits:
+  def __init__(self):
+    self.checkouts = 0
+    self.seconds = 0.0
+    self.max_seconds = 0.0
+    self.timeouts = 0
+    self.lock = threading.Lock()
+
+  def record(self, seconds, timed_out=False):
+    with self.lock:
+      self.checkouts += 1
+      self.seconds += seconds
+      self.max_seconds = max(self.max_seconds, seconds)
+      if timed_out:
+        self.timeouts += 1
+
+  def status(self):
+    with self.lock:
+      return {
+        'checkouts': self.checkouts,
+        'wait_seconds': self.seconds,
+        'max_wait_seconds': self.max_seconds,
+        'timeouts': self.timeouts
+      }
+
+'''
+TimedQueuePool
+    QueuePool that records how long each checkout waits for a connection
+'''
+class TimedQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.waits = PoolWaits()
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      connection = super()._do_get()
+    except exc.TimeoutError:
+      self.waits.record(time.perf_counter() - start, timed_out=True)
+      raise
+    self.waits.record(time.perf_counter() - start)
+    return connection
+
+  def recreate(self):
+    pool = super().recreate()
+    pool.waits = self.waits
+    return pool
+
+'''
+pool_status(engine)
+    returns pool class, size, checked out and overflow connections, and
+    checkout waits of the pool of engine, by default of the current app
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
-    db.init_app(app)
-    db.create_all()
+def pool_status(engine=None):
+  pool = (engine or db.engine).pool
+  status = {'pool': type(pool).__name__}
+  if isinstance(pool, QueuePool):
+    status.update({
+      'size': pool.size(),
+      'checked_in': pool.checkedin(),
+      'checked_out': pool.checkedout(),
+      # Negative while fewer connections than the size are open
+      'overflow': max(0, pool.overflow()),
+      'max_overflow': pool._max_overflow
+    })
+  if isinstance(pool, TimedQueuePool):
+    status.update(pool.waits.status())
+  return status
+
+'''
+create_search_index()
+    adds a full-text index over question and answer text, kept in sync by
+    triggers so every write to the questions table updates it
+    PostgreSQL: tsvector column with a GIN index
+    SQLite: FTS5 virtual table with questions as its external content
+'''
+def create_search_index():
+  dialect = db.engine.dialect.name
+  if dialect == 'postgresql':
+    if 'search_vector' in [c['name'] for c in inspect(db.engine).get_columns('questions')]:
+      return
+    statements = ['''
+      ALTER TABLE questions ADD COLUMN search_vector tsvector;
+      CREATE INDEX ix_questions_search_vector ON questions
+        USING gin (search_vector);
+      CREATE OR REPLACE FUNCTION questions_search_vector_update()
+        RETURNS trigger AS $$
+      BEGIN
+        NEW.search_vector :=
+          setweight(to_tsvector('simple', coalesce(NEW.question, '')), 'A') ||
+          setweight(to_tsvector('simple', coalesce(NEW.answer, '')), 'B');
+        RETURN NEW;
+      END
+      $$ LANGUAGE plpgsql;
+      CREATE TRIGGER questions_search_vector_update
+        BEFORE INSERT OR UPDATE OF question, answer ON questions
+        FOR EACH ROW EXECUTE PROCEDURE questions_search_vector_update();
+      UPDATE questions SET question = question;
+    ''']
+  elif dialect == 'sqlite':
+    if db.engine.has_table('questions_search'):
+      return
+    statements = [
+      '''CREATE VIRTUAL TABLE questions_search USING fts5(
+           question, answer, content='questions', content_rowid='id')''',
+      '''CREATE TRIGGER questions_search_insert AFTER INSERT ON questions BEGIN
+           INSERT INTO questions_search (rowid, question, answer)
+           VALUES (new.id, new.question, new.answer);
+         END''',
+      '''CREATE TRIGGER questions_search_delete AFTER DELETE ON questions BEGIN
+           INSERT INTO questions_search (questions_search, rowid, question, answer)
+           VALUES ('delete', old.id, old.question, old.answer);
+         END''',
+      '''CREATE TRIGGER questions_search_update AFTER UPDATE ON questions BEGIN
+           INSERT INTO questions_search (questions_search, rowid, question, answer)
+           VALUES ('delete', old.id, old.question, old.answer);
+           INSERT INTO questions_search (rowid, question, answer)
+           VALUES (new.id, new.question, new.answer);
+         END''',
+      "INSERT INTO questions_search (questions_search, rank) VALUES ('rank', 'bm25(2.0, 1.0)')",
+      "INSERT INTO questions_search (questions_search) VALUES ('rebuild')"
+    ]
+  else:
+    return
+  with db.engine.begin() as connection:
+    for statement in statements:
+      connection.execute(text(statement))
+
+'''
+create_trigram_index()
+    adds a pg_trgm index over question text for suggestions on PostgreSQL,
+    skipped when the extension is not available
+'''
+def create_trigram_index():
+  if db.engine.dialect.name != 'postgresql':
+    return
+  try:
+    with db.engine.begin() as connection:
+      connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+      connection.execute('''
+        CREATE INDEX IF NOT EXISTS ix_questions_question_trgm ON questions
+          USING gin (question gin_trgm_ops)
+      ''')
+  except exc.DBAPIError:
+    pass
+
+'''
+upgrade_schema(batch_size, log, null_invalid)
+    brings an existing questions table up to the current model while it
+    stays online: an integer category column with a foreign key to
+    categories, and indexes on (category, id) and difficulty
+    PostgreSQL: a text category column is copied to a new integer column in
+    batches, kept in sync by a trigger meanwhile, then swapped in under a
+    short lock; indexes are built concurrently and the foreign key is
+    validated without blocking writes
+    categories that are not integers or not in categories are logged before
+    the swap and before validating the foreign key, and fail the upgrade
+    with ValueError unless null_invalid is set, which makes them NULL
+    reruns resume a failed upgrade, validating a foreign key left NOT VALID
+    SQLite: only adds the indexes, any column there can hold integers
+'''
+SCHEMA_INDEXES = {
+  'ix_questions_category_id': 'category, id',
+  'ix_questions_difficulty': 'difficulty'
+}
+# Text that casts to a PostgreSQL integer, else NULL; the nested CASE makes
+# the range check run only on digits
+INTEGER_CAST = (
+  "CASE WHEN {0} ~ '^\\s*-?\\d{{1,18}}\\s*$' THEN "
+  "CASE WHEN {0}::bigint BETWEEN -2147483648 AND 2147483647 "
+  "THEN {0}::integer END END")
+
+def upgrade_schema(batch_size=10000, log=print, null_invalid=False):
+  db.session.remove()
+  engine = db.engine
+  if engine.dialect.name != 'postgresql':
+    with engine.begin() as connection:
+      for name, columns in SCHEMA_INDEXES.items():
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {name} ON questions ({columns})')
+        log(f'Index {name} ready')
+    return
+  connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+  try:
+    types = {c['name']: c['type'] for c in inspect(engine).get_columns('questions')}
+    if not isinstance(types['category'], Integer):
+      convert_category_column(connection, batch_size, log, null_invalid)
+    for name, columns in SCHEMA_INDEXES.items():
+      create_index_concurrently(connection, name, columns)
+      log(f'Index {name} ready')
+    validated = connection.execute(
+      "SELECT convalidated FROM pg_constraint WHERE conrelid = 'questions'::regclass "
+      "AND conname = 'category'").scalar()
+    if validated is None:
+      # NOT VALID skips the scan under lock, VALIDATE scans without blocking writes
+      connection.execute(
+        'ALTER TABLE questions ADD CONSTRAINT category FOREIGN KEY (category) '
+        'REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL NOT VALID')
+    if not validated:
+      if check_categories(connection, 'questions.category', log, null_invalid):
+        connection.execute(
+          'UPDATE questions SET category = NULL WHERE category IS NOT NULL '
+          'AND NOT EXISTS (SELECT 1 FROM categories WHERE categories.id = questions.category)')
+      connection.execute('ALTER TABLE questions VALIDATE CONSTRAINT category')
+      log('Foreign key category ready')
+    # Clears dead rows of the conversion and sets the visibility map for
+    # index only scans, without locking out writes
+    connection.execute('VACUUM ANALYZE questions')
+  finally:
+    connection.close()
+
+'''
+check_categories(connection, category, log, null_invalid)
+    logs each category of questions that is not an integer or not in
+    categories, with category the integer SQL expression of the category
+    column, and returns True if there are any
+    raises ValueError for them unless null_invalid is set
+'''
+def check_categories(connection, category, log, null_invalid):
+  invalid = connection.execute(f'''
+    SELECT questions.category, count(*), bool_or({category} IS NULL)
+    FROM questions
+    WHERE questions.category IS NOT NULL AND ({category} IS NULL OR NOT EXISTS (
+      SELECT 1 FROM categories WHERE categories.id = {category}))
+    GROUP BY questions.category ORDER BY questions.category
+  ''').fetchall()
+  for value, count, not_integer in invalid:
+    problem = 'is not an integer' if not_integer else 'is not in categories'
+    log(f'Category {value!r} of {count} questions {problem}')
+  if len(invalid) > 0 and not null_invalid:
+    raise ValueError(f'{len(invalid)} categories not valid, rerun with '
+                     'null_invalid to set them NULL')
+  return len(invalid) > 0
+
+'''
+convert_category_column(connection, batch_size, log, null_invalid)
+    replaces the text category column of questions with an integer column
+    while the table stays readable and writable, on an autocommit connection
+    values that are not integers or not in categories are checked before the
+    swap, which keeps the text column until they are fixed or made NULL
+'''
+def convert_category_column(connection, batch_size, log, null_invalid):
+  connection.execute(f'''
+    ALTER TABLE questions ADD COLUMN IF NOT EXISTS category_new integer;
+    CREATE OR REPLACE FUNCTION questions_category_new_update()
+      RETURNS trigger AS $$
+    BEGIN
+      NEW.category_new := {INTEGER_CAST.format('NEW.category')};
+      RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS questions_category_new_update ON questions;
+    CREATE TRIGGER questions_category_new_update
+      BEFORE INSERT OR UPDATE OF category ON questions
+      FOR EACH ROW EXECUTE PROCEDURE questions_category_new_update();
+  ''')
+  low, high = connection.execute('SELECT min(id), max(id) FROM questions').first()
+  for start in range(low or 0, (high or -1) + 1, batch_size):
+    # One short transaction per batch so row locks are held briefly
+    connection.execute(text(
+      f"UPDATE questions SET category_new = {INTEGER_CAST.format('category')} "
+      'WHERE id >= :start AND id < :stop'
+    ), start=start, stop=start + batch_size)
+    log(f'Copied categories of IDs up to {min(start + batch_size - 1, high)}')
+  if check_categories(connection, 'questions.category_new', log, null_invalid):
+    connection.execute(
+      'UPDATE questions SET category_new = NULL WHERE category_new IS NOT NULL '
+      'AND NOT EXISTS (SELECT 1 FROM categories WHERE categories.id = questions.category_new)')
+  create_index_concurrently(connection, 'ix_questions_category_id', 'category_new, id')
+  with connection.engine.begin() as swap:
+    # Give up rather than queue every query behind a long transaction
+    swap.execute("SET LOCAL lock_timeout = '5s'")
+    swap.execute('''
+      DROP TRIGGER questions_category_new_update ON questions;
+      DROP FUNCTION questions_category_new_update();
+      ALTER TABLE questions DROP COLUMN category;
+      ALTER TABLE questions RENAME COLUMN category_new TO category;
+    ''')
+  log('Category column converted to integer')
+
+'''
+create_index_concurrently(connection, name, columns)
+    builds an index on questions without blocking writes, first dropping an
+    invalid index left behind by an interrupted build
+'''
+def create_index_concurrently(connection, name, columns):
+  valid = connection.execute(text(
+    'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'
+  ), name=name).scalar()
+  if valid is False:
+    connection.execute(f'DROP INDEX CONCURRENTLY {name}')
+  connection.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON questions ({columns})')
 
 '''
 Question
@@ -29,8 +464,15 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
-  difficulty = Column(Integer)
+  # active_history loads the category a question had before it is set,
+  # even once expired, so question counts know which count to take it from
+  category = orm.column_property(Column(Integer, ForeignKey(
+    'categories.id', name='category', onupdate='CASCADE', ondelete='SET NULL')),
+    active_history=True)
+  difficulty = Column(Integer, index=True)
+
+  # Category listings and quiz lookups filter on category in ID order
+  __table_args__ = (Index('ix_questions_category_id', 'category', 'id'),)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -49,6 +491,29 @@ class Question(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+  @classmethod
+  def search(cls, search_term):
+    '''
+    Return query of questions matching every word of search term as a
+    word prefix in question or answer, most relevant first
+    Falls back to a substring match without the full-text index
+    '''
+    words = re.findall(r'\w+', search_term.lower())
+    dialect = db.engine.dialect.name
+    if len(words) == 0 or dialect not in ['postgresql', 'sqlite']:
+      return cls.query.filter(cls.question.ilike(f'%{search_term}%'))
+    if dialect == 'postgresql':
+      ts_query = func.to_tsquery('simple', ' & '.join(f'{word}:*' for word in words))
+      search_vector = literal_column('questions.search_vector')
+      return cls.query.filter(search_vector.op('@@')(ts_query)).order_by(
+        func.ts_rank(search_vector, ts_query).desc())
+    questions_search = table('questions_search', column('rowid'), column('rank'))
+    return cls.query.join(
+      questions_search, questions_search.c.rowid == cls.id
+    ).filter(
+      literal_column('questions_search').op('MATCH')(' AND '.join(f'"{word}"*' for word in words))
+    ).order_by(questions_search.c.rank)
+
   def format(self):
     return {
       'id': self.id,
@@ -76,3 +541,36 @@ class Category(db.Model):
       'id': self.id,
       'type': self.type
     }
+
+
+'''
+QuestionCount
+    number of questions in a category, category 0 counting every question,
+    changed in the transaction of every question write made by the app
+'''
+class QuestionCount(db.Model):
+  __tablename__ = 'question_counts'
+
+  category_id = Column(Integer, primary_key=True, autoincrement=False)
+  count = Column(Integer, nullable=False)
+
+  def __init__(self, category_id, count):
+    self.category_id = category_id
+    self.count = count
+
+
+'''
+DataVersion
+    generation counter of a table, bumped by every write to it
+'''
+class DataVersion(db.Model):
+  __tablename__ = 'data_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False)
+  updated_at = Column(DateTime, nullable=False)
+
+  def __init__(self, name, version):
+    self.name = name
+    self.version = version
+    self.updated_at = datetime.utcnow()
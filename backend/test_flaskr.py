@@ -1,10 +1,120 @@
 import os
+import csv
+import functools
+import io
+import logging
+import math
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
 import unittest
 import json
+from unittest import mock
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, Integer
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import (
+    create_app, encode_cursor, QUESTIONS_PER_PAGE, MAX_QUIZ_COUNT
+)
+from flaskr.asgi import create_async_app, numbered, aiosqlite, asyncpg, \
+    Connection
+from flaskr.bulk import (
+    import_questions, export_query, export_questions, delete_questions
+)
+from flaskr.counts import begin_write, reconcile_question_counts
+from flaskr.metrics import count_statement
+from flaskr.question_ids import QuestionIds, question_ids
+from flaskr.quiz_sessions import QuizSession
+from flaskr.search_cache import (
+    LocalSearchCache, SharedSearchCache, search_key, ENTRY_OVERHEAD
+)
+from flaskr.selection import (
+    AliasTable, target_difficulty, DIFFICULTY_WEIGHTS, STRATEGIES,
+    UNIFORM, WEIGHTED, ADAPTIVE
+)
+from flaskr.suggest import NGramIndex
+from models import (
+    setup_db, upgrade_schema, pool_status, db, Question, Category,
+    QuestionCount, DataVersion
+)
+from asgi_client import AsyncAppRunner
+
+
+class QueryBudget:
+    """
+    Count SQL statements of an app and the rows they return, and fail when
+    more run than the budget allows, as a context manager or test decorator
+    Set QUERY_BUDGET_DEBUG=1 to log statements run more than once, the
+    signature of N+1 queries
+    """
+
+    def __init__(self, statements=None, rows=None, app=None, debug=None):
+        self.max_statements = statements
+        self.max_rows = rows
+        self.app = app
+        if debug is None:
+            debug = os.environ.get('QUERY_BUDGET_DEBUG') == '1'
+        self.debug = debug
+        self.statements = []
+        self.rows = 0
+
+    def __enter__(self):
+        with self.app.app_context():
+            self.engine = db.get_engine()
+        self.statements = []
+        self.rows = 0
+        event.listen(self.engine, 'after_cursor_execute', self.count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'after_cursor_execute', self.count)
+        if self.debug:
+            for statement, times in self.repeated().items():
+                logging.getLogger(__name__).warning(
+                    'Statement run %d times: %s', times, statement)
+        if exc_type is None:
+            self.check()
+        return False
+
+    def __call__(self, test):
+        """Return test method run within budget of its app"""
+        @functools.wraps(test)
+        def run_within_budget(testcase, *args, **kwargs):
+            with QueryBudget(self.max_statements, self.max_rows,
+                             testcase.app, self.debug):
+                return test(testcase, *args, **kwargs)
+        return run_within_budget
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        """Count statement, and its rows as reported by the driver"""
+        self.statements.append(statement)
+        if cursor.description is not None and cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+
+    def repeated(self):
+        """Return times run of each statement run more than once"""
+        return {statement: times for statement, times
+                in Counter(self.statements).items() if times > 1}
+
+    def check(self):
+        """Raise AssertionError if statements or rows are over budget"""
+        if self.max_statements is not None and \
+                len(self.statements) > self.max_statements:
+            raise AssertionError(
+                '{} statements over budget of {}:\n{}'.format(
+                    len(self.statements), self.max_statements,
+                    '\n'.join(self.statements)))
+        if self.max_rows is not None and self.rows > self.max_rows:
+            raise AssertionError('{} rows over budget of {}'.format(
+                self.rows, self.max_rows))
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -16,7 +126,7 @@ class TriviaTestCase(unittest.TestCase):
         self.client = self.app.test_client
         self.database_name = 'trivia_test'
         self.database_path = 'postgresql://{}/{}'.format('localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        setup_db(self.app, self.database_path, create=True)
 
         # binds the app to the current context
         with self.app.app_context():
@@ -37,6 +147,212 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertIsInstance((data['categories']), dict)
 
+    def statements_during(self, app, make_request):
+        """Return SQL statements executed while making a request, response"""
+        with QueryBudget(app=app) as budget:
+            response = make_request()
+        return budget.statements, response
+
+    def test_success_get_categories_cached(self):
+        """Test success GET /categories is served from cache"""
+        first = self.client().get('/categories')
+        statements, second = self.statements_during(
+            self.app, lambda: self.client().get('/categories'))
+        self.assertEqual(statements, [])
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+
+    def test_success_get_questions_total_after_post_and_delete(self):
+        """Test success GET /questions total follows POST and DELETE"""
+        response = self.client().get('/categories/6/questions')
+        total_questions = json.loads(response.data)['total_questions']
+        new_question = {
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        }
+        response = self.client().post('/questions', json=new_question)
+        created = json.loads(response.data)['created']
+        response = self.client().get('/categories/6/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total_questions + 1)
+        self.client().delete('/questions/' + str(created))
+        response = self.client().get('/categories/6/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total_questions)
+
+    def test_success_get_questions_total_across_workers(self):
+        """Test success GET /questions total follows writes of other apps"""
+        apps = []
+        for _ in range(2):
+            app = create_app({'DATA_VERSION_TABLE': True})
+            setup_db(app, self.database_path)
+            apps.append(app)
+        reader, writer = apps
+        response = reader.test_client().get('/questions')
+        total_questions = json.loads(response.data)['total_questions']
+        new_question = {
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        }
+        response = writer.test_client().post('/questions', json=new_question)
+        created = json.loads(response.data)['created']
+        response = reader.test_client().get('/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total_questions + 1)
+        writer.test_client().delete('/questions/' + str(created))
+        response = reader.test_client().get('/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total_questions)
+
+    def test_success_get_questions_total_across_workers_expires(self):
+        """Test success GET /questions total of other apps once expired"""
+        apps = []
+        for ttl in [60, 0]:
+            app = create_app({'CACHE_TTL': ttl})
+            setup_db(app, self.database_path)
+            apps.append(app)
+        writer, reader = apps
+        response = reader.test_client().get('/questions')
+        total_questions = json.loads(response.data)['total_questions']
+        response = writer.test_client().post('/questions', json={
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        })
+        created = json.loads(response.data)['created']
+        try:
+            response = reader.test_client().get('/questions')
+            self.assertEqual(json.loads(response.data)['total_questions'],
+                             total_questions + 1)
+        finally:
+            writer.test_client().delete('/questions/' + str(created))
+
+    def test_success_get_categories_not_modified(self):
+        """Test success GET /categories when If-None-Match is current"""
+        response = self.client().get('/categories')
+        etag = response.headers['ETag']
+        # In-process versions do not know when other workers wrote
+        self.assertNotIn('Last-Modified', response.headers)
+        statements, response = self.statements_during(
+            self.app, lambda: self.client().get(
+                '/categories', headers={'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn('Access-Control-Allow-Methods', response.headers)
+        self.assertEqual(statements, [])
+
+    def versions_updated_at(self, app, updated_at):
+        """Set update time of every data version of the app's database"""
+        with app.app_context():
+            db.session.query(DataVersion).update(
+                {DataVersion.updated_at: updated_at})
+            db.session.commit()
+
+    def test_success_get_questions_not_modified_since(self):
+        """Test success GET /questions when If-Modified-Since is current"""
+        app = create_app({'DATA_VERSION_TABLE': True})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        client.get('/questions')
+        self.versions_updated_at(app, datetime(2020, 1, 1, 12, 0, 0, 500))
+        response = client.get('/questions?page=2')
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Wed, 01 Jan 2020 12:00:00 GMT')
+        response = client.get('/questions?page=2', headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+        # An ETag outranks the date
+        response = client.get('/questions?page=2', headers={
+            'If-Modified-Since': 'Wed, 01 Jan 2020 12:00:00 GMT',
+            'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_success_get_questions_modified_since_same_second(self):
+        """Test success GET /questions has no date while it could repeat"""
+        app = create_app({'DATA_VERSION_TABLE': True})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        client.get('/questions')
+        self.versions_updated_at(app, datetime.utcnow() + timedelta(
+            seconds=2))
+        response = client.get('/questions?page=2')
+        self.assertNotIn('Last-Modified', response.headers)
+        response = client.get('/questions?page=2', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_success_get_categories_etag_expires_with_cache(self):
+        """Test success GET /categories ETag changes as the cache expires"""
+        app = create_app({'CACHE_TTL': 0})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        etag = client.get('/categories').headers['ETag']
+        response = client.get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_success_get_questions_ignores_modified_since(self):
+        """Test success GET /questions ignores dates of in-process versions"""
+        response = self.client().get('/questions?page=2', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response.headers)
+
+    def test_success_get_questions_modified_after_post_and_delete(self):
+        """Test success GET /questions ETag changes after POST and DELETE"""
+        etag = self.client().get('/questions').headers['ETag']
+        new_question = {
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        }
+        response = self.client().post('/questions', json=new_question)
+        created = json.loads(response.data)['created']
+        response = self.client().get(
+            '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        etag = response.headers['ETag']
+        response = self.client().get(
+            '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client().delete('/questions/' + str(created))
+        response = self.client().get(
+            '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_success_get_categories_by_id_modified_across_workers(self):
+        """Test success GET /categories/<category_id>/questions ETag shared"""
+        apps = []
+        for _ in range(2):
+            app = create_app({'DATA_VERSION_TABLE': True})
+            setup_db(app, self.database_path)
+            apps.append(app)
+        reader, writer = apps
+        path = '/categories/6/questions'
+        etag = reader.test_client().get(path).headers['ETag']
+        response = writer.test_client().get(
+            path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = writer.test_client().post('/questions', json={
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        })
+        writer.test_client().delete(
+            '/questions/' + str(json.loads(response.data)['created']))
+        response = reader.test_client().get(
+            path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_success_get_categories_by_id(self):
         """Test success GET /categories/<category_id>/questions"""
         category_id = 1
@@ -73,6 +389,157 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not Found')
 
+    def test_success_get_questions_loads_one_page(self):
+        """Test success GET /questions loads one page of rows, no instances"""
+        loaded = []
+
+        def on_load(question, context):
+            loaded.append(question.id)
+
+        event.listen(Question, 'load', on_load)
+        try:
+            statements, response = self.statements_during(
+                self.app, lambda: self.client().get('/questions?page=2'))
+        finally:
+            event.remove(Question, 'load', on_load)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(data['total_questions'], QUESTIONS_PER_PAGE)
+        self.assertEqual(loaded, [])
+        self.assertLessEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertTrue(any('LIMIT' in statement for statement in statements))
+
+    def test_success_get_questions_fields(self):
+        """Test success GET /questions with sparse fieldset"""
+        statements, response = self.statements_during(
+            self.app,
+            lambda: self.client().get('/questions?fields=question,category'))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question', 'category'})
+        self.assertFalse(any('questions.answer' in statement
+                             for statement in statements))
+
+    def test_success_get_questions_fields_after_cursor(self):
+        """Test success GET /questions with sparse fieldset and cursor"""
+        response = self.client().get('/questions?after=&fields=difficulty')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data['questions'][0]), {'id', 'difficulty'})
+        self.assertEqual(data['next_cursor'],
+                         encode_cursor(data['questions'][-1]['id']))
+
+    def test_success_post_questions_for_search_term_fields(self):
+        """Test success POST /questions for search term with sparse fieldset"""
+        response = self.client().post('/questions?fields=question',
+                                      json={'searchTerm': 'title'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(data['questions']), 0)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question'})
+
+    def test_error_get_questions_fields_not_valid(self):
+        """Test error GET /questions when a field is not valid"""
+        response = self.client().get('/questions?fields=question,secret')
+        self.assertEqual(response.status_code, 422)
+
+    def test_success_get_questions_without_orjson(self):
+        """Test success GET /questions encodes the same without orjson"""
+        fast = json.loads(self.client().get('/questions').data)
+        with mock.patch('flaskr.orjson', None):
+            response = self.client().get('/questions')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data), fast)
+
+    def test_success_get_questions_total_matches_count(self):
+        """Test success GET /questions total is count of all questions"""
+        response = self.client().get('/questions')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+
+    def walk_cursor_pages(self, path, **kwargs):
+        """Return question IDs of all pages walked by cursor"""
+        question_ids = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client().open(
+                path, query_string={'after': cursor}, **kwargs)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+            question_ids += [question['id'] for question in data['questions']]
+            cursor = data['next_cursor']
+        return question_ids
+
+    def test_success_get_questions_by_cursor(self):
+        """Test success GET /questions walking all pages by cursor"""
+        question_ids = self.walk_cursor_pages('/questions')
+        with self.app.app_context():
+            expected_ids = [question.id for question in
+                            Question.query.order_by(Question.id).all()]
+        self.assertEqual(question_ids, expected_ids)
+
+    def test_success_get_categories_by_id_by_cursor(self):
+        """Test success GET /categories/<category_id>/questions by cursor"""
+        question_ids = self.walk_cursor_pages('/categories/1/questions')
+        with self.app.app_context():
+            expected_ids = [question.id for question in Question.query.filter(
+                Question.category == 1).order_by(Question.id).all()]
+        self.assertEqual(question_ids, expected_ids)
+
+    def test_success_post_questions_for_search_term_by_cursor(self):
+        """Test success POST /questions for search term by cursor"""
+        search_term = {'searchTerm': 'wh'}
+        question_ids = self.walk_cursor_pages(
+            '/questions', method='POST', json=search_term)
+        response = self.client().post('/questions', json=search_term)
+        data = json.loads(response.data)
+        self.assertEqual(len(question_ids), data['total_questions'])
+        self.assertEqual(question_ids, sorted(question_ids))
+        self.assertGreater(len(question_ids), QUESTIONS_PER_PAGE)
+
+    def test_success_get_questions_by_cursor_deep_page_same_cost(self):
+        """Test success GET /questions deep cursor page costs as first page"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            last_question = Question.query.order_by(Question.id.desc()).first()
+            engine = db.get_engine()
+        # Warm the category cache so only page queries are compared
+        self.client().get('/questions?after=')
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.client().get('/questions?after=')
+            first_page_statements = list(statements)
+            del statements[:]
+            self.client().get(
+                '/questions?after=' + encode_cursor(last_question.id - 1))
+            deep_page_statements = list(statements)
+        finally:
+            event.remove(
+                engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len(first_page_statements),
+                         len(deep_page_statements))
+        for statement in first_page_statements + deep_page_statements:
+            self.assertNotIn('OFFSET', statement.upper())
+            self.assertNotIn('COUNT(', statement.upper())
+
+    def test_error_get_questions_by_cursor_not_valid(self):
+        """Test error GET /questions when cursor not valid"""
+        response = self.client().get('/questions?after=not-a-cursor')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
     def test_success_post_questions(self):
         """Test success POST /questions"""
         new_question = {
@@ -123,6 +590,213 @@ class TriviaTestCase(unittest.TestCase):
         self.assertIsInstance((data['questions']), list)
         self.assertIsInstance(data['total_questions'], int)
 
+    def test_success_post_questions_for_search_term_in_answer(self):
+        """Test success POST /questions for search term found in answer"""
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'muhammad'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([question['answer'] for question in data['questions']],
+                         ['Muhammad Ali'])
+
+    def test_success_post_questions_for_search_term_ranked(self):
+        """Test success POST /questions for search term ranks question first"""
+        with self.app.app_context():
+            in_answer = Question('Which word is this?', 'Zebrafish', 6, 1)
+            in_answer.insert()
+            in_question = Question('Is a zebrafish a fish?', 'Yes', 6, 1)
+            in_question.insert()
+            question_ids = [in_question.id, in_answer.id]
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'Zebrafish'})
+        data = json.loads(response.data)
+        with self.app.app_context():
+            for question_id in question_ids:
+                Question.query.get(question_id).delete()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         question_ids)
+
+    def test_success_post_questions_for_search_term_after_delete(self):
+        """Test success POST /questions for search term after insert, delete"""
+        new_question = {
+            'question': 'Which quokka is the happiest?',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '1'
+        }
+        response = self.client().post('/questions', json=new_question)
+        created = json.loads(response.data)['created']
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'quokk'})
+        data = json.loads(response.data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [created])
+        self.client().delete('/questions/' + str(created))
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'quokk'})
+        data = json.loads(response.data)
+        self.assertEqual(data['questions'], [])
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_success_post_questions_for_search_term_cached(self):
+        """Test success POST /questions for search term from search cache"""
+        cache = self.app.extensions['trivia_search_cache']
+        first = self.client().post('/questions',
+                                   json={'searchTerm': 'Penicillin'})
+        misses = cache.misses
+        statements, second = self.statements_during(
+            self.app, lambda: self.client().post(
+                '/questions', json={'searchTerm': ' penicillin?'}))
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(cache.misses, misses)
+        self.assertGreaterEqual(cache.hits, 1)
+        self.assertEqual(statements, [])
+
+    def test_success_post_questions_for_search_term_cached_by_page(self):
+        """Test success POST /questions caches each page of a search"""
+        first = self.client().post('/questions', json={'searchTerm': 'e'})
+        second = self.client().post('/questions?page=2',
+                                    json={'searchTerm': 'e'})
+        self.assertNotEqual(json.loads(first.data)['questions'],
+                            json.loads(second.data)['questions'])
+
+    def test_success_get_metrics_search_cache(self):
+        """Test success GET /metrics reports the search cache"""
+        self.client().post('/questions', json={'searchTerm': 'title'})
+        self.client().post('/questions', json={'searchTerm': 'title'})
+        text = self.client().get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE trivia_search_cache_hits_total counter', text)
+        self.assertRegex(text, r'trivia_search_cache_hits_total [1-9]')
+        self.assertRegex(text, r'trivia_search_cache_bytes [1-9]')
+
+    def test_success_search_cache_disabled(self):
+        """Test success POST /questions for search term without a cache"""
+        app = create_app({'SEARCH_CACHE_MAX_BYTES': 0})
+        setup_db(app, self.database_path)
+        self.assertIsNone(app.extensions['trivia_search_cache'])
+        response = app.test_client().post('/questions',
+                                          json={'searchTerm': 'penicillin'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['total_questions'], 1)
+        text = app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertNotIn('trivia_search_cache', text)
+
+    def test_success_search_cache_shared_by_workers(self):
+        """Test success SEARCH_CACHE_PATH shares results between apps"""
+        with tempfile.TemporaryDirectory() as directory:
+            apps = []
+            for _ in range(2):
+                app = create_app({
+                    'SEARCH_CACHE_PATH': os.path.join(directory, 'cache.db'),
+                    'DATA_VERSION_TABLE': True
+                })
+                setup_db(app, self.database_path)
+                apps.append(app)
+            first, second = [app.extensions['trivia_search_cache']
+                             for app in apps]
+            apps[0].test_client().post('/questions',
+                                       json={'searchTerm': 'quokka'})
+            apps[1].test_client().post('/questions',
+                                       json={'searchTerm': 'quokka'})
+            self.assertEqual((first.misses, second.hits), (1, 1))
+            # A write in one worker makes the entries of both stale
+            response = apps[0].test_client().post('/questions', json={
+                'question': 'Which quokka is the happiest?',
+                'answer': 'answer',
+                'difficulty': '1',
+                'category': '6'
+            })
+            created = json.loads(response.data)['created']
+            try:
+                response = apps[1].test_client().post(
+                    '/questions', json={'searchTerm': 'quokka'})
+                self.assertEqual(second.misses, 1)
+                self.assertEqual(
+                    [question['id'] for question in
+                     json.loads(response.data)['questions']], [created])
+            finally:
+                apps[0].test_client().delete(f'/questions/{created}')
+
+    def test_success_get_question_suggestions(self):
+        """Test success GET /questions/suggest"""
+        response = self.client().get('/questions/suggest?prefix=PENIC')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['suggestions'], ['Who discovered penicillin?'])
+
+    def test_success_get_question_suggestions_short_prefix(self):
+        """Test success GET /questions/suggest for short prefix and limit"""
+        response = self.client().get('/questions/suggest?prefix=wh')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['suggestions'], [])
+        response = self.client().get('/questions/suggest?prefix=who&limit=3')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['suggestions']), 3)
+        for suggestion in data['suggestions']:
+            self.assertIn('who', suggestion.lower())
+
+    def test_success_get_question_suggestions_same_on_trigram_index(self):
+        """Test success GET /questions/suggest same from SQL and n-grams"""
+        prefixes = ['who', 'Wha', 'the', 'PENIC', 'art', 'ear', 'o b',
+                    '%_\\']
+        suggestions = {}
+        for trigram_index in [False, True]:
+            with mock.patch('flaskr.suggest.has_trigram_index',
+                            return_value=trigram_index):
+                suggestions[trigram_index] = [json.loads(self.client().get(
+                    '/questions/suggest', query_string={
+                        'prefix': prefix, 'limit': 50
+                    }).data)['suggestions'] for prefix in prefixes]
+        self.assertEqual(suggestions[True], suggestions[False])
+        self.assertTrue(all(len(texts) > 0
+                            for texts in suggestions[True][:6]))
+
+    def test_success_get_question_suggestions_after_delete(self):
+        """Test success GET /questions/suggest after insert and delete"""
+        self.client().get('/questions/suggest?prefix=warm')
+        new_question = {
+            'question': 'Where do wombats sleep?',
+            'answer': 'answer',
+            'difficulty': '1',
+            'category': '6'
+        }
+        response = self.client().post('/questions', json=new_question)
+        created = json.loads(response.data)['created']
+        response = self.client().get('/questions/suggest?prefix=wombat')
+        data = json.loads(response.data)
+        self.assertEqual(data['suggestions'], ['Where do wombats sleep?'])
+        self.client().delete('/questions/' + str(created))
+        response = self.client().get('/questions/suggest?prefix=wombat')
+        data = json.loads(response.data)
+        self.assertEqual(data['suggestions'], [])
+
+    def test_error_get_question_suggestions_prefix_missing(self):
+        """Test error GET /questions/suggest when prefix missing"""
+        response = self.client().get('/questions/suggest')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_success_ngram_index_ranks_word_start_first(self):
+        """Test success n-gram index ranks word starts, then short texts"""
+        index = NGramIndex('sqlite://', 0)
+        index.add(1, 'A longer question about the cartoon?')
+        index.add(2, 'What is art?')
+        index.add(3, 'Who painted this artwork?')
+        index.add(4, 'Is it smart?')
+        self.assertEqual(index.suggest('art', 10), [
+            'What is art?', 'Who painted this artwork?', 'Is it smart?',
+            'A longer question about the cartoon?'])
+        index.remove(2)
+        index.add(3, 'Who painted this?')
+        self.assertEqual(index.suggest('art', 10), [
+            'Is it smart?', 'A longer question about the cartoon?'])
+
     def test_success_post_questions_search_term_not_valid_type(self):
         """Test success POST /questions when search term not valid type"""
         search_term = {
@@ -334,6 +1008,392 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable Entity')
 
+    def delete_questions_like(self, text):
+        """Delete questions with question text like text, return count"""
+        with self.app.app_context():
+            questions = Question.query.filter(
+                Question.question.like(text)).all()
+            for question in questions:
+                question.delete()
+        return len(questions)
+
+    def test_success_post_questions_bulk(self):
+        """Test success POST /questions/bulk for JSON array"""
+        total_questions = json.loads(
+            self.client().get('/questions').data)['total_questions']
+        new_questions = [{
+            'question': f'Bulk question {i}, with "quotes"\tand tabs?',
+            'answer': f'answer {i}',
+            'difficulty': i % 5 + 1,
+            'category': str(i % 6 + 1)
+        } for i in range(25)]
+        response = self.client().post('/questions/bulk', json=new_questions)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 25)
+        self.assertIsInstance(data['rows_per_second'], int)
+        response = self.client().get('/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total_questions + 25)
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'bulk question'})
+        self.assertEqual(json.loads(response.data)['total_questions'], 25)
+        with self.app.app_context():
+            question = Question.query.filter(
+                Question.answer == 'answer 7').one()
+            self.assertEqual(question.question,
+                             'Bulk question 7, with "quotes"\tand tabs?')
+        self.assertEqual(self.delete_questions_like('Bulk question %'), 25)
+
+    def test_success_post_questions_bulk_ndjson(self):
+        """Test success POST /questions/bulk for NDJSON"""
+        lines = [json.dumps({
+            'question': f'Ndjson question {i}',
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': 2
+        }) for i in range(3)]
+        response = self.client().post(
+            '/questions/bulk', data='\n'.join(lines) + '\n',
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 3)
+        self.assertEqual(self.delete_questions_like('Ndjson question %'), 3)
+
+    def test_error_post_questions_bulk_rows_not_valid(self):
+        """Test error POST /questions/bulk when rows not valid"""
+        lines = [
+            json.dumps({'question': 'Invalid bulk question', 'answer': 'a',
+                        'difficulty': 1, 'category': 1}),
+            json.dumps({'question': 'Invalid bulk question', 'answer': '',
+                        'difficulty': 1, 'category': 1}),
+            '{not json',
+            json.dumps({'question': 'Invalid bulk question', 'answer': 'a',
+                        'difficulty': 1, 'category': 999})
+        ]
+        response = self.client().post(
+            '/questions/bulk', data='\n'.join(lines),
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([error['row'] for error in data['errors']],
+                         [1, 2, 3])
+        self.assertEqual(self.delete_questions_like('Invalid bulk question'),
+                         0)
+
+    def test_error_post_questions_bulk_request_body_not_array(self):
+        """Test error POST /questions/bulk when request body not array"""
+        response = self.client().post('/questions/bulk', json={})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_success_import_questions_command(self):
+        """Test success flask import-questions"""
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump([{
+                'question': f'Imported question {i}',
+                'answer': 'answer',
+                'difficulty': 3,
+                'category': 4
+            } for i in range(4)], file)
+            file.flush()
+            result = self.app.test_cli_runner().invoke(
+                args=['import-questions', file.name])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Imported 4 questions', result.output)
+        self.assertEqual(self.delete_questions_like('Imported question %'), 4)
+
+    def test_error_import_questions_command_rows_not_valid(self):
+        """Test error flask import-questions when rows not valid"""
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as file:
+            file.write('{"question": "Imported question"}\n')
+            file.flush()
+            result = self.app.test_cli_runner().invoke(
+                args=['import-questions', file.name])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Row 0:', result.output)
+        self.assertEqual(self.delete_questions_like('Imported question'), 0)
+
+    def assertCountsMatch(self):
+        """Assert stored question counts equal counts by COUNT(*)"""
+        with db.get_engine(self.app).connect() as connection:
+            stored = dict(connection.execute(
+                'SELECT category_id, count FROM question_counts '
+                'WHERE count <> 0 OR category_id = 0').fetchall())
+            counted = dict(connection.execute(
+                'SELECT category, COUNT(*) FROM questions '
+                'WHERE category IS NOT NULL GROUP BY category').fetchall())
+            counted[0] = connection.execute(
+                'SELECT COUNT(*) FROM questions').scalar()
+        self.assertEqual(stored, counted)
+
+    def test_success_question_counts_match(self):
+        """Test success question counts match COUNT(*) of every category"""
+        self.assertCountsMatch()
+        response = self.client().get('/categories/6/questions')
+        with self.app.app_context():
+            count = Question.query.filter(Question.category == 6).count()
+        self.assertEqual(json.loads(response.data)['total_questions'], count)
+
+    def test_success_question_counts_after_insert_update_delete(self):
+        """Test success question counts follow insert, update and delete"""
+        with self.app.app_context():
+            counts = dict(QuestionCount.query.with_entities(
+                QuestionCount.category_id, QuestionCount.count))
+            question = Question('Counted question?', 'Yes', 6, 1)
+            question.insert()
+            self.assertCountsMatch()
+            question.category = 5
+            question.update()
+            self.assertCountsMatch()
+            question.delete()
+            self.assertCountsMatch()
+            self.assertEqual(dict(QuestionCount.query.with_entities(
+                QuestionCount.category_id, QuestionCount.count)), counts)
+
+    def test_success_question_counts_after_rollback(self):
+        """Test success question counts roll back with their question"""
+        with self.app.app_context():
+            db.session.add(Question('Counted question?', 'Yes', 6, 1))
+            db.session.flush()
+            db.session.rollback()
+        self.assertCountsMatch()
+
+    def test_success_question_counts_after_bulk_import(self):
+        """Test success question counts follow bulk imports"""
+        response = self.client().post('/questions/bulk', json=[{
+            'question': f'Counted question {i}',
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': 5 + i % 2
+        } for i in range(5)])
+        self.assertEqual(response.status_code, 200)
+        try:
+            self.assertCountsMatch()
+        finally:
+            self.delete_questions_like('Counted question %')
+        self.assertCountsMatch()
+
+    def test_success_reconcile_counts_command(self):
+        """Test success flask reconcile-counts fixes drifted counts"""
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(QuestionCount.__table__.update().where(
+                    QuestionCount.category_id == 6).values(
+                    count=QuestionCount.count + 3))
+        result = self.app.test_cli_runner().invoke(
+            args=['reconcile-counts'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertRegex(result.output, r'Category 6: (\d+) -> \d+')
+        self.assertIn('Fixed 1 question counts', result.output)
+        self.assertCountsMatch()
+        result = self.app.test_cli_runner().invoke(
+            args=['reconcile-counts'])
+        self.assertIn('Fixed 0 question counts', result.output)
+
+    def test_success_get_questions_total_after_reconcile(self):
+        """Test success GET /questions serves counts fixed by reconcile"""
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(QuestionCount.__table__.update().where(
+                    QuestionCount.category_id == 0).values(count=0))
+            reconcile_question_counts()
+            count = Question.query.count()
+        response = self.client().get('/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'], count)
+
+    def test_success_get_questions_export(self):
+        """Test success GET /questions/export as NDJSON"""
+        response = self.client().get('/questions/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in
+                response.get_data(as_text=True).splitlines()]
+        with self.app.app_context():
+            self.assertEqual(
+                [row['id'] for row in rows],
+                [question.id for question in
+                 Question.query.order_by(Question.id).all()])
+        self.assertEqual(set(rows[0]), {
+            'id', 'question', 'answer', 'category', 'difficulty'})
+
+    def test_success_get_questions_export_csv_filtered(self):
+        """Test success GET /questions/export as CSV by category, difficulty"""
+        response = self.client().get(
+            '/questions/export?format=csv&category=1&difficulty=4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(
+            response.get_data(as_text=True))))
+        with self.app.app_context():
+            expected = Question.query.filter(
+                Question.category == 1, Question.difficulty == 4).order_by(
+                Question.id).all()
+        self.assertEqual([int(row['id']) for row in rows],
+                         [question.id for question in expected])
+        self.assertEqual([row['question'] for row in rows],
+                         [question.question for question in expected])
+
+    def test_error_get_questions_export_format_not_valid(self):
+        """Test error GET /questions/export when format not valid"""
+        for query_string in ['format=xml', 'category=science']:
+            response = self.client().get('/questions/export?' + query_string)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['success'], False)
+
+    def test_success_export_questions_memory_flat(self):
+        """Test success export peak memory does not grow with row count"""
+        def export_peak(category_id):
+            tracemalloc.start()
+            try:
+                for _ in export_questions(
+                        export_query(category_id, 5), 'ndjson'):
+                    pass
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        with self.app.app_context():
+            for category_id, count in [(4, 2000), (5, 20000)]:
+                import_questions([{
+                    'question': f'Export question {i}',
+                    'answer': 'answer',
+                    'difficulty': 5,
+                    'category': category_id
+                } for i in range(count)], {category_id})
+            try:
+                small_peak = export_peak(4)
+                large_peak = export_peak(5)
+            finally:
+                Question.query.filter(
+                    Question.question.like('Export question %')
+                ).delete(synchronize_session=False)
+                db.session.commit()
+                reconcile_question_counts()
+        self.assertLess(large_peak, small_peak * 1.5)
+
+    def test_success_export_questions_command(self):
+        """Test success flask export-questions"""
+        result = self.app.test_cli_runner().invoke(
+            args=['export-questions', '--format', 'csv', '--category', '1'])
+        self.assertEqual(result.exit_code, 0)
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        self.assertGreater(len(rows), 0)
+        self.assertEqual({row['category'] for row in rows}, {'1'})
+
+    def question_schema(self):
+        """Return category column type, index columns and foreign keys"""
+        inspector = inspect(db.engine)
+        category_type = next(column['type'] for column in
+                             inspector.get_columns('questions')
+                             if column['name'] == 'category')
+        indexes = {index['name']: index['column_names']
+                   for index in inspector.get_indexes('questions')}
+        foreign_keys = [(fk['constrained_columns'], fk['referred_table'])
+                        for fk in inspector.get_foreign_keys('questions')]
+        return category_type, indexes, foreign_keys
+
+    def test_success_upgrade_schema_command(self):
+        """Test success flask upgrade-schema"""
+        result = self.app.test_cli_runner().invoke(args=['upgrade-schema'])
+        self.assertEqual(result.exit_code, 0)
+        with self.app.app_context():
+            category_type, indexes, foreign_keys = self.question_schema()
+        self.assertIsInstance(category_type, Integer)
+        self.assertEqual(indexes['ix_questions_category_id'],
+                         ['category', 'id'])
+        self.assertEqual(indexes['ix_questions_difficulty'], ['difficulty'])
+        self.assertIn((['category'], 'categories'), foreign_keys)
+
+    def test_success_upgrade_schema_converts_text_category(self):
+        """Test success upgrade_schema converts a text category column"""
+        with self.app.app_context():
+            categories = dict(Question.query.with_entities(
+                Question.id, Question.category))
+            db.session.remove()
+            with db.engine.begin() as connection:
+                connection.execute(
+                    'ALTER TABLE questions DROP CONSTRAINT category;'
+                    'DROP INDEX IF EXISTS ix_questions_category_id;'
+                    'ALTER TABLE questions ALTER COLUMN category '
+                    'TYPE varchar USING category::varchar')
+            messages = []
+            upgrade_schema(batch_size=5, log=messages.append)
+            category_type, indexes, foreign_keys = self.question_schema()
+            self.assertEqual(dict(Question.query.with_entities(
+                Question.id, Question.category)), categories)
+            db.session.remove()
+        self.assertIsInstance(category_type, Integer)
+        self.assertIn('ix_questions_category_id', indexes)
+        self.assertIn((['category'], 'categories'), foreign_keys)
+        self.assertIn('Category column converted to integer', messages)
+
+    def test_error_upgrade_schema_invalid_text_categories(self):
+        """Test error upgrade_schema stops at categories not valid"""
+        with self.app.app_context():
+            db.session.remove()
+            with db.engine.begin() as connection:
+                connection.execute(
+                    'ALTER TABLE questions DROP CONSTRAINT category;'
+                    'DROP INDEX IF EXISTS ix_questions_category_id;'
+                    'ALTER TABLE questions ALTER COLUMN category '
+                    'TYPE varchar USING category::varchar')
+                ids = [connection.execute(
+                    "INSERT INTO questions (question, answer, category, "
+                    "difficulty) VALUES ('Invalid?', 'answer', %s, 1) "
+                    "RETURNING id", category).scalar()
+                    for category in ['science', '99999999999', '999']]
+            try:
+                messages = []
+                with self.assertRaises(ValueError):
+                    upgrade_schema(batch_size=5, log=messages.append)
+                category_type, indexes, foreign_keys = self.question_schema()
+                self.assertNotIsInstance(category_type, Integer)
+                for message in [
+                        "Category '999' of 1 questions is not in categories",
+                        "Category '99999999999' of 1 questions is not an "
+                        "integer",
+                        "Category 'science' of 1 questions is not an "
+                        "integer"]:
+                    self.assertIn(message, messages)
+                upgrade_schema(batch_size=5, log=messages.append,
+                               null_invalid=True)
+                category_type, indexes, foreign_keys = self.question_schema()
+                self.assertIsInstance(category_type, Integer)
+                self.assertIn((['category'], 'categories'), foreign_keys)
+                self.assertEqual([question.category for question in
+                                  Question.query.filter(Question.id.in_(ids))],
+                                 [None, None, None])
+            finally:
+                Question.query.filter(Question.id.in_(ids)).delete(
+                    synchronize_session=False)
+                db.session.commit()
+                db.session.remove()
+
+    def test_success_upgrade_schema_validates_foreign_key_left_not_valid(self):
+        """Test success upgrade_schema validates a NOT VALID foreign key"""
+        with self.app.app_context():
+            db.session.remove()
+            with db.engine.begin() as connection:
+                connection.execute(
+                    'ALTER TABLE questions DROP CONSTRAINT category;'
+                    'ALTER TABLE questions ADD CONSTRAINT category '
+                    'FOREIGN KEY (category) REFERENCES categories (id) '
+                    'ON UPDATE CASCADE ON DELETE SET NULL NOT VALID')
+            messages = []
+            upgrade_schema(log=messages.append)
+            validated = db.engine.execute(
+                "SELECT convalidated FROM pg_constraint "
+                "WHERE conname = 'category'").scalar()
+        self.assertTrue(validated)
+        self.assertIn('Foreign key category ready', messages)
+
     def test_success_delete_questions_by_id(self):
         """Test success DELETE /questions/<question_id>"""
         last_question = Question.query.order_by(Question.id.desc()).first()
@@ -351,6 +1411,119 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not Found')
 
+    def insert_retired_category(self, count):
+        """Return ID of a new category and IDs of its count questions"""
+        with self.app.app_context():
+            category = Category('Retired')
+            db.session.add(category)
+            db.session.commit()
+            questions = [Question(f'Retired question {i}?', 'answer',
+                                  category.id, i % 2 + 1)
+                         for i in range(count)]
+            db.session.add_all(questions)
+            db.session.commit()
+            return category.id, [question.id for question in questions]
+
+    def delete_retired_category(self, category_id):
+        """Delete category of insert_retired_category and its questions"""
+        self.client().delete('/questions', json={'category': category_id})
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+
+    def test_success_delete_questions_by_ids(self):
+        """Test success DELETE /questions for a list of IDs"""
+        category_id, question_ids = self.insert_retired_category(3)
+        try:
+            response = self.client().delete('/questions', json={
+                'ids': [question_ids[2], question_ids[0], 999999]
+            })
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['success'], True)
+            self.assertEqual(data['deleted'],
+                             [question_ids[0], question_ids[2]])
+            self.assertEqual(data['total_deleted'], 2)
+            self.assertCountsMatch()
+            response = self.client().get(
+                f'/categories/{category_id}/questions')
+            data = json.loads(response.data)
+            self.assertEqual([question['id'] for question in
+                              data['questions']], [question_ids[1]])
+            self.assertEqual(data['total_questions'], 1)
+        finally:
+            self.delete_retired_category(category_id)
+
+    def test_success_delete_questions_by_category_and_difficulty(self):
+        """Test success DELETE /questions by category and difficulty"""
+        category_id, question_ids = self.insert_retired_category(4)
+        try:
+            response = self.client().delete('/questions', json={
+                'category': category_id,
+                'difficulty': 1
+            })
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['deleted'], question_ids[0::2])
+            self.assertCountsMatch()
+            response = self.client().delete('/questions', json={
+                'category': category_id
+            })
+            self.assertEqual(json.loads(response.data)['deleted'],
+                             question_ids[1::2])
+            self.assertCountsMatch()
+        finally:
+            self.delete_retired_category(category_id)
+
+    def test_success_delete_questions_updates_indexes(self):
+        """Test success DELETE /questions updates quiz and suggestions"""
+        category_id, retired_ids = self.insert_retired_category(2)
+        try:
+            quiz = {'previous_questions': [],
+                    'quiz_category': {'id': category_id}}
+            response = self.client().post('/quizzes', json=quiz)
+            self.assertIsNotNone(json.loads(response.data)['question'])
+            response = self.client().get(
+                '/questions/suggest?prefix=Retired question')
+            self.assertEqual(len(json.loads(response.data)['suggestions']),
+                             2)
+            with self.app.app_context():
+                index = question_ids()
+            self.client().delete('/questions', json={'ids': retired_ids})
+            with self.app.app_context():
+                # Updated in place rather than rebuilt
+                self.assertIs(question_ids(), index)
+            response = self.client().post('/quizzes', json=quiz)
+            self.assertIsNone(json.loads(response.data)['question'])
+            response = self.client().get(
+                '/questions/suggest?prefix=Retired question')
+            self.assertEqual(json.loads(response.data)['suggestions'], [])
+            for difficulty in [1, 2]:
+                self.assertFalse(set(retired_ids) &
+                                 set(index.buckets[(0, difficulty)]))
+        finally:
+            self.delete_retired_category(category_id)
+
+    def test_success_delete_questions_none_matching(self):
+        """Test success DELETE /questions deletes nothing when none match"""
+        response = self.client().delete('/questions', json={'ids': []})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], [])
+        self.assertEqual(data['total_deleted'], 0)
+
+    def test_error_delete_questions_not_valid(self):
+        """Test error DELETE /questions without filters or with bad ones"""
+        for body in [{}, {'ids': 'all'}, {'ids': [1, '2']}, {'ids': [True]},
+                     {'category': '1'}, {'difficulty': None},
+                     {'ids': list(range(10001))}]:
+            response = self.client().delete('/questions', json=body)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['success'], False)
+        response = self.client().delete('/questions', json=[1, 2])
+        self.assertEqual(response.status_code, 400)
+
     def test_success_post_quizzes_for_all_categories(self):
         """Test success POST /quizzes for all categories"""
         quiz = {
@@ -396,46 +1569,455 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['question'], None)
 
-    def test_error_post_quizzes_request_body_missing(self):
-        """Test error POST /quizzes when request body not JSON"""
-        response = self.client().post('/quizzes', json=None)
-        data = json.loads(response.data)
-        self.assertEqual(response.status_code, 400)
-        self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Bad Request')
-
-    def test_error_post_quizzes_previous_questions_not_valid_type(self):
-        """Test success POST /quizzes when previous questions not valid type"""
-        quiz = {
-            'previous_questions': {},
-            'quiz_category': {
-                'type': 'Other',
-                'id': '1'
+    def test_success_post_quizzes_plays_every_question_once(self):
+        """Test success POST /quizzes returns each question once until none"""
+        previous_questions = []
+        while True:
+            quiz = {
+                'previous_questions': previous_questions,
+                'quiz_category': {
+                    'type': 'Science',
+                    'id': '1'
+                }
             }
-        }
-        response = self.client().post('/quizzes', json=quiz)
-        data = json.loads(response.data)
-        self.assertEqual(response.status_code, 422)
-        self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable Entity')
+            response = self.client().post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            if data['question'] is None:
+                break
+            self.assertEqual(data['question']['category'], 1)
+            self.assertNotIn(data['question']['id'], previous_questions)
+            previous_questions.append(data['question']['id'])
+        with self.app.app_context():
+            expected_ids = [question.id for question in Question.query.filter(
+                Question.category == 1).order_by(Question.id).all()]
+        self.assertEqual(sorted(previous_questions), expected_ids)
+
+    def test_success_post_quizzes_loads_few_rows(self):
+        """Test success POST /quizzes does not load every question"""
+        loaded = []
+
+        def on_load(question, context):
+            loaded.append(question.id)
 
-    def test_error_post_quizzes_previous_questions_blank(self):
-        """Test success POST /quizzes when previous questions blank"""
         quiz = {
-            'previous_questions': '',
+            'previous_questions': [],
             'quiz_category': {
-                'type': 'Other',
-                'id': '1'
+                'type': 'All',
+                'id': '0'
             }
         }
-        response = self.client().post('/quizzes', json=quiz)
-        data = json.loads(response.data)
-        self.assertEqual(response.status_code, 422)
-        self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable Entity')
+        event.listen(Question, 'load', on_load)
+        try:
+            response = self.client().post('/quizzes', json=quiz)
+        finally:
+            event.remove(Question, 'load', on_load)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(loaded), 1)
 
-    def test_error_post_quizzes_previous_questions_missing(self):
-        """Test success POST /quizzes when previous questions missing"""
+    def sports_quiz(self, previous_questions):
+        """Return question of POST /quizzes for Sports, None when none remain"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': previous_questions,
+            'quiz_category': {'type': 'Sports', 'id': 6}
+        })
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['question']
+
+    def test_success_question_ids_index(self):
+        """Test success QuestionIds keeps sorted IDs by category"""
+        index = QuestionIds('sqlite://', 0)
+        for question_id, category_id, difficulty in [
+                (5, 1, 1), (2, 2, 3), (9, 1, 3), (7, None, 2)]:
+            index.add(question_id, category_id, difficulty)
+        self.assertEqual(list(index.buckets[(0, 3)]), [2, 9])
+        self.assertEqual(list(index.buckets[(1, 1)]), [5])
+        index.add(5, 2, 3)
+        index.remove(9)
+        self.assertEqual(list(index.buckets[(0, 1)]), [])
+        self.assertEqual(list(index.buckets[(0, 3)]), [2, 5])
+        self.assertEqual(list(index.buckets[(1, 3)]), [])
+        self.assertEqual(list(index.buckets[(2, 3)]), [2, 5])
+        self.assertEqual(index.sample_unseen(2, {2}, 1), [5])
+        self.assertEqual(index.sample_unseen(2, {2, 5}, 1), [])
+        self.assertEqual(index.sample_unseen(3, set(), 1), [])
+        self.assertEqual(sorted(index.sample_unseen(0, {7}, 5)), [2, 5])
+        self.assertEqual({index.sample_unseen(0, {7}, 1)[0]
+                          for _ in range(200)}, {2, 5})
+
+    def test_success_post_quizzes_follows_question_writes(self):
+        """Test success POST /quizzes serves posted questions, not deleted"""
+        with self.app.app_context():
+            sports_ids = [question_id for question_id, in
+                          Question.query.with_entities(Question.id).filter(
+                              Question.category == 6)]
+        response = self.client().post('/questions', json={
+            'question': 'Quiz index question?', 'answer': 'Yes',
+            'category': 6, 'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        try:
+            self.assertEqual(self.sports_quiz(sports_ids)['id'], created)
+        finally:
+            self.client().delete(f'/questions/{created}')
+        self.assertIsNone(self.sports_quiz(sports_ids))
+
+    def test_success_post_quizzes_skips_question_deleted_elsewhere(self):
+        """Test success POST /quizzes skips questions deleted outside the ORM"""
+        with self.app.app_context():
+            sports_ids = [question_id for question_id, in
+                          Question.query.with_entities(Question.id).filter(
+                              Question.category == 6)]
+            question = Question('Quiz index question?', 'Yes', 6, 1)
+            question.insert()
+            self.sports_quiz(sports_ids)
+            # Bypasses the session events that keep the index current
+            with db.engine.begin() as connection:
+                connection.execute(Question.__table__.delete().where(
+                    Question.id == question.id))
+            reconcile_question_counts()
+        self.assertIsNone(self.sports_quiz(sports_ids))
+
+    def test_success_post_quizzes_after_bulk_import(self):
+        """Test success POST /quizzes serves questions imported in bulk"""
+        with self.app.app_context():
+            sports_ids = [question_id for question_id, in
+                          Question.query.with_entities(Question.id).filter(
+                              Question.category == 6)]
+        self.sports_quiz(sports_ids)
+        response = self.client().post('/questions/bulk', json=[{
+            'question': 'Quiz index bulk question?', 'answer': 'Yes',
+            'category': 6, 'difficulty': 1
+        }])
+        self.assertEqual(response.status_code, 200)
+        try:
+            question = self.sports_quiz(sports_ids)
+            self.assertEqual(question['question'], 'Quiz index bulk question?')
+        finally:
+            self.delete_questions_like('Quiz index bulk question?')
+
+    def worker_apps(self, reader_config):
+        """Return reader app of reader config and writer app of a database"""
+        apps = []
+        for config in [reader_config, {'DATA_VERSION_TABLE': True}]:
+            app = create_app(config)
+            setup_db(app, self.database_path)
+            apps.append(app)
+        return apps
+
+    def test_success_question_ids_catch_up_with_other_workers(self):
+        """Test success question ID index loads questions of other apps"""
+        for config in [{'DATA_VERSION_TABLE': True}, {'CACHE_TTL': 0}]:
+            reader, writer = self.worker_apps(config)
+            with reader.app_context():
+                index = question_ids()
+            response = writer.test_client().post('/questions', json={
+                'question': 'Quiz index question?', 'answer': 'Yes',
+                'category': 6, 'difficulty': 1
+            })
+            created = json.loads(response.data)['created']
+            try:
+                with reader.app_context():
+                    # Caught up in place rather than rebuilt
+                    self.assertIs(question_ids(), index)
+                    self.assertIn(created, index.buckets[(6, 1)])
+                    self.assertEqual(index.max_id, created)
+                    self.assertFalse(index.missed_writes)
+            finally:
+                writer.test_client().delete(f'/questions/{created}')
+
+    def test_success_suggestions_catch_up_with_other_workers(self):
+        """Test success n-gram index loads questions of other apps"""
+        reader, writer = self.worker_apps({'DATA_VERSION_TABLE': True})
+        reader.test_client().get('/questions/suggest?prefix=wombat')
+        index = reader.extensions['trivia_indexes']['ngrams']
+        response = writer.test_client().post('/questions', json={
+            'question': 'Where do wombats sleep?', 'answer': 'Burrows',
+            'category': 6, 'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        try:
+            response = reader.test_client().get(
+                '/questions/suggest?prefix=wombat')
+            self.assertEqual(json.loads(response.data)['suggestions'],
+                             ['Where do wombats sleep?'])
+            self.assertIs(reader.extensions['trivia_indexes']['ngrams'],
+                          index)
+            self.assertEqual(index.max_id, created)
+        finally:
+            writer.test_client().delete(f'/questions/{created}')
+
+    def test_success_question_ids_catch_up_without_waiting(self):
+        """Test success question ID index is served while catching up"""
+        reader, writer = self.worker_apps({'DATA_VERSION_TABLE': True})
+        with reader.app_context():
+            index = question_ids()
+        response = writer.test_client().post('/questions', json={
+            'question': 'Quiz index question?', 'answer': 'Yes',
+            'category': 6, 'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        try:
+            with reader.app_context(), index.catch_up_lock:
+                self.assertIs(question_ids(), index)
+                self.assertNotIn(created, index.buckets[(6, 1)])
+        finally:
+            writer.test_client().delete(f'/questions/{created}')
+
+    def test_success_question_ids_rebuilt_after_missed_delete(self):
+        """Test success question ID index is rebuilt in the background"""
+        reader, writer = self.worker_apps({
+            'DATA_VERSION_TABLE': True, 'INDEX_REBUILD_INTERVAL': 0})
+        response = writer.test_client().post('/questions', json={
+            'question': 'Quiz index question?', 'answer': 'Yes',
+            'category': 6, 'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        with reader.app_context():
+            index = question_ids()
+            self.assertIn(created, index.buckets[(6, 1)])
+        writer.test_client().delete(f'/questions/{created}')
+        with reader.app_context():
+            self.assertIs(question_ids(), index)
+            self.assertTrue(index.missed_writes)
+        reader.extensions['trivia_index_rebuilds']['question_ids'].join()
+        with reader.app_context():
+            rebuilt = question_ids()
+        self.assertIsNot(rebuilt, index)
+        self.assertNotIn(created, rebuilt.buckets[(6, 1)])
+        self.assertFalse(rebuilt.missed_writes)
+
+    def test_success_post_quizzes_count(self):
+        """Test success POST /quizzes for count questions in one query"""
+        quiz = {
+            'previous_questions': [2, 4],
+            'quiz_category': {'type': 'All', 'id': 0},
+            'count': 5
+        }
+        self.client().post('/quizzes', json=quiz)
+        statements, response = self.statements_during(
+            self.app, lambda: self.client().post('/quizzes', json=quiz))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('question', data)
+        question_ids = [question['id'] for question in data['questions']]
+        self.assertEqual(len(set(question_ids)), 5)
+        self.assertFalse({2, 4} & set(question_ids))
+        self.assertEqual(len(statements), 1)
+
+    def test_success_post_quizzes_count_fewer_remain(self):
+        """Test success POST /quizzes for count when fewer questions remain"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [20],
+            'quiz_category': {'type': 'Science', 'id': 1},
+            'count': 10
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(question['id'] for question in
+                                data['questions']), [21, 22])
+
+    def test_error_post_quizzes_count_not_valid(self):
+        """Test error POST /quizzes when count not valid"""
+        quizzes = [{'previous_questions': [], 'count': count}
+                   for count in [0, MAX_QUIZ_COUNT + 1, '5', True, 2.5]]
+        quizzes.append({'quiz_session': 42, 'count': 5})
+        for quiz in quizzes:
+            quiz['quiz_category'] = {'type': 'All', 'id': 0}
+            response = self.client().post('/quizzes', json=quiz)
+            self.assertEqual(response.status_code, 422)
+
+    def test_success_post_quizzes_adaptive(self):
+        """Test success POST /quizzes for adaptive strategy"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'All', 'id': 0},
+            'strategy': 'adaptive',
+            'correct': 8,
+            'incorrect': 1,
+            'count': 3
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['questions']), 3)
+
+    def test_success_post_quizzes_weighted(self):
+        """Test success POST /quizzes for weighted strategy"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Science', 'id': 1},
+            'strategy': 'weighted'
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['category'], 1)
+
+    def test_error_post_quizzes_strategy_not_valid(self):
+        """Test error POST /quizzes when strategy or answer counts not valid"""
+        quizzes = [
+            {'previous_questions': [], 'strategy': 'hardest'},
+            {'previous_questions': [], 'strategy': 'adaptive', 'correct': -1},
+            {'previous_questions': [], 'strategy': 'adaptive',
+             'incorrect': '2'},
+            {'quiz_session': 42, 'strategy': 'weighted'}
+        ]
+        for quiz in quizzes:
+            quiz['quiz_category'] = {'type': 'All', 'id': 0}
+            response = self.client().post('/quizzes', json=quiz)
+            self.assertEqual(response.status_code, 422)
+
+    def play_quiz_session(self, quiz_session, category_id, on_turn=None):
+        """Return question IDs played in a quiz session until none remain"""
+        question_ids = []
+        while True:
+            quiz = {
+                'quiz_session': quiz_session,
+                'quiz_category': {
+                    'id': category_id
+                }
+            }
+            response = self.client().post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['success'], True)
+            self.assertIsInstance(data['quiz_session'], str)
+            quiz_session = data['quiz_session']
+            if data['question'] is None:
+                return question_ids
+            question_ids.append(data['question']['id'])
+            if on_turn is not None:
+                on_turn(question_ids)
+
+    def test_success_post_quizzes_session_plays_every_question_once(self):
+        """Test success POST /quizzes session plays each question once"""
+        question_ids = self.play_quiz_session(1234, '0')
+        self.assertEqual(len(question_ids), len(set(question_ids)))
+        with self.app.app_context():
+            expected_ids = [question.id for question in
+                            Question.query.order_by(Question.id).all()]
+        self.assertEqual(sorted(question_ids), expected_ids)
+
+    def test_success_post_quizzes_session_for_category(self):
+        """Test success POST /quizzes session for a category"""
+        question_ids = self.play_quiz_session('', '1')
+        with self.app.app_context():
+            expected_ids = [question.id for question in Question.query.filter(
+                Question.category == 1).order_by(Question.id).all()]
+        self.assertEqual(sorted(question_ids), expected_ids)
+
+    def test_success_post_quizzes_session_same_seed_same_order(self):
+        """Test success POST /quizzes session order is decided by seed"""
+        self.assertEqual(self.play_quiz_session(99, '0'),
+                         self.play_quiz_session(99, '0'))
+        self.assertNotEqual(self.play_quiz_session(99, '0'),
+                            self.play_quiz_session(100, '0'))
+
+    def test_success_post_quizzes_session_questions_changed(self):
+        """Test success POST /quizzes session when questions added, deleted"""
+        changes = {}
+        with self.app.app_context():
+            candidates = [Question('question', 'answer', 6, 1)
+                          for _ in range(3)]
+            for candidate in candidates:
+                candidate.insert()
+            candidate_ids = [candidate.id for candidate in candidates]
+            original_ids = [question.id for question in Question.query.all()]
+
+        def on_turn(question_ids):
+            if len(question_ids) != 2:
+                return
+            with self.app.app_context():
+                deleted_id = [candidate_id for candidate_id in candidate_ids
+                              if candidate_id not in question_ids][0]
+                Question.query.get(deleted_id).delete()
+                changes['deleted'] = deleted_id
+                added = Question('question', 'answer', 6, 1)
+                added.insert()
+                changes['added'] = added.id
+
+        question_ids = self.play_quiz_session(4321, '0', on_turn)
+        with self.app.app_context():
+            for question_id in candidate_ids + [changes['added']]:
+                question = Question.query.get(question_id)
+                if question is not None:
+                    question.delete()
+        self.assertEqual(len(question_ids), len(set(question_ids)))
+        self.assertNotIn(changes['deleted'], question_ids)
+        self.assertEqual(
+            sorted(set(question_ids) - {changes['added']}),
+            sorted(set(original_ids) - {changes['deleted']}))
+
+    def test_success_quiz_session_sparse_and_dense_same_order(self):
+        """Test success quiz session plays same order sparse and dense"""
+        with self.app.app_context():
+            orders = []
+            for next_question in ['next_sparse_question',
+                                  'next_dense_question']:
+                session = QuizSession(5678, 8)
+                order = []
+                question = getattr(session, next_question)(Question.query)
+                while question is not None:
+                    order.append(question.id)
+                    question = getattr(session, next_question)(Question.query)
+                orders.append(order)
+        self.assertEqual(orders[0], orders[1])
+        self.assertEqual(len(orders[0]), len(set(orders[0])))
+
+    def test_error_post_quizzes_session_not_valid(self):
+        """Test error POST /quizzes when quiz session not valid"""
+        for quiz_session in ['not-a-session', [], True]:
+            quiz = {
+                'quiz_session': quiz_session,
+                'quiz_category': {
+                    'id': '0'
+                }
+            }
+            response = self.client().post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_error_post_quizzes_request_body_missing(self):
+        """Test error POST /quizzes when request body not JSON"""
+        response = self.client().post('/quizzes', json=None)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_error_post_quizzes_previous_questions_not_valid_type(self):
+        """Test success POST /quizzes when previous questions not valid type"""
+        quiz = {
+            'previous_questions': {},
+            'quiz_category': {
+                'type': 'Other',
+                'id': '1'
+            }
+        }
+        response = self.client().post('/quizzes', json=quiz)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_error_post_quizzes_previous_questions_blank(self):
+        """Test success POST /quizzes when previous questions blank"""
+        quiz = {
+            'previous_questions': '',
+            'quiz_category': {
+                'type': 'Other',
+                'id': '1'
+            }
+        }
+        response = self.client().post('/quizzes', json=quiz)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_error_post_quizzes_previous_questions_missing(self):
+        """Test success POST /quizzes when previous questions missing"""
         quiz = {
             'quiz_category': {
                 'type': 'Other',
@@ -507,6 +2089,1815 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable Entity')
 
+    def metric_value(self, text, name, route, status='200'):
+        """Return value of metric sample of GET requests to route"""
+        labels = f'{{method="GET",route="{route}",status="{status}"}}'
+        for line in text.splitlines():
+            if line.startswith(name + labels):
+                return float(line.split()[-1])
+        return None
+
+    def test_success_get_metrics(self):
+        """Test success GET /metrics counts requests, statements and bytes"""
+        first, listing = self.statements_during(
+            self.app, lambda: self.client().get('/questions'))
+        second, listing = self.statements_during(
+            self.app, lambda: self.client().get('/questions'))
+        response = self.client().get('/metrics')
+        text = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn(
+            '# TYPE trivia_request_duration_seconds histogram', text)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_request_duration_seconds_count', '/questions'), 2)
+        self.assertIn('trivia_request_duration_seconds_bucket{method="GET",'
+                      'route="/questions",status="200",le="+Inf"} 2', text)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_sql_statements_total', '/questions'),
+            len(first) + len(second))
+        self.assertEqual(self.metric_value(
+            text, 'trivia_response_bytes_total', '/questions'),
+            2 * len(listing.data))
+        # psycopg2 reports the rows of the page, counts and categories
+        self.assertGreater(self.metric_value(
+            text, 'trivia_sql_rows_total', '/questions'),
+            len(json.loads(listing.data)['questions']))
+
+    def test_success_get_metrics_by_route_and_status(self):
+        """Test success GET /metrics labels requests by route and status"""
+        self.client().get('/categories/999/questions')
+        self.client().get('/nowhere')
+        text = self.client().get('/metrics').get_data(as_text=True)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_request_duration_seconds_count',
+            '/categories/<int:category_id>/questions', '404'), 1)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_request_duration_seconds_count',
+            'unmatched', '404'), 1)
+
+    def test_success_get_metrics_streamed_response(self):
+        """Test success GET /metrics records streamed responses on close"""
+        response = self.client().get('/questions/export')
+        body = response.get_data()
+        response.close()
+        text = self.client().get('/metrics').get_data(as_text=True)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_request_duration_seconds_count',
+            '/questions/export'), 1)
+        self.assertEqual(self.metric_value(
+            text, 'trivia_response_bytes_total', '/questions/export'),
+            len(body))
+        self.assertEqual(self.metric_value(
+            text, 'trivia_sql_statements_total', '/questions/export'), 1)
+
+    def test_success_server_timing(self):
+        """Test success Server-Timing header when SERVER_TIMING is set"""
+        app = create_app({'SERVER_TIMING': True})
+        setup_db(app, self.database_path)
+        statements, response = self.statements_during(
+            app, lambda: app.test_client().get('/questions'))
+        self.assertRegex(
+            response.headers['Server-Timing'],
+            r'^app;dur=[0-9.]+, db;dur=[0-9.]+;desc="{} statements"$'.format(
+                len(statements)))
+        self.assertNotIn('Server-Timing',
+                         self.client().get('/questions').headers)
+
+    def test_success_setup_db_pool_settings(self):
+        """Test success setup_db takes pool settings from test_config"""
+        app = create_app({
+            'DATABASE_URL': self.database_path,
+            'DB_POOL_SIZE': 2,
+            'DB_MAX_OVERFLOW': 1,
+            'DB_POOL_RECYCLE': 600,
+            'DB_POOL_PRE_PING': True,
+            'DB_STATEMENT_TIMEOUT': 1500
+        })
+        with app.app_context():
+            engine = db.get_engine()
+            self.assertEqual(engine.url.database, 'trivia_test')
+            self.assertEqual(engine.pool.size(), 2)
+            self.assertEqual(engine.pool._max_overflow, 1)
+            self.assertEqual(engine.pool._recycle, 600)
+            self.assertTrue(engine.pool._pre_ping)
+            self.assertEqual(
+                db.session.execute('SHOW statement_timeout').scalar(),
+                '1500ms')
+
+    def test_success_setup_db_settings_from_environment(self):
+        """Test success setup_db takes settings from the environment"""
+        with mock.patch.dict(os.environ, {'DATABASE_URL': self.database_path,
+                                          'DB_POOL_SIZE': '3',
+                                          'DB_POOL_PRE_PING': 'true'}):
+            app = create_app({'DB_POOL_SIZE': 4})
+        with app.app_context():
+            engine = db.get_engine()
+            self.assertEqual(engine.url.database, 'trivia_test')
+            # test_config takes precedence over the environment
+            self.assertEqual(engine.pool.size(), 4)
+            self.assertTrue(engine.pool._pre_ping)
+
+    def test_error_statement_timeout(self):
+        """Test error statements running longer than DB_STATEMENT_TIMEOUT"""
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'DB_STATEMENT_TIMEOUT': 50})
+        with app.app_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute('SELECT pg_sleep(1)')
+            db.session.rollback()
+
+    def test_success_pool_status(self):
+        """Test success pool_status reports checkouts and overflow"""
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'DB_POOL_SIZE': 1,
+                          'DB_MAX_OVERFLOW': 1,
+                          'DB_POOL_TIMEOUT': 0.1})
+        with app.app_context():
+            engine = db.get_engine()
+            first = engine.connect()
+            second = engine.connect()
+            status = pool_status()
+            self.assertEqual(status['pool'], 'TimedQueuePool')
+            self.assertEqual(status['size'], 1)
+            self.assertEqual(status['checked_out'], 2)
+            self.assertEqual(status['overflow'], 1)
+            with self.assertRaises(TimeoutError):
+                engine.connect()
+            first.close()
+            second.close()
+            status = pool_status()
+        self.assertEqual(status['checked_out'], 0)
+        self.assertEqual(status['timeouts'], 1)
+        self.assertGreaterEqual(status['checkouts'], 3)
+        self.assertGreaterEqual(status['max_wait_seconds'], 0.1)
+        self.assertGreaterEqual(status['wait_seconds'],
+                                status['max_wait_seconds'])
+
+    def test_success_get_metrics_pool(self):
+        """Test success GET /metrics reports the connection pool"""
+        self.client().get('/categories')
+        text = self.client().get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE trivia_db_pool_checked_out gauge', text)
+        self.assertIn('trivia_db_pool_size 5\n', text)
+        self.assertRegex(text, r'trivia_db_pool_checkouts_total [1-9]')
+
+    def test_success_setup_db_skips_schema(self):
+        """Test success setup_db creates tables only when asked to"""
+        with tempfile.NamedTemporaryFile(suffix='.db') as database_file:
+            path = 'sqlite:///' + database_file.name
+            app = create_app()
+            setup_db(app, path)
+            with app.app_context():
+                self.assertEqual(inspect(db.engine).get_table_names(), [])
+            app = create_app({'CREATE_SCHEMA': True})
+            setup_db(app, path)
+            with app.app_context():
+                self.assertTrue({'categories', 'questions', 'data_versions',
+                                 'questions_search'} <=
+                                set(inspect(db.engine).get_table_names()))
+
+    def test_error_get_metrics_disabled(self):
+        """Test error GET /metrics when METRICS is off"""
+        app = create_app({'METRICS': False, 'SERVER_TIMING': True})
+        setup_db(app, self.database_path)
+        self.assertNotIn('trivia_metrics', app.extensions)
+        self.assertNotIn('Server-Timing',
+                         app.test_client().get('/questions').headers)
+        response = app.test_client().get('/metrics')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        with app.app_context():
+            self.assertFalse(event.contains(
+                db.get_engine(), 'after_cursor_execute', count_statement))
+        self.client().get('/categories')
+        with self.app.app_context():
+            self.assertTrue(event.contains(
+                db.get_engine(), 'after_cursor_execute', count_statement))
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """
+    This class represents the query budget of each endpoint test case
+    Budgets are for the first request of a worker, with the question ID
+    index built at startup and the other caches still empty. Rows are the
+    row counts psycopg2 reports, with 6 categories in the test database
+    and 7 question counts, one of them for all questions.
+    """
+
+    def setUp(self):
+        """Define test variables and initialize app with built index."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = 'postgresql://localhost:5432/trivia_test'
+        setup_db(self.app, self.database_path, create=True)
+        with self.app.app_context():
+            question_ids()
+
+    def insert_question(self):
+        """Return ID of new Sports question"""
+        with self.app.app_context():
+            question = Question(question='Budget question?', answer='Budget',
+                                category=6, difficulty=1)
+            question.insert()
+            return question.id
+
+    def delete_questions(self):
+        """Delete questions the tests inserted"""
+        with self.app.app_context():
+            Question.query.filter(
+                Question.question == 'Budget question?').delete()
+            db.session.commit()
+            reconcile_question_counts()
+
+    @QueryBudget(statements=1, rows=6)
+    def test_budget_get_categories(self):
+        """Test GET /categories reads the categories once"""
+        self.assertEqual(self.client().get('/categories').status_code, 200)
+
+    @QueryBudget(statements=2, rows=7 + QUESTIONS_PER_PAGE)
+    def test_budget_get_questions_by_category(self):
+        """Test GET /categories/1/questions reads counts and one page"""
+        response = self.client().get('/categories/1/questions')
+        self.assertEqual(response.status_code, 200)
+
+    @QueryBudget(statements=3, rows=7 + QUESTIONS_PER_PAGE + 6)
+    def test_budget_get_questions(self):
+        """Test GET /questions reads counts, one page and categories"""
+        self.assertEqual(self.client().get('/questions').status_code, 200)
+
+    @QueryBudget(statements=3, rows=7 + QUESTIONS_PER_PAGE + 1 + 6)
+    def test_budget_get_questions_after(self):
+        """Test GET /questions after cursor reads one more row than a page"""
+        response = self.client().get(f'/questions?after={encode_cursor(5)}')
+        self.assertEqual(response.status_code, 200)
+
+    # The suggestion index streams questions from a server-side cursor,
+    # which reports no row count
+    @QueryBudget(statements=2)
+    def test_budget_get_question_suggestions(self):
+        """Test GET /questions/suggest builds its index in one read"""
+        response = self.client().get('/questions/suggest?prefix=Who')
+        self.assertEqual(response.status_code, 200)
+
+    @QueryBudget(statements=2, rows=QUESTIONS_PER_PAGE + 1)
+    def test_budget_post_questions_search(self):
+        """Test POST /questions search reads a full page and its count"""
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'the'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_budget_post_questions(self):
+        """Test POST /questions reads categories, inserts and counts once"""
+        try:
+            with QueryBudget(statements=4, rows=6 + 1 + 1, app=self.app):
+                response = self.client().post('/questions', json={
+                    'question': 'Budget question?',
+                    'answer': 'Budget',
+                    'category': 6,
+                    'difficulty': 1
+                })
+            self.assertEqual(response.status_code, 200)
+        finally:
+            self.delete_questions()
+
+    def test_budget_post_questions_bulk(self):
+        """Test POST /questions/bulk reads categories and counts once"""
+        # COPY runs on the raw connection, out of sight of engine events
+        questions = [{'question': 'Budget question?', 'answer': 'Budget',
+                      'category': 6, 'difficulty': 1}] * 100
+        try:
+            with QueryBudget(statements=2, rows=6, app=self.app):
+                response = self.client().post('/questions/bulk',
+                                              json=questions)
+            self.assertEqual(response.status_code, 200)
+        finally:
+            self.delete_questions()
+
+    # Exports stream from a server-side cursor, which reports no row count
+    @QueryBudget(statements=1)
+    def test_budget_get_questions_export(self):
+        """Test GET /questions/export reads questions in one statement"""
+        response = self.client().get('/questions/export')
+        response.get_data()
+        response.close()
+        self.assertEqual(response.status_code, 200)
+
+    def test_budget_delete_question(self):
+        """Test DELETE /questions/<id> loads, deletes and counts once"""
+        question_id = self.insert_question()
+        try:
+            with QueryBudget(statements=3, rows=1, app=self.app):
+                response = self.client().delete(f'/questions/{question_id}')
+            self.assertEqual(response.status_code, 200)
+        finally:
+            self.delete_questions()
+
+    def test_budget_delete_questions(self):
+        """Test DELETE /questions deletes in one statement and counts once"""
+        question_ids = [self.insert_question() for _ in range(20)]
+        try:
+            with QueryBudget(statements=2, rows=20, app=self.app):
+                response = self.client().delete('/questions',
+                                                json={'ids': question_ids})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            self.delete_questions()
+
+    @QueryBudget(statements=2, rows=6 + 1)
+    def test_budget_post_quizzes(self):
+        """Test POST /quizzes reads categories and one question"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Science', 'id': 1}
+        })
+        self.assertEqual(response.status_code, 200)
+
+    @QueryBudget(statements=1, rows=MAX_QUIZ_COUNT)
+    def test_budget_post_quizzes_count(self):
+        """Test POST /quizzes with count reads the questions at once"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0},
+            'count': MAX_QUIZ_COUNT
+        })
+        self.assertEqual(response.status_code, 200)
+
+    @QueryBudget(statements=0, rows=0)
+    def test_budget_get_metrics(self):
+        """Test GET /metrics reads nothing from the database"""
+        self.assertEqual(self.client().get('/metrics').status_code, 200)
+
+    def test_budget_many_requests(self):
+        """Test warm listing requests read one page each"""
+        self.client().get('/questions')
+        with QueryBudget(statements=10, app=self.app):
+            for page in range(1, 11):
+                self.client().get(f'/questions?page={page}')
+
+    def test_error_budget_exceeded(self):
+        """Test error QueryBudget fails over budget and logs repeats"""
+        with self.assertLogs(__name__, 'WARNING') as logs:
+            with self.assertRaises(AssertionError) as error:
+                with QueryBudget(statements=2, app=self.app, debug=True):
+                    for _ in range(3):
+                        self.client().get('/categories/1/questions')
+        self.assertIn('over budget of 2', str(error.exception))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Statement run 3 times', logs.output[0])
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """
+    This class represents the read replica routing test case, on a primary
+    and a replica SQLite file whose answers tell which one served a read
+    """
+
+    def setUp(self):
+        """Seed primary, copy it to replica and initialize app on both."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.primary_path = 'sqlite:///' + os.path.join(
+            self.directory.name, 'primary.db')
+        self.replica_path = 'sqlite:///' + os.path.join(
+            self.directory.name, 'replica.db')
+        seed_app = create_app({'DATABASE_URL': self.primary_path,
+                               'CREATE_SCHEMA': True})
+        with seed_app.app_context():
+            db.session.add(Category('Science'))
+            db.session.commit()
+            for question in ['What is the heaviest organ?',
+                             'Who discovered penicillin?']:
+                Question(question, 'Primary', 1, 1).insert()
+            db.session.remove()
+        shutil.copy(os.path.join(self.directory.name, 'primary.db'),
+                    os.path.join(self.directory.name, 'replica.db'))
+        self.app = self.replica_app(self.replica_path)
+        with db.get_engine(self.app, 'replica').begin() as connection:
+            connection.execute("UPDATE questions SET answer = 'Replica'")
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        """Executed after each test"""
+        with self.app.app_context():
+            db.session.remove()
+        self.directory.cleanup()
+
+    def replica_app(self, replica_path, **config):
+        """Return app reading from replica_path"""
+        return create_app({'DATABASE_URL': self.primary_path,
+                           'REPLICA_DATABASE_URL': replica_path,
+                           'REPLICA_READ_YOUR_WRITES': 5, **config})
+
+    def answers(self, response):
+        """Return set of answers of listed questions"""
+        return {question['answer']
+                for question in json.loads(response.data)['questions']}
+
+    def test_success_get_questions_from_replica(self):
+        """Test success GET /questions reads questions from the replica"""
+        response = self.client().get('/questions')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.answers(response), {'Replica'})
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_success_post_question_to_primary(self):
+        """Test success POST /questions writes to the primary only"""
+        response = self.client().post('/questions', json={
+            'question': 'What is the largest planet?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 1
+        })
+        self.assertEqual(response.status_code, 200)
+        question_id = json.loads(response.data)['created']
+        query = f'SELECT COUNT(*) FROM questions WHERE id = {question_id}'
+        self.assertEqual(db.get_engine(self.app).scalar(query), 1)
+        self.assertEqual(
+            db.get_engine(self.app, 'replica').scalar(query), 0)
+
+    def test_success_read_your_writes(self):
+        """Test success a client reads the primary for a while after writes"""
+        writer = self.client()
+        response = writer.post('/questions', json={
+            'question': 'What is the largest planet?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 1
+        })
+        self.assertIn('trivia_read_primary_until=',
+                      response.headers['Set-Cookie'])
+        self.assertIn('Max-Age=5', response.headers['Set-Cookie'])
+        self.assertEqual(self.answers(writer.get('/questions')),
+                         {'Primary', 'Jupiter'})
+        self.assertEqual(self.answers(self.client().get('/questions')),
+                         {'Replica'})
+        writer.set_cookie('localhost', 'trivia_read_primary_until',
+                          str(time.time() - 1))
+        self.assertEqual(self.answers(writer.get('/questions')),
+                         {'Replica'})
+
+    def test_success_search_from_replica(self):
+        """Test success POST /questions search reads from the replica"""
+        app = self.replica_app(self.replica_path, SEARCH_CACHE_MAX_BYTES=0)
+        response = app.test_client().post('/questions',
+                                          json={'searchTerm': 'penicillin'})
+        self.assertEqual(self.answers(response), {'Replica'})
+
+    def test_success_cached_search_from_primary(self):
+        """Test success POST /questions search caches results of primary"""
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'penicillin'})
+        self.assertEqual(self.answers(response), {'Primary'})
+
+    def test_success_unhealthy_replica_falls_back_to_primary(self):
+        """Test success reads go to the primary while the replica is down"""
+        app = self.replica_app('sqlite:///' + os.path.join(
+            self.directory.name, 'missing', 'replica.db'))
+        response = app.test_client().get('/questions')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.answers(response), {'Primary'})
+        self.assertFalse(app.extensions['trivia_replica'].health.healthy)
+
+    def test_success_replica_checked_again_after_interval(self):
+        """Test success reads return to the replica once it is healthy"""
+        health = self.app.extensions['trivia_replica'].health
+        health.mark_unhealthy()
+        self.assertEqual(self.answers(self.client().get('/questions')),
+                         {'Primary'})
+        health.checked_at -= health.interval
+        self.assertEqual(self.answers(self.client().get('/questions')),
+                         {'Replica'})
+
+    def test_success_post_quizzes_keeps_questions_replica_lacks(self):
+        """Test success POST /quizzes keeps IDs a lagging replica lacks"""
+        with self.app.app_context():
+            question = Question('What is the largest planet?', 'Jupiter', 1,
+                                1)
+            question.insert()
+            question_id = question.id
+        with db.get_engine(self.app, 'replica').begin() as connection:
+            self.assertEqual(connection.scalar(
+                f'SELECT COUNT(*) FROM questions WHERE id = {question_id}'),
+                0)
+        response = self.client().post('/quizzes', json={
+            'previous_questions': [1, 2],
+            'quiz_category': {'type': 'Science', 'id': 1}
+        })
+        self.assertEqual(json.loads(response.data)['question'], None)
+        with self.app.app_context():
+            self.assertIn(question_id, question_ids().buckets[(1, 1)])
+
+
+class SearchCacheTestCase(unittest.TestCase):
+    """This class represents the search cache test case"""
+
+    def setUp(self):
+        """Create a shared cache file for the shared cache tests"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'search_cache.db')
+
+    def tearDown(self):
+        """Executed after each test"""
+        shutil.rmtree(self.directory)
+
+    def caches(self, max_bytes=1 << 20, max_entries=100, ttl=None):
+        """Return a local and a shared cache with the same limits"""
+        return [LocalSearchCache(max_bytes, max_entries, ttl),
+                SharedSearchCache(self.path, max_bytes, max_entries, ttl)]
+
+    def test_success_get_put(self):
+        """Test success get returns body put at the same version"""
+        for cache in self.caches():
+            self.assertIsNone(cache.get('key', 'v1'))
+            cache.put('key', 'v1', b'body')
+            self.assertEqual(cache.get('key', 'v1'), b'body')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_success_get_stale_version(self):
+        """Test success get misses and drops entries of an older version"""
+        for cache in self.caches():
+            cache.put('key', 'v1', b'body')
+            self.assertIsNone(cache.get('key', 'v2'))
+            self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_success_evict_least_recently_used_by_entries(self):
+        """Test success put evicts least recently used beyond max entries"""
+        for cache in self.caches(max_entries=2):
+            cache.put('a', 'v1', b'a')
+            time.sleep(0.01)
+            cache.put('b', 'v1', b'b')
+            time.sleep(0.01)
+            if isinstance(cache, LocalSearchCache):
+                cache.get('a', 'v1')
+            else:
+                # Shared entries are touched at most once per interval
+                cache.put('a', 'v1', b'a')
+            time.sleep(0.01)
+            cache.put('c', 'v1', b'c')
+            self.assertIsNone(cache.get('b', 'v1'))
+            self.assertEqual(cache.get('a', 'v1'), b'a')
+            self.assertEqual(cache.get('c', 'v1'), b'c')
+            self.assertEqual(cache.evictions, 1)
+
+    def test_success_evict_by_bytes(self):
+        """Test success put keeps the bytes held within max bytes"""
+        max_bytes = 3 * (ENTRY_OVERHEAD + 101)
+        for cache in self.caches(max_bytes=max_bytes):
+            for key in 'abcde':
+                cache.put(key, 'v1', b'x' * 100)
+            stats = cache.stats()
+            self.assertEqual(stats['entries'], 3)
+            self.assertLessEqual(stats['bytes'], max_bytes)
+            self.assertEqual(cache.evictions, 2)
+            self.assertIsNone(cache.get('a', 'v1'))
+            self.assertEqual(cache.get('e', 'v1'), b'x' * 100)
+
+    def test_success_put_skips_larger_than_max_bytes(self):
+        """Test success put does not cache a body over max bytes"""
+        for cache in self.caches(max_bytes=1000):
+            cache.put('key', 'v1', b'x' * 1000)
+            self.assertIsNone(cache.get('key', 'v1'))
+            self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_success_get_expired(self):
+        """Test success get misses entries older than the TTL"""
+        for cache in self.caches(ttl=0.05):
+            cache.put('key', 'v1', b'body')
+            self.assertEqual(cache.get('key', 'v1'), b'body')
+            time.sleep(0.06)
+            self.assertIsNone(cache.get('key', 'v1'))
+
+    def test_success_shared_between_instances(self):
+        """Test success shared caches on one file see each other's entries"""
+        first = SharedSearchCache(self.path, 1 << 20, 100)
+        second = SharedSearchCache(self.path, 1 << 20, 100)
+        first.put('key', 'v1', b'body')
+        self.assertEqual(second.get('key', 'v1'), b'body')
+
+    def test_success_search_key_normalized(self):
+        """Test success search_key is the same for the same words"""
+        self.assertEqual(search_key('Penicillin?', None, None, None),
+                         search_key('  penicillin ', None, None, None))
+        self.assertEqual(search_key('who  DISCOVERED', '1', None, None),
+                         search_key('Who discovered', '1', None, None))
+        self.assertNotEqual(search_key('penicillin', '1', None, None),
+                            search_key('penicillin', '2', None, None))
+        self.assertNotEqual(search_key('penicillin', None, None, None),
+                            search_key('penicillin', None, None, ['id']))
+        self.assertNotEqual(search_key('%', None, None, None),
+                            search_key('_', None, None, None))
+
+
+class WriteBehindTestCase(unittest.TestCase):
+    """This class represents the write-behind question queue test case"""
+
+    def setUp(self):
+        """Create a SQLite database with one category."""
+        self.directory = tempfile.mkdtemp()
+        self.database_path = 'sqlite:///' + os.path.join(self.directory,
+                                                         'trivia.db')
+        self.journal_path = os.path.join(self.directory, 'journal.ndjson')
+        self.apps = []
+        with self.write_behind_app(WRITE_BEHIND=False).app_context():
+            db.session.add(Category('Science'))
+            db.session.commit()
+
+    def tearDown(self):
+        """Stop the queues and remove the database"""
+        for app in self.apps:
+            if 'trivia_write_behind' in app.extensions:
+                app.extensions['trivia_write_behind'].close()
+            with app.app_context():
+                db.session.remove()
+        shutil.rmtree(self.directory)
+
+    def write_behind_app(self, **config):
+        """Return app on the test database with a write-behind queue"""
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'CREATE_SCHEMA': True,
+                          'WRITE_BEHIND': True,
+                          'WRITE_BEHIND_INTERVAL': 10,
+                          **config})
+        self.apps.append(app)
+        return app
+
+    def post_question(self, app, text='Queued question?'):
+        """Return response to POST /questions with a new question"""
+        return app.test_client().post('/questions', json={
+            'question': text,
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': 1
+        })
+
+    def wait_inserted(self, app, count, timeout=5):
+        """Wait until the queue of app has inserted all but count"""
+        queue = app.extensions['trivia_write_behind']
+        deadline = time.monotonic() + timeout
+        while queue.size() > count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(queue.size(), count)
+
+    def question_texts(self, app):
+        """Return sorted question texts in the database"""
+        with app.app_context():
+            return sorted(question for question, in
+                          Question.query.with_entities(Question.question))
+
+    def test_success_post_questions_synchronous_by_default(self):
+        """Test success POST /questions inserts at once by default"""
+        app = self.write_behind_app(WRITE_BEHIND=False)
+        self.assertNotIn('trivia_write_behind', app.extensions)
+        response = self.post_question(app)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(json.loads(response.data)['created'], int)
+        response = app.test_client().get('/questions/pending/unknown')
+        self.assertEqual(response.status_code, 404)
+
+    def test_success_post_questions_write_behind(self):
+        """Test success POST /questions queues and reports status"""
+        app = self.write_behind_app()
+        response = self.post_question(app)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(response.headers['Location'],
+                         'http://localhost' + data['status_url'])
+        status = json.loads(app.test_client().get(data['status_url']).data)
+        self.assertEqual(status['status'], 'pending')
+        self.assertEqual(self.question_texts(app), [])
+        app.extensions['trivia_write_behind'].close()
+        status = json.loads(app.test_client().get(data['status_url']).data)
+        self.assertEqual(status['status'], 'created')
+        self.assertEqual(self.question_texts(app), ['Queued question?'])
+        with app.app_context():
+            self.assertEqual(Question.query.get(status['created']).question,
+                             'Queued question?')
+        response = app.test_client().get('/categories/1/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'], 1)
+
+    def test_success_write_behind_batch_size(self):
+        """Test success write-behind inserts a full batch at once"""
+        app = self.write_behind_app(WRITE_BEHIND_BATCH_SIZE=3)
+        for i in range(2):
+            self.post_question(app, f'Queued question {i}?')
+        time.sleep(0.1)
+        self.assertEqual(self.question_texts(app), [])
+        self.post_question(app, 'Queued question 2?')
+        self.wait_inserted(app, 0)
+        self.assertEqual(len(self.question_texts(app)), 3)
+
+    def test_success_write_behind_interval(self):
+        """Test success write-behind inserts a partial batch in time"""
+        app = self.write_behind_app(WRITE_BEHIND_INTERVAL=0.05)
+        self.post_question(app)
+        self.wait_inserted(app, 0, timeout=1)
+        self.assertEqual(self.question_texts(app), ['Queued question?'])
+
+    def test_error_post_questions_write_behind_not_valid(self):
+        """Test error POST /questions validates before queueing"""
+        app = self.write_behind_app()
+        response = app.test_client().post('/questions', json={
+            'question': 'Queued question?',
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': 2
+        })
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(app.extensions['trivia_write_behind'].size(), 0)
+
+    def test_success_write_behind_failed_question_marked_alone(self):
+        """Test success a question failing outside the database fails alone"""
+        app = self.write_behind_app()
+        queue = app.extensions['trivia_write_behind']
+        original = Question.__init__
+
+        def init(instance, **values):
+            if values['question'] == 'Broken question?':
+                raise TypeError('broken')
+            original(instance, **values)
+
+        tokens = [json.loads(self.post_question(app, text).data)['pending']
+                  for text in ['First question?', 'Broken question?',
+                               'Last question?']]
+        with mock.patch.object(Question, '__init__', init):
+            queue.close()
+        self.assertEqual([queue.status(token)['status'] for token in tokens],
+                         ['created', 'failed', 'created'])
+        self.assertEqual(self.question_texts(app),
+                         ['First question?', 'Last question?'])
+
+    def test_success_write_behind_thread_survives_batch_error(self):
+        """Test success the write-behind thread outlives a failed batch"""
+        app = self.write_behind_app(WRITE_BEHIND_INTERVAL=0.05)
+        queue = app.extensions['trivia_write_behind']
+        with mock.patch.object(queue, 'insert',
+                               side_effect=ValueError('broken')):
+            token = json.loads(self.post_question(app).data)['pending']
+            self.wait_inserted(app, 0)
+        self.assertEqual(queue.status(token), {'status': 'failed'})
+        self.assertTrue(queue.thread.is_alive())
+        token = json.loads(self.post_question(app).data)['pending']
+        self.wait_inserted(app, 0)
+        self.assertEqual(queue.status(token)['status'], 'created')
+
+    def test_success_write_behind_retries_only_uncommitted(self):
+        """Test success questions committed one by one are not retried"""
+        app = self.write_behind_app()
+        queue = app.extensions['trivia_write_behind']
+        original = db.session.commit
+        calls = []
+
+        def commit():
+            calls.append(len(calls) + 1)
+            if len(calls) == 1:
+                raise IntegrityError('INSERT', {}, Exception('batch'))
+            if len(calls) == 3:
+                raise OperationalError('INSERT', {}, Exception('busy'))
+            original()
+
+        tokens = [json.loads(self.post_question(app, text).data)['pending']
+                  for text in ['q0', 'q1']]
+        with mock.patch('flaskr.write_behind.RETRY_DELAY', 0), \
+                mock.patch.object(db.session, 'commit', commit):
+            queue.close()
+        self.assertEqual(self.question_texts(app), ['q0', 'q1'])
+        self.assertEqual([queue.status(token)['status'] for token in tokens],
+                         ['created', 'created'])
+
+    def test_error_post_questions_write_behind_thread_stopped(self):
+        """Test error POST /questions when the write-behind thread died"""
+        app = self.write_behind_app()
+        queue = app.extensions['trivia_write_behind']
+        # Stop the thread as if it died, leaving the queue open
+        with queue.condition:
+            queue.closed = True
+            queue.condition.notify()
+        queue.thread.join()
+        queue.closed = False
+        response = self.post_question(app)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Service Unavailable')
+        self.assertEqual(queue.size(), 0)
+
+    def test_error_get_pending_question_unknown(self):
+        """Test error GET /questions/pending/<token> for unknown token"""
+        app = self.write_behind_app()
+        response = app.test_client().get('/questions/pending/unknown')
+        self.assertEqual(response.status_code, 404)
+
+    def test_success_write_behind_journal_replay(self):
+        """Test success journal questions not inserted are replayed"""
+        with open(self.journal_path, 'w') as journal:
+            for token in ['a', 'b', 'c']:
+                journal.write(json.dumps({'token': token, 'values': {
+                    'question': f'Journal question {token}?',
+                    'answer': 'answer',
+                    'category': 1,
+                    'difficulty': 1
+                }}) + '\n')
+            journal.write(json.dumps({'inserted': ['b']}) + '\n')
+            # Cut short by a crash
+            journal.write('{"token": "d", "val')
+        app = self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+        self.assertEqual(app.extensions['trivia_write_behind'].size(), 2)
+        app.extensions['trivia_write_behind'].close()
+        self.assertEqual(self.question_texts(app),
+                         ['Journal question a?', 'Journal question c?'])
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+    def test_success_write_behind_journal_replay_crash(self):
+        """Test success a crash while replaying keeps the journal whole"""
+        with open(self.journal_path, 'w') as journal:
+            for token in ['a', 'b']:
+                journal.write(json.dumps({'token': token, 'values': {
+                    'question': f'Journal question {token}?',
+                    'answer': 'answer',
+                    'category': 1,
+                    'difficulty': 1
+                }}) + '\n')
+            journal.write(json.dumps({'inserted': ['b']}) + '\n')
+        with open(self.journal_path) as journal:
+            records = journal.read()
+        with mock.patch('flaskr.write_behind.os.replace',
+                        side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+        with open(self.journal_path) as journal:
+            self.assertEqual(journal.read(), records)
+        app = self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+        with open(self.journal_path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+        app.extensions['trivia_write_behind'].close()
+        self.assertEqual(self.question_texts(app), ['Journal question a?'])
+
+    def test_success_write_behind_journal_survives_crash(self):
+        """Test success questions accepted before a crash are inserted"""
+        app = self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+        self.post_question(app)
+        queue = app.extensions['trivia_write_behind']
+        # A crashed process inserts nothing more and releases its journal
+        with queue.condition:
+            queue.pending.clear()
+            queue.closed = True
+            queue.condition.notify()
+        queue.thread.join()
+        queue.journal.close()
+        self.apps.remove(app)
+        app = self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path,
+                                    WRITE_BEHIND_INTERVAL=0.05)
+        self.wait_inserted(app, 0)
+        self.assertEqual(self.question_texts(app), ['Queued question?'])
+
+    def test_error_write_behind_journal_in_use(self):
+        """Test error two queues cannot share a journal"""
+        self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+        with self.assertRaises(RuntimeError):
+            self.write_behind_app(WRITE_BEHIND_JOURNAL=self.journal_path)
+
+
+class SelectionTestCase(unittest.TestCase):
+    """This class represents the quiz selection strategy test case"""
+
+    # Chi-square values exceeded by chance once in 1000 samples, by degrees
+    # of freedom
+    CHI_SQUARE_999 = {1: 10.83, 2: 13.82, 3: 16.27, 4: 18.47, 5: 20.52,
+                      99: 148.23}
+
+    def setUp(self):
+        """Seed random draws so statistical tests are repeatable."""
+        random.seed(14)
+
+    def assertDistribution(self, counts, weights):
+        """Assert counts by key fit shares of weights by chi-square test"""
+        self.assertLessEqual(set(counts), set(weights))
+        total = sum(counts.values())
+        weight_sum = sum(weights.values())
+        chi_square = 0
+        for key, weight in weights.items():
+            expected = total * weight / weight_sum
+            chi_square += (counts.get(key, 0) - expected) ** 2 / expected
+        self.assertLess(chi_square, self.CHI_SQUARE_999[len(weights) - 1])
+
+    def difficulty_index(self, sizes):
+        """Return index of category 1 with questions of sizes by difficulty"""
+        index = QuestionIds('sqlite://', 0)
+        question_id = 0
+        for difficulty, size in sizes.items():
+            for _ in range(size):
+                question_id += 1
+                index.add(question_id, 1, difficulty)
+        return index
+
+    def sampled_difficulties(self, index, draws, strategy, target=None,
+                             seen=frozenset()):
+        """Return counts of difficulty of single draws by strategy"""
+        difficulties = {question_id: difficulty
+                        for (category_id, difficulty), ids
+                        in index.buckets.items() if category_id == 1
+                        for question_id in ids}
+        return Counter(
+            difficulties[index.sample_unseen(1, seen, 1, strategy, target)[0]]
+            for _ in range(draws))
+
+    def test_success_alias_table_distribution(self):
+        """Test success AliasTable draws indexes in proportion to weights"""
+        weights = [1, 2, 3, 4, 0, 10]
+        table = AliasTable(weights)
+        counts = Counter(table.draw() for _ in range(50000))
+        self.assertNotIn(4, counts)
+        self.assertDistribution(counts, {i: weight for i, weight
+                                         in enumerate(weights) if weight})
+        self.assertEqual({AliasTable([3]).draw() for _ in range(10)}, {0})
+
+    def test_success_target_difficulty(self):
+        """Test success target difficulty follows share of correct answers"""
+        self.assertEqual(target_difficulty(0, 0), 3.0)
+        self.assertEqual(target_difficulty(9, 0), 4.6)
+        self.assertEqual(target_difficulty(0, 9), 1.4)
+
+    def test_success_uniform_strategy_distribution(self):
+        """Test success uniform strategy draws every question equally"""
+        index = self.difficulty_index({1: 10, 2: 30, 3: 60})
+        counts = Counter(index.sample_unseen(1, set(), 1, UNIFORM)[0]
+                         for _ in range(30000))
+        self.assertDistribution(counts, {i: 1 for i in range(1, 101)})
+
+    def test_success_weighted_strategy_distribution(self):
+        """Test success weighted strategy draws by difficulty weight"""
+        sizes = {1: 40, 2: 30, 3: 20, 4: 10}
+        index = self.difficulty_index(sizes)
+        counts = self.sampled_difficulties(index, 30000, WEIGHTED)
+        self.assertDistribution(counts, {
+            difficulty: size * DIFFICULTY_WEIGHTS[difficulty]
+            for difficulty, size in sizes.items()})
+
+    def test_success_adaptive_strategy_distribution(self):
+        """Test success adaptive strategy centres on the target difficulty"""
+        index = self.difficulty_index({1: 50, 2: 20, 3: 10, 4: 5, 5: 5})
+        for target in [1.4, 4.6]:
+            counts = self.sampled_difficulties(index, 30000, ADAPTIVE, target)
+            self.assertDistribution(counts, {
+                difficulty: math.exp(-(difficulty - target) ** 2 / 2)
+                for difficulty in range(1, 6)})
+
+    def test_success_strategy_skips_seen_questions(self):
+        """Test success strategies draw only unseen questions"""
+        index = self.difficulty_index({1: 5, 2: 5, 3: 5})
+        seen = set(range(1, 6)) | {6, 7}
+        for strategy in STRATEGIES:
+            counts = self.sampled_difficulties(
+                index, 3000, strategy, target=3.0, seen=seen)
+            self.assertEqual(set(counts), {2, 3})
+            self.assertEqual(sorted(index.sample_unseen(
+                1, seen, 20, strategy, 3.0)), list(range(8, 16)))
+
+
+class SQLiteSearchTestCase(unittest.TestCase):
+    """This class represents the trivia search test case on SQLite"""
+
+    def setUp(self):
+        """Define test variables and initialize app on a SQLite database."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+        setup_db(self.app, 'sqlite:///' + self.database_file.name,
+                 create=True)
+        with self.app.app_context():
+            db.session.add(Category('Science'))
+            db.session.commit()
+            Question('What is the heaviest organ?', 'The liver', 1, 1).insert()
+            Question('Who discovered penicillin?', 'Fleming', 1, 1).insert()
+
+    def tearDown(self):
+        """Executed after each test"""
+        with self.app.app_context():
+            db.session.remove()
+        self.database_file.close()
+
+    def test_success_post_questions_for_search_term(self):
+        """Test success POST /questions for search term on SQLite"""
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'liv heav'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([question['answer'] for question in data['questions']],
+                         ['The liver'])
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_success_post_questions_for_search_term_after_delete(self):
+        """Test success POST /questions for search term on SQLite after delete"""
+        with self.app.app_context():
+            Question.query.filter(Question.answer == 'Fleming').one().delete()
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'penicillin'})
+        data = json.loads(response.data)
+        self.assertEqual(data['questions'], [])
+
+    def test_success_question_counts_sqlite(self):
+        """Test success question counts follow writes and reconcile on SQLite"""
+        with self.app.app_context():
+            question = Question('Who painted the Mona Lisa?', 'Da Vinci', 1, 2)
+            question.insert()
+            question.delete()
+            counts = dict(QuestionCount.query.with_entities(
+                QuestionCount.category_id, QuestionCount.count))
+            self.assertEqual(counts, {0: 2, 1: 2})
+            QuestionCount.query.get(1).count = 5
+            db.session.commit()
+            self.assertEqual(reconcile_question_counts(), {1: (5, 2)})
+        response = self.client().get('/categories/1/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'], 2)
+
+    def test_success_begin_write_sqlite(self):
+        """Test success begin_write holds the SQLite write lock at once"""
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                begin_write(connection)
+                self.assertTrue(connection.connection.in_transaction)
+                other = sqlite3.connect(self.database_file.name, timeout=0)
+                try:
+                    with self.assertRaisesRegex(sqlite3.OperationalError,
+                                                'locked'):
+                        other.execute('UPDATE question_counts SET count = 0')
+                finally:
+                    other.close()
+                # Already writing, so no second BEGIN
+                begin_write(connection)
+
+    def test_success_question_counts_category_change_sqlite(self):
+        """Test success question counts follow an expired category change"""
+        with self.app.app_context():
+            question = Question.query.first()
+            db.session.add(Category('History'))
+            db.session.commit()
+            question.category = 2
+            db.session.commit()
+            counts = dict(QuestionCount.query.with_entities(
+                QuestionCount.category_id, QuestionCount.count))
+        self.assertEqual(counts, {0: 2, 1: 1, 2: 1})
+
+    def test_success_delete_questions_sqlite(self):
+        """Test success DELETE /questions by category on SQLite"""
+        response = self.client().delete('/questions', json={
+            'category': 1,
+            'difficulty': 1
+        })
+        self.assertEqual(json.loads(response.data)['deleted'], [1, 2])
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'liver'})
+        self.assertEqual(json.loads(response.data)['questions'], [])
+        with self.app.app_context():
+            self.assertEqual(dict(QuestionCount.query.with_entities(
+                QuestionCount.category_id, QuestionCount.count)),
+                {0: 0, 1: 0})
+
+    def test_success_upgrade_schema_sqlite(self):
+        """Test success upgrade_schema on SQLite keeps the indexes"""
+        with self.app.app_context():
+            upgrade_schema(log=lambda message: None)
+            indexes = {index['name'] for index in
+                       inspect(db.engine).get_indexes('questions')}
+        self.assertTrue({'ix_questions_category_id',
+                         'ix_questions_difficulty'} <= indexes)
+
+    def test_success_post_quizzes_sqlite(self):
+        """Test success POST /quizzes plays every question on SQLite"""
+        previous_questions = []
+        for _ in range(3):
+            response = self.client().post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'type': 'Science', 'id': 1}
+            })
+            question = json.loads(response.data)['question']
+            if question is None:
+                break
+            previous_questions.append(question['id'])
+        self.assertEqual(sorted(previous_questions), [1, 2])
+
+
+class ApiContractTests:
+    """
+    Tests of the routes and JSON contracts that create_app and
+    create_async_app both serve, mixed into a test case per app and
+    database below. Each test gets a Contract category of 12 questions,
+    deleted again afterwards, so the tests run on the shared PostgreSQL
+    test database too
+    """
+
+    async_app = False
+    database_url = 'postgresql://localhost:5432/trivia_test'
+
+    def setUp(self):
+        """Add the Contract category and create the app under test."""
+        self.fixture_app = create_app({'DATABASE_URL': self.database_url,
+                                       'CREATE_SCHEMA': True})
+        with self.fixture_app.app_context():
+            category = Category('Contract')
+            db.session.add(category)
+            db.session.commit()
+            self.category_id = category.id
+            import_questions([{
+                'question': f'Which quokka number {i}?',
+                'answer': f'Answer {i}',
+                'category': self.category_id,
+                'difficulty': i % 5 + 1
+            } for i in range(12)], {self.category_id})
+            self.question_ids = [question_id for question_id, in
+                                 Question.query.with_entities(Question.id)
+                                 .filter(Question.category ==
+                                         self.category_id)
+                                 .order_by(Question.id)]
+        if self.async_app:
+            self.start_app({'DATABASE_URL': self.database_url})
+        else:
+            self.app = self.fixture_app
+            self.client = self.app.test_client
+
+    def start_app(self, config):
+        """Replace the app under test by one of config"""
+        if not self.async_app:
+            self.app = create_app(config)
+            self.client = self.app.test_client
+            return
+        if hasattr(self, 'runner'):
+            self.runner.close()
+        self.app = create_async_app(config)
+        # Served from a runner of its own
+        self.runner = AsyncAppRunner(self.app)
+        self.client = self.runner.test_client
+
+    def tearDown(self):
+        """Delete the Contract category and its questions."""
+        if self.async_app:
+            self.runner.close()
+        with self.fixture_app.app_context():
+            delete_questions(category_id=self.category_id)
+            db.session.delete(Category.query.get(self.category_id))
+            db.session.commit()
+            db.session.remove()
+
+    def category_total(self):
+        """Return total_questions of the Contract category"""
+        response = self.client().get(
+            f'/categories/{self.category_id}/questions')
+        if response.status_code == 404:
+            return 0
+        return json.loads(response.data)['total_questions']
+
+    def assertError(self, response, code, message):
+        """Assert response is the JSON error of code"""
+        self.assertEqual(response.status_code, code)
+        self.assertEqual(json.loads(response.data), {
+            'success': False,
+            'error': code,
+            'message': message
+        })
+
+    def test_contract_get_categories(self):
+        """Test contract GET /categories"""
+        response = self.client().get('/categories')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['categories'][str(self.category_id)],
+                         'Contract')
+
+    def test_contract_get_questions_by_category(self):
+        """Test contract GET /categories/<id>/questions by page"""
+        response = self.client().get(
+            f'/categories/{self.category_id}/questions')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['current_category'], self.category_id)
+        self.assertEqual(data['total_questions'], 12)
+        self.assertEqual(data['questions'][0], {
+            'id': self.question_ids[0],
+            'question': 'Which quokka number 0?',
+            'answer': 'Answer 0',
+            'category': self.category_id,
+            'difficulty': 1
+        })
+        self.assertEqual([question['id'] for question in data['questions']],
+                         self.question_ids[:QUESTIONS_PER_PAGE])
+        response = self.client().get(
+            f'/categories/{self.category_id}/questions?page=2')
+        self.assertEqual([question['id'] for question in
+                          json.loads(response.data)['questions']],
+                         self.question_ids[QUESTIONS_PER_PAGE:])
+        self.assertError(self.client().get(
+            f'/categories/{self.category_id}/questions?page=3'),
+            404, 'Not Found')
+
+    def test_contract_get_questions_by_category_after_cursor(self):
+        """Test contract GET /categories/<id>/questions after cursors"""
+        seen = []
+        path = f'/categories/{self.category_id}/questions?after='
+        while True:
+            data = json.loads(self.client().get(path).data)
+            seen.extend(question['id'] for question in data['questions'])
+            if data['next_cursor'] is None:
+                break
+            path = f'/categories/{self.category_id}/questions?after=' + \
+                data['next_cursor']
+        self.assertEqual(seen, self.question_ids)
+        self.assertError(self.client().get('/questions?after=%%%'),
+                         422, 'Unprocessable Entity')
+
+    def test_contract_get_questions_fields(self):
+        """Test contract GET /categories/<id>/questions with fields"""
+        response = self.client().get(
+            f'/categories/{self.category_id}/questions?fields=answer')
+        self.assertEqual(json.loads(response.data)['questions'][1],
+                         {'id': self.question_ids[1], 'answer': 'Answer 1'})
+        self.assertError(self.client().get('/questions?fields=secret'),
+                         422, 'Unprocessable Entity')
+
+    def test_contract_get_questions(self):
+        """Test contract GET /questions"""
+        response = self.client().get('/questions')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertGreaterEqual(data['total_questions'], 12)
+        self.assertEqual(data['categories'][str(self.category_id)],
+                         'Contract')
+        self.assertError(self.client().get('/questions?page=100000'),
+                         404, 'Not Found')
+
+    def test_contract_post_questions_for_search_term(self):
+        """Test contract POST /questions for search term"""
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'quokka'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 12)
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        response = self.client().post('/questions?page=2',
+                                      json={'searchTerm': 'quokka'})
+        self.assertEqual(len(json.loads(response.data)['questions']), 2)
+        response = self.client().post('/questions',
+                                      json={'searchTerm': 'QUOKKA numb 7'})
+        data = json.loads(response.data)
+        self.assertEqual([question['answer'] for question in
+                          data['questions']], ['Answer 7'])
+        self.assertEqual(data['total_questions'], 1)
+        response = self.client().post('/questions?after=',
+                                      json={'searchTerm': 'quokka'})
+        data = json.loads(response.data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         self.question_ids[:QUESTIONS_PER_PAGE])
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_contract_post_questions_not_valid(self):
+        """Test contract POST /questions errors"""
+        self.assertError(self.client().post('/questions',
+                                            json={'searchTerm': 3}),
+                         422, 'Unprocessable Entity')
+        self.assertError(self.client().post('/questions', json={
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': 9,
+            'category': self.category_id
+        }), 422, 'Unprocessable Entity')
+        self.assertError(self.client().post('/questions', json={
+            'question': 'question',
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': 999999
+        }), 422, 'Unprocessable Entity')
+        self.assertError(self.client().post('/questions', json=[]),
+                         400, 'Bad Request')
+        self.assertError(self.client().post(
+            '/questions', data='{', content_type='application/json'),
+            400, 'Bad Request')
+        self.assertEqual(self.category_total(), 12)
+
+    def test_contract_post_and_delete_question(self):
+        """Test contract POST /questions and DELETE /questions/<id>"""
+        response = self.client().post('/questions', json={
+            'question': 'Which quokka is new?',
+            'answer': 'This one',
+            'difficulty': '2',
+            'category': str(self.category_id)
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        created = data['created']
+        self.assertGreater(created, self.question_ids[-1])
+        self.assertEqual(self.category_total(), 13)
+        response = self.client().get(
+            f'/categories/{self.category_id}/questions?page=2')
+        self.assertEqual(json.loads(response.data)['questions'][-1], {
+            'id': created,
+            'question': 'Which quokka is new?',
+            'answer': 'This one',
+            'category': self.category_id,
+            'difficulty': 2
+        })
+        response = self.client().delete(f'/questions/{created}')
+        self.assertEqual(json.loads(response.data),
+                         {'success': True, 'deleted': created})
+        self.assertEqual(self.category_total(), 12)
+        self.assertError(self.client().delete(f'/questions/{created}'),
+                         404, 'Not Found')
+
+    def test_contract_get_question_suggestions(self):
+        """Test contract GET /questions/suggest"""
+        response = self.client().get('/questions/suggest?prefix=Quok&limit=3')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['suggestions']), 3)
+        self.assertTrue(all('quokka' in suggestion
+                            for suggestion in data['suggestions']))
+        response = self.client().get('/questions/suggest?prefix=%20')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+        self.assertError(self.client().get('/questions/suggest'),
+                         422, 'Unprocessable Entity')
+        self.assertError(self.client().get(
+            '/questions/suggest?prefix=quo&limit=0'),
+            422, 'Unprocessable Entity')
+
+    def test_contract_get_question_suggestions_after_writes(self):
+        """Test contract GET /questions/suggest follows writes"""
+        self.client().get('/questions/suggest?prefix=quokka')
+        created = json.loads(self.client().post('/questions', json={
+            'question': 'Which wombat is new?',
+            'answer': 'This one',
+            'difficulty': 2,
+            'category': self.category_id
+        }).data)['created']
+        response = self.client().get('/questions/suggest?prefix=wombat')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         ['Which wombat is new?'])
+        self.client().delete(f'/questions/{created}')
+        response = self.client().get('/questions/suggest?prefix=wombat')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+
+    def test_contract_get_question_suggestions_rule(self):
+        """Test contract GET /questions/suggest matches substrings"""
+        created = [json.loads(self.client().post('/questions', json={
+            'question': question,
+            'answer': 'answer',
+            'difficulty': 1,
+            'category': self.category_id
+        }).data)['created'] for question in [
+            'Where do gazebras live?', 'Is a zebrafish a fish?',
+            'Which zebra is this?']]
+        try:
+            response = self.client().get('/questions/suggest?prefix=ZEBRA')
+            self.assertEqual(json.loads(response.data)['suggestions'], [
+                'Which zebra is this?', 'Is a zebrafish a fish?',
+                'Where do gazebras live?'])
+            response = self.client().get('/questions/suggest?prefix=ze')
+            self.assertEqual(json.loads(response.data)['suggestions'], [])
+        finally:
+            for question_id in created:
+                self.client().delete(f'/questions/{question_id}')
+
+    def test_contract_post_questions_bulk(self):
+        """Test contract POST /questions/bulk"""
+        rows = [{
+            'question': f'Bulk quokka {i}?',
+            'answer': 'Bulk',
+            'category': self.category_id,
+            'difficulty': 3
+        } for i in range(3)]
+        response = self.client().post('/questions/bulk', json=rows)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 3)
+        self.assertIsInstance(data['rows_per_second'], int)
+        response = self.client().post(
+            '/questions/bulk', content_type='application/x-ndjson',
+            data='\n'.join(json.dumps(row) for row in rows[:2]))
+        self.assertEqual(json.loads(response.data)['created'], 2)
+        self.assertEqual(self.category_total(), 17)
+        response = self.client().post('/questions/bulk',
+                                      json=[rows[0], {'question': ''}])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.data), {
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable Entity',
+            'errors': [{'row': 1, 'message':
+                        'difficulty and category must be integers'}]
+        })
+        self.assertError(self.client().post('/questions/bulk',
+                                            json={'rows': rows}),
+                         400, 'Bad Request')
+        self.assertEqual(self.category_total(), 17)
+
+    def test_contract_get_questions_export(self):
+        """Test contract GET /questions/export as NDJSON and CSV"""
+        response = self.client().get(
+            f'/questions/export?category={self.category_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in
+                response.data.decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.question_ids)
+        self.assertEqual(rows[3]['answer'], 'Answer 3')
+        response = self.client().get(
+            f'/questions/export?format=csv&category={self.category_id}'
+            f'&difficulty=2')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(list(csv.reader(io.StringIO(
+            response.data.decode()))), [
+            ['id', 'question', 'answer', 'category', 'difficulty']] + [
+            [str(self.question_ids[i]), f'Which quokka number {i}?',
+             f'Answer {i}', str(self.category_id), '2'] for i in [1, 6, 11]])
+        self.assertError(self.client().get('/questions/export?format=xml'),
+                         422, 'Unprocessable Entity')
+        self.assertError(self.client().get(
+            '/questions/export?category=science'),
+            422, 'Unprocessable Entity')
+
+    def test_contract_delete_questions(self):
+        """Test contract DELETE /questions by filters and IDs"""
+        response = self.client().delete('/questions', json={
+            'category': self.category_id,
+            'difficulty': 1
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, {
+            'success': True,
+            'deleted': [self.question_ids[i] for i in [0, 5, 10]],
+            'total_deleted': 3
+        })
+        response = self.client().delete('/questions', json={
+            'ids': [self.question_ids[2], self.question_ids[0]]
+        })
+        self.assertEqual(json.loads(response.data)['deleted'],
+                         [self.question_ids[2]])
+        self.assertEqual(self.category_total(), 8)
+        self.assertError(self.client().delete('/questions', json={}),
+                         422, 'Unprocessable Entity')
+        self.assertError(self.client().delete('/questions'),
+                         400, 'Bad Request')
+
+    def test_contract_post_quizzes_plays_every_question(self):
+        """Test contract POST /quizzes with previous questions"""
+        previous_questions = []
+        while True:
+            response = self.client().post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'type': 'Contract',
+                                  'id': self.category_id}
+            })
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['success'], True)
+            if data['question'] is None:
+                break
+            self.assertEqual(data['question']['category'], self.category_id)
+            previous_questions.append(data['question']['id'])
+        self.assertEqual(sorted(previous_questions), self.question_ids)
+
+    def test_contract_post_quizzes_count(self):
+        """Test contract POST /quizzes with count"""
+        response = self.client().post('/quizzes', json={
+            'previous_questions': self.question_ids[:4],
+            'quiz_category': {'id': self.category_id},
+            'count': 20,
+            'strategy': 'weighted'
+        })
+        questions = json.loads(response.data)['questions']
+        self.assertEqual(sorted(question['id'] for question in questions),
+                         self.question_ids[4:])
+        self.assertEqual(set(questions[0]), {
+            'id', 'question', 'answer', 'category', 'difficulty'})
+        for count in [0, MAX_QUIZ_COUNT + 1, True]:
+            self.assertError(self.client().post('/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'id': self.category_id},
+                'count': count
+            }), 422, 'Unprocessable Entity')
+
+    def test_contract_post_quizzes_session(self):
+        """Test contract POST /quizzes with a quiz session"""
+        played = []
+        quiz_session = 7
+        while True:
+            response = self.client().post('/quizzes', json={
+                'quiz_session': quiz_session,
+                'quiz_category': {'id': self.category_id}
+            })
+            data = json.loads(response.data)
+            quiz_session = data['quiz_session']
+            if data['question'] is None:
+                break
+            played.append(data['question']['id'])
+        self.assertEqual(sorted(played), self.question_ids)
+        self.assertError(self.client().post('/quizzes', json={
+            'quiz_session': 'not a session',
+            'quiz_category': {'id': self.category_id}
+        }), 422, 'Unprocessable Entity')
+
+    def test_contract_post_quizzes_not_valid(self):
+        """Test contract POST /quizzes errors"""
+        for body in [
+                {'previous_questions': [], 'quiz_category': {'id': 999999}},
+                {'previous_questions': [], 'quiz_category': None},
+                {'quiz_category': {'id': self.category_id}},
+                {'previous_questions': [], 'strategy': 'hardest',
+                 'quiz_category': {'id': self.category_id}},
+                {'previous_questions': [], 'strategy': 'adaptive',
+                 'correct': -1, 'quiz_category': {'id': self.category_id}}]:
+            self.assertError(self.client().post('/quizzes', json=body),
+                             422, 'Unprocessable Entity')
+        self.assertError(self.client().post('/quizzes', data='quiz'),
+                         400, 'Bad Request')
+
+    def test_contract_unknown_route(self):
+        """Test contract 404 for a route that does not exist"""
+        self.assertError(self.client().get('/answers'), 404, 'Not Found')
+
+    def test_contract_method_not_allowed(self):
+        """Test contract 405 in JSON for a method the route does not take"""
+        response = self.client().open('/categories', method='PUT')
+        self.assertError(response, 405, 'Method Not Allowed')
+        self.assertEqual(set(response.headers['Allow'].split(', ')),
+                         {'GET', 'HEAD', 'OPTIONS'})
+
+    def test_contract_get_not_modified(self):
+        """Test contract ETag and 304 of read endpoints"""
+        paths = ['/categories', '/questions',
+                 f'/categories/{self.category_id}/questions',
+                 '/questions/suggest?prefix=quokka']
+        etags = {}
+        for path in paths:
+            response = self.client().get(path)
+            etags[path] = response.headers['ETag']
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+            # In-process versions do not know when other workers wrote
+            self.assertNotIn('Last-Modified', response.headers)
+            response = self.client().get(
+                path, headers={'If-None-Match': etags[path]})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etags[path])
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        response = self.client().get('/questions', headers={
+            'If-None-Match': '"stale"',
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        self.client().post('/questions', json={
+            'question': 'Which quokka is new?',
+            'answer': 'This one',
+            'difficulty': 2,
+            'category': self.category_id
+        })
+        for path in paths:
+            response = self.client().get(
+                path, headers={'If-None-Match': etags[path]})
+            # Only the categories are unchanged by a new question
+            self.assertEqual(response.status_code,
+                             304 if path == '/categories' else 200)
+
+    def test_contract_get_not_modified_since(self):
+        """Test contract Last-Modified and 304 with DATA_VERSION_TABLE"""
+        config = {'DATABASE_URL': self.database_url,
+                  'DATA_VERSION_TABLE': True}
+        self.start_app(config)
+        self.client().get('/questions')
+        with self.fixture_app.app_context():
+            db.session.query(DataVersion).update(
+                {DataVersion.updated_at: datetime(2020, 1, 1, 12, 0, 0, 500)})
+            db.session.commit()
+        response = self.client().get('/questions')
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Wed, 01 Jan 2020 12:00:00 GMT')
+        # Versions in the table give the same ETags in every app
+        self.assertEqual(response.headers['ETag'], create_app(
+            config).test_client().get('/questions').headers['ETag'])
+        response = self.client().get('/questions', headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+        response = self.client().get('/questions', headers={
+            'If-Modified-Since': 'Wed, 01 Jan 2020 12:00:00 GMT',
+            'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_contract_cors_headers(self):
+        """Test contract CORS headers and OPTIONS"""
+        response = self.client().get('/categories')
+        self.assertEqual(response.headers['Access-Control-Allow-Methods'],
+                         'GET,PUT,POST,DELETE,OPTIONS')
+        response = self.client().open('/questions', method='OPTIONS')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(response.headers['Allow'].split(', ')),
+            {'GET', 'HEAD', 'POST', 'DELETE', 'OPTIONS'})
+
+    def test_contract_get_metrics(self):
+        """Test contract GET /metrics counts requests by route"""
+        self.client().get(f'/categories/{self.category_id}/questions')
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'trivia_request_duration_seconds_count{method="GET",route='
+            '"/categories/<int:category_id>/questions",status="200"} 1',
+            response.data.decode())
+
+
+class SyncSQLiteContractTestCase(ApiContractTests, unittest.TestCase):
+    """This class runs the API contract tests on create_app and SQLite"""
+
+    def setUp(self):
+        self.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.database_url = 'sqlite:///' + self.database_file.name
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.database_file.close()
+
+    def test_contract_post_quizzes_session_extends(self):
+        """Test contract POST /quizzes session plays IDs beyond its space"""
+        played = []
+        quiz_session = 7
+        while True:
+            data = json.loads(self.client().post('/quizzes', json={
+                'quiz_session': quiz_session,
+                'quiz_category': {'id': self.category_id}
+            }).data)
+            if data['question'] is None:
+                break
+            quiz_session = data['quiz_session']
+            played.append(data['question']['id'])
+        size = QuizSession.decode(quiz_session).size
+        # Inserted with an explicit ID, which SQLite lets the next follow
+        with self.fixture_app.app_context():
+            question = Question('Which quokka is far?', 'This one',
+                                self.category_id, 1)
+            question.id = size + 3
+            question.insert()
+        for expected in [size + 3, None]:
+            data = json.loads(self.client().post('/quizzes', json={
+                'quiz_session': quiz_session,
+                'quiz_category': {'id': self.category_id}
+            }).data)
+            self.assertEqual(data['question'] and data['question']['id'],
+                             expected)
+            quiz_session = data['quiz_session']
+        session = QuizSession.decode(quiz_session)
+        self.assertEqual(session.floor, size)
+        self.assertEqual(QuizSession.decode(session.encode()).floor, size)
+        self.assertEqual(sorted(played), self.question_ids)
+
+
+@unittest.skipIf(aiosqlite is None, 'aiosqlite not installed')
+class AsyncSQLiteContractTestCase(SyncSQLiteContractTestCase):
+    """This class runs the API contract tests on create_async_app and SQLite"""
+
+    async_app = True
+
+    def test_async_concurrent_requests_share_pool(self):
+        """Test success concurrent requests wait for a small pool"""
+        self.start_app({'DATABASE_URL': self.database_url,
+                        'DB_POOL_SIZE': 2})
+        client = self.client()
+        with ThreadPoolExecutor(16) as executor:
+            statuses = list(executor.map(
+                lambda page: client.get(
+                    f'/categories/{self.category_id}/questions?page='
+                    f'{page % 2 + 1}').status_code, range(64)))
+        self.assertEqual(statuses, [200] * 64)
+        status = self.app.pool.status()
+        self.assertEqual(status['size'], 2)
+        self.assertEqual(self.app.pool.opened, 2)
+        self.assertEqual(status['checkouts'], 64 + 1)
+
+    def test_async_write_behind_refused(self):
+        """Test error the async app refuses to start with WRITE_BEHIND"""
+        with self.assertRaises(ValueError):
+            create_async_app({'DATABASE_URL': self.database_url,
+                              'WRITE_BEHIND': True})
+
+    def test_async_indexes_catch_up_with_other_apps(self):
+        """Test success async indexes load questions other apps insert"""
+        self.start_app({'DATABASE_URL': self.database_url,
+                        'CACHE_TTL': 0})
+        client = self.client()
+        client.get('/questions/suggest?prefix=wombat')
+        client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'id': self.category_id}
+        })
+        indexes = dict(self.app.indexes)
+        created = json.loads(self.fixture_app.test_client().post(
+            '/questions', json={
+                'question': 'Which wombat is new?',
+                'answer': 'This one',
+                'difficulty': 2,
+                'category': self.category_id
+            }).data)['created']
+        response = client.get('/questions/suggest?prefix=wombat')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         ['Which wombat is new?'])
+        response = client.post('/quizzes', json={
+            'previous_questions': self.question_ids,
+            'quiz_category': {'id': self.category_id}
+        })
+        self.assertEqual(json.loads(response.data)['question']['id'],
+                         created)
+        # Caught up in place rather than rebuilt
+        self.assertEqual(self.app.indexes, indexes)
+        self.assertEqual(indexes['ngrams'].max_id, created)
+
+    def test_async_delete_questions_select_then_delete(self):
+        """Test success SQLite deletes selected questions by ID chunks"""
+        with self.assertRaises(TypeError):
+            Connection(None)
+        with mock.patch('flaskr.asgi.DELETE_CHUNK_SIZE', 2):
+            response = self.client().delete('/questions', json={
+                'ids': self.question_ids[:5] + [0],
+                'difficulty': 1
+            })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], [self.question_ids[0]])
+        with mock.patch('flaskr.asgi.DELETE_CHUNK_SIZE', 2):
+            response = self.client().delete('/questions', json={
+                'category': self.category_id,
+                'difficulty': 2
+            })
+        self.assertEqual(json.loads(response.data)['deleted'],
+                         [self.question_ids[i] for i in [1, 6, 11]])
+        self.assertEqual(self.category_total(), 8)
+
+
+class SyncPostgresContractTestCase(ApiContractTests, unittest.TestCase):
+    """This class runs the API contract tests on create_app and PostgreSQL"""
+
+
+@unittest.skipIf(asyncpg is None, 'asyncpg not installed')
+class AsyncPostgresContractTestCase(ApiContractTests, unittest.TestCase):
+    """
+    This class runs the API contract tests on create_async_app and
+    PostgreSQL
+    """
+
+    async_app = True
+
+    def test_async_statement_placeholders(self):
+        """Test success ? placeholders are numbered for asyncpg"""
+        self.assertEqual(numbered('SELECT ? WHERE id = ANY(?) LIMIT ?'),
+                         'SELECT $1 WHERE id = ANY($2) LIMIT $3')
+
+    def test_async_writes_seen_by_sync_app(self):
+        """Test success writes of both apps are seen with DATA_VERSION_TABLE"""
+        config = {'DATABASE_URL': self.database_url,
+                  'DATA_VERSION_TABLE': True}
+        self.start_app(config)
+        sync_client = create_app(config).test_client()
+        async_client = self.client()
+        path = f'/categories/{self.category_id}/questions'
+        previous_questions = self.question_ids[:-1]
+        for client in [sync_client, async_client]:
+            client.get(path)
+            client.post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'id': self.category_id}})
+        created = json.loads(async_client.post('/questions', json={
+            'question': 'Which quokka is new?',
+            'answer': 'This one',
+            'difficulty': 2,
+            'category': self.category_id
+        }).data)['created']
+        self.assertEqual(json.loads(sync_client.get(path).data)[
+            'total_questions'], 13)
+        played = set()
+        for _ in range(20):
+            response = sync_client.post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'id': self.category_id}})
+            played.add(json.loads(response.data)['question']['id'])
+        self.assertEqual(played, {self.question_ids[-1], created})
+        sync_client.delete(f'/questions/{created}')
+        self.assertEqual(json.loads(async_client.get(path).data)[
+            'total_questions'], 12)
+        response = async_client.post('/quizzes', json={
+            'previous_questions': previous_questions,
+            'quiz_category': {'id': self.category_id},
+            'count': 5})
+        self.assertEqual([question['id'] for question in
+                          json.loads(response.data)['questions']],
+                         [self.question_ids[-1]])
+
+
 # Make the tests conveniently executable
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
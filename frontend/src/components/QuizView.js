@@ -11,6 +11,7 @@ class QuizView extends Component {
     this.state = {
         quizCategory: null,
         previousQuestions: [],
+        upcomingQuestions: [],
         showAnswer: false,
         categories: {},
         numCorrect: 0,
@@ -36,38 +37,30 @@ class QuizView extends Component {
   }
 
   selectCategory = ({type, id=0}) => {
-    this.setState({quizCategory: {type, id}}, this.getNextQuestion)
+    this.setState({quizCategory: {type, id}}, this.loadQuestions)
   }
 
   handleChange = (event) => {
     this.setState({[event.target.name]: event.target.value})
   }
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions]
-    if(this.state.currentQuestion.id) { previousQuestions.push(this.state.currentQuestion.id) }
-
+  loadQuestions = () => {
     $.ajax({
       url: '/quizzes',
       type: "POST",
       dataType: 'json',
       contentType: 'application/json',
       data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory
+        previous_questions: [],
+        quiz_category: this.state.quizCategory,
+        count: questionsPerPlay
       }),
       xhrFields: {
         withCredentials: true
       },
       crossDomain: true,
       success: (result) => {
-        this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: '',
-          forceEnd: result.question ? false : true
-        })
+        this.setState({upcomingQuestions: result.questions}, this.getNextQuestion)
         return;
       },
       error: (error) => {
@@ -77,6 +70,21 @@ class QuizView extends Component {
     })
   }
 
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions]
+    if(this.state.currentQuestion.id) { previousQuestions.push(this.state.currentQuestion.id) }
+    const [nextQuestion, ...upcomingQuestions] = this.state.upcomingQuestions
+
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      upcomingQuestions: upcomingQuestions,
+      currentQuestion: nextQuestion || {},
+      guess: '',
+      forceEnd: nextQuestion ? false : true
+    })
+  }
+
   submitGuess = (event) => {
     event.preventDefault();
     const formatGuess = this.state.guess.replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g,"").toLowerCase()
@@ -91,6 +99,7 @@ class QuizView extends Component {
     this.setState({
       quizCategory: null,
       previousQuestions: [],
+      upcomingQuestions: [],
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},